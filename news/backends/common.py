@@ -15,3 +15,11 @@ class NewsletterNoResultsException(NewsletterException):
     didn't report any errors)
     """
     pass
+
+
+class CircuitOpen(NewsletterException):
+    """
+    ExactTarget has been failing or timing out, so we aren't calling it
+    for a while.
+    """
+    pass
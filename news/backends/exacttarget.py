@@ -16,23 +16,84 @@ et.data_ext().add_record('Master_Subscribers',
 et.trigger_send('WelcomeEmail', 'jlong@mozilla.com', 'hello', 'H')
 """
 
+import atexit
+import cPickle as pickle
+import gc
+import hashlib
 import os
+import threading
+import time
+from contextlib import contextmanager
 from functools import wraps
+from multiprocessing.pool import ThreadPool, TimeoutError
 
 from django.conf import settings
 from django.core.cache import cache
+from django_statsd.clients import statsd
 
+import suds
 from suds import WebFault
 from suds.cache import Cache
 from suds.client import Client
 from suds.transport.https import HttpAuthenticated
 from suds.wsse import Security, UsernameToken
 
-from .common import NewsletterException, NewsletterNoResultsException, \
-    UnauthorizedException
+from news.usercache import user_data_stamp
+
+from . import soapcodec, transport
+from .common import CircuitOpen, NewsletterException, \
+    NewsletterNoResultsException, UnauthorizedException
 
 
 ET_TIMEOUT = getattr(settings, 'EXACTTARGET_TIMEOUT', 3)
+# Send calls here instead of the endpoint in the WSDL, e.g. to a fake ET
+# started with ./manage.py run_fake_et
+ET_ENDPOINT = getattr(settings, 'EXACTTARGET_ENDPOINT', None)
+
+# ET rejects API calls carrying more objects than this.
+ET_BATCH_SIZE = getattr(settings, 'EXACTTARGET_BATCH_SIZE', 2500)
+
+# Most values we put in one IN filter of a Retrieve call.
+ET_FILTER_BATCH_SIZE = getattr(settings, 'EXACTTARGET_FILTER_BATCH_SIZE', 100)
+# Render and parse add_record, get_record and trigger_send calls with
+# soapcodec instead of suds.
+ET_FAST_SOAP = getattr(settings, 'EXACTTARGET_FAST_SOAP', False)
+# Threads per process for lookups run with get_record_async
+ET_LOOKUP_THREADS = getattr(settings, 'EXACTTARGET_LOOKUP_THREADS', 10)
+# suds clients per process, each used by one thread at a time
+ET_CLIENT_POOL_SIZE = getattr(settings, 'EXACTTARGET_CLIENT_POOL_SIZE', 10)
+# Seconds to wait for a client when they're all in use
+ET_CLIENT_POOL_WAIT = getattr(settings, 'EXACTTARGET_CLIENT_POOL_WAIT',
+                              ET_TIMEOUT)
+
+# Stop calling ET for a while when it keeps failing. See CircuitBreaker.
+ET_BREAKER_ENABLED = getattr(settings, 'EXACTTARGET_BREAKER_ENABLED', True)
+# Seconds over which calls are counted
+ET_BREAKER_WINDOW = getattr(settings, 'EXACTTARGET_BREAKER_WINDOW', 60)
+# Calls needed in a window before the breaker can trip
+ET_BREAKER_MIN_CALLS = getattr(settings, 'EXACTTARGET_BREAKER_MIN_CALLS', 20)
+# Fraction of failed or slow calls that trips the breaker
+ET_BREAKER_ERROR_RATE = getattr(settings, 'EXACTTARGET_BREAKER_ERROR_RATE',
+                                0.5)
+# Seconds after which a call counts as slow
+ET_BREAKER_SLOW_CALL = getattr(settings, 'EXACTTARGET_BREAKER_SLOW_CALL',
+                               ET_TIMEOUT)
+# Seconds to fail fast before letting a call through to test ET again
+ET_BREAKER_OPEN_SECONDS = getattr(settings, 'EXACTTARGET_BREAKER_OPEN_SECONDS',
+                                  30)
+# Seconds to wait for a set of lookups started together. A single
+# call can take up to ET_TIMEOUT to connect and again to read.
+ET_LOOKUP_DEADLINE = getattr(settings, 'EXACTTARGET_LOOKUP_DEADLINE',
+                             ET_TIMEOUT * 2)
+# Let concurrent get_record calls for the same record share one ET call
+ET_SINGLE_FLIGHT = getattr(settings, 'EXACTTARGET_SINGLE_FLIGHT', True)
+# ... across processes too, through the cache
+ET_SINGLE_FLIGHT_SHARED = getattr(settings,
+                                  'EXACTTARGET_SINGLE_FLIGHT_SHARED', False)
+
+# Bump this if the snapshot file format changes, so that stale snapshots
+# written by older code are ignored rather than unpickled.
+WSDL_SNAPSHOT_VERSION = 1
 
 
 class SudsDjangoCache(Cache):
@@ -58,21 +119,172 @@ class SudsDjangoCache(Cache):
         cache.delete(self._cache_key(id))
 
 
+class WSDLSnapshotCache(Cache):
+    """
+    Implement the suds cache interface on top of a precompiled snapshot
+    of the parsed WSDL.
+
+    suds spends seconds parsing our WSDL (and fetching the fault schema
+    it imports) every time a process builds its first client. The
+    ``build_wsdl_snapshot`` management command pickles the resulting
+    definitions to disk once; at runtime this cache hands them back to
+    suds instead.
+
+    The snapshot starts with a header line made of the snapshot format
+    version, the suds version and the SHA1 of the WSDL file. If any of
+    those don't match, the snapshot is ignored and suds parses the WSDL
+    as usual.
+
+    Unless ``writable`` is set, ``put`` is a no-op, so web and worker
+    processes never write into the code directory.
+    """
+    def __init__(self, wsdl_file, snapshot_file=None, writable=False):
+        self.wsdl_file = wsdl_file
+        self.snapshot_file = snapshot_file or wsdl_snapshot_path(wsdl_file)
+        self.writable = writable
+
+    def header(self):
+        with open(self.wsdl_file, 'rb') as f:
+            checksum = hashlib.sha1(f.read()).hexdigest()
+        return '%d:%s:%s\n' % (WSDL_SNAPSHOT_VERSION, suds.__version__,
+                               checksum)
+
+    def is_valid(self):
+        """Return True if the snapshot exists and matches the WSDL file"""
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                return f.readline() == self.header()
+        except IOError:
+            return False
+
+    def get(self, id):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                if f.readline() != self.header():
+                    return None
+                data = f.read()
+        except IOError:
+            return None
+        # The definitions are a large graph of small objects; the cyclic
+        # garbage collector would otherwise run many times while they are
+        # being created.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return pickle.loads(data)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def put(self, id, value):
+        if not self.writable:
+            return
+        # Write to a temp file and rename, so a process starting up
+        # never sees a half-written snapshot.
+        tmp_file = '%s.%d.tmp' % (self.snapshot_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            f.write(self.header())
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.snapshot_file)
+
+    def purge(self, id):
+        if not self.writable:
+            return
+        try:
+            os.remove(self.snapshot_file)
+        except OSError:
+            pass
+
+
+def wsdl_path():
+    """Return the path of the WSDL file for the configured ET account"""
+    wsdl_file_name = ('et-sandbox-wsdl.txt' if settings.EXACTTARGET_USE_SANDBOX
+                      else 'et-wsdl.txt')
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        wsdl_file_name)
+
+
+def wsdl_snapshot_path(wsdl_file):
+    """Return where the parsed snapshot of ``wsdl_file`` is stored"""
+    snapshot_dir = getattr(settings, 'EXACTTARGET_WSDL_SNAPSHOT_DIR', None)
+    if not snapshot_dir:
+        snapshot_dir = os.path.dirname(wsdl_file)
+    return os.path.join(snapshot_dir,
+                        os.path.basename(wsdl_file) + '.snapshot')
+
+
+def make_client(user, pass_, cache=None):
+    """
+    Build a new suds client for ET.
+
+    The parsed WSDL is loaded from its snapshot if a valid one has been
+    built; otherwise suds parses the WSDL file. Every client, including
+    the one build_wsdl_snapshot makes, is built the same way here.
+    """
+    # Monkey-patch suds because it always initializes an ObjectCache
+    # before looking at the cache you told it to use, and that tries
+    # to use the same subdir under /tmp even if it already exists
+    # and is owned by another user.
+    # While we're at it, use Django caching instead of temp files.
+    import suds.client
+    suds.client.ObjectCache = SudsDjangoCache
+
+    # This is just a cached version. The real URL is:
+    # https://webservice.s4.exacttarget.com/etframework.wsdl
+    #
+    # The cached version has been stripped down to make suds run 1000x
+    # faster. I deleted most of the fields in the TriggeredSendDefinition
+    # and TriggeredSend objects that we don't use.
+    wsdl_file = wsdl_path()
+    wsdl_url = 'file://{0}'.format(wsdl_file)
+
+    kwargs = {}
+    if cache is None:
+        cache = WSDLSnapshotCache(wsdl_file)
+        if not cache.is_valid():
+            cache = None
+    if cache is not None:
+        # Policy 1 makes suds cache the whole parsed WSDL instead of
+        # the raw XML documents.
+        kwargs['cache'] = cache
+        kwargs['cachingpolicy'] = 1
+    if ET_ENDPOINT:
+        kwargs['location'] = ET_ENDPOINT
+
+    security = Security()
+    token = UsernameToken(user, pass_)
+    security.tokens.append(token)
+    if transport.POOL_SIZE:
+        http = transport.PooledHttpTransport(timeout=ET_TIMEOUT)
+    else:
+        http = HttpAuthenticated(timeout=ET_TIMEOUT)
+    return Client(wsdl_url, wsse=security, transport=http, **kwargs)
+
+
+def result_error(res):
+    """Return the error message of one entry of a response's Results,
+    or None if that entry succeeded."""
+    if hasattr(res, 'ErrorMessage') and res.ErrorMessage:
+        return res.ErrorMessage
+    elif hasattr(res, 'ValueErrors') and res.ValueErrors:
+        # For some reason, the value errors array is inside an array
+        val_errs = res.ValueErrors[0]
+        if len(val_errs) > 0:
+            return val_errs[0].ErrorMessage
+    elif hasattr(res, 'StatusCode') and res.StatusCode == 'Error':
+        return res.StatusMessage
+    return None
+
+
 def assert_status(obj):
     """Make sure the returned status is OK"""
     if obj.OverallStatus != 'OK':
         if hasattr(obj, 'Results') and len(obj.Results) > 0:
-            res = obj.Results[0]
-
-            if hasattr(res, 'ErrorMessage') and res.ErrorMessage:
-                raise NewsletterException(res.ErrorMessage)
-            elif hasattr(res, 'ValueErrors') and res.ValueErrors:
-                # For some reason, the value errors array is inside an array
-                val_errs = res.ValueErrors[0]
-                if len(val_errs) > 0:
-                    raise NewsletterException(val_errs[0].ErrorMessage)
-            elif hasattr(res, 'StatusCode') and res.StatusCode == 'Error':
-                raise NewsletterException(res.StatusMessage)
+            error = result_error(obj.Results[0])
+            if error:
+                raise NewsletterException(error)
         raise NewsletterException(obj.OverallStatus)
 
 
@@ -82,6 +294,42 @@ def assert_result(obj):
         raise NewsletterNoResultsException('No results returned')
 
 
+def map_results(obj, count):
+    """
+    Map the Results of a response to a request that sent ``count``
+    objects back onto those objects.
+
+    Returns a list with one entry per object sent: its result, or None
+    if ET didn't return one for it. Raises NewsletterException if the
+    whole request failed.
+    """
+    results = getattr(obj, 'Results', None) or []
+    if obj.OverallStatus != 'OK' and not results:
+        raise NewsletterException(obj.OverallStatus)
+
+    mapped = [None] * count
+    for i, res in enumerate(results):
+        # ET numbers results by the position of the object in the
+        # request; fall back to the order of the results if it doesn't.
+        try:
+            index = int(getattr(res, 'OrdinalID', None))
+        except (TypeError, ValueError):
+            index = i
+        if not 0 <= index < count:
+            index = i
+        if index < count:
+            mapped[index] = res
+    return mapped
+
+
+def result_errors(obj, count):
+    """
+    Like map_results, but returns for each object sent None if ET saved
+    it, otherwise ET's error message for it.
+    """
+    return [res and result_error(res) for res in map_results(obj, count)]
+
+
 def handle_fault(e):
     """Handle an exception thrown by suds, and throw the appropriate
     type of error"""
@@ -94,48 +342,406 @@ def handle_fault(e):
     raise NewsletterException(str(e))
 
 
+class CircuitBreaker(object):
+    """
+    Stop calling ET for a while when most calls to it fail or are slow.
+
+    Calls are counted in windows of ``window`` seconds. Once at least
+    ``min_calls`` calls were made in a window and ``error_rate`` of
+    them failed to get an answer from ET or took ``slow_call`` seconds
+    or more, the breaker opens: calls raise CircuitOpen right away
+    instead of waiting on ET. After ``open_seconds`` one call at a time
+    is let through as a probe; if it goes well the breaker closes,
+    otherwise it stays open for another ``open_seconds``.
+
+    The state is kept in the cache, so all processes sharing it stop
+    calling ET together.
+    """
+    def __init__(self, name, window, min_calls, error_rate, slow_call,
+                 open_seconds):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+
+    def key(self, name):
+        return 'circuit-breaker:%s:%s' % (self.name, name)
+
+    def opened_at(self):
+        return cache.get(self.key('opened'))
+
+    def is_open(self):
+        """True while calls should fail fast, not counting probes"""
+        opened = self.opened_at()
+        return opened is not None and time.time() < opened + self.open_seconds
+
+    def before_call(self):
+        """
+        Call before calling ET.
+
+        :returns: True if the call is the probe of a half-open breaker
+        :raises: CircuitOpen if the call must not be made
+        """
+        opened = self.opened_at()
+        if opened is None:
+            return False
+        if (time.time() >= opened + self.open_seconds and
+                cache.add(self.key('probe'), 1, self.open_seconds)):
+            return True
+        statsd.incr('news.et.breaker.rejected')
+        raise CircuitOpen('ExactTarget is unavailable')
+
+    def after_call(self, probe, ok, elapsed):
+        """
+        Call after calling ET.
+
+        :param bool probe: What before_call returned
+        :param bool ok: Whether ET answered, even if with an error
+        :param float elapsed: Seconds the call took
+        """
+        bad = not ok or elapsed >= self.slow_call
+        if probe:
+            if bad:
+                self.trip()
+            else:
+                statsd.incr('news.et.breaker.close')
+                self.reset()
+            cache.delete(self.key('probe'))
+            return
+
+        calls = self.incr('calls')
+        if not bad:
+            return
+        errors = self.incr('errors')
+        if (calls >= self.min_calls and
+                errors >= calls * self.error_rate and
+                self.opened_at() is None):
+            self.trip()
+
+    def cancel(self, probe):
+        """Call instead of after_call if ET wasn't called after all"""
+        if probe:
+            cache.delete(self.key('probe'))
+
+    def trip(self):
+        statsd.incr('news.et.breaker.open')
+        # Forget the state eventually even if nobody probes.
+        cache.set(self.key('opened'), time.time(), self.open_seconds * 10)
+        self.clear_counts()
+
+    def window_key(self, name):
+        return self.key('%s:%d' % (name, time.time() // self.window))
+
+    def clear_counts(self):
+        cache.delete_many([self.window_key('calls'),
+                           self.window_key('errors')])
+
+    def incr(self, name):
+        key = self.window_key(name)
+        cache.add(key, 0, self.window * 2)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # Expired in between
+            cache.add(key, 1, self.window * 2)
+            return 1
+
+    def reset(self):
+        cache.delete_many([self.key('opened'), self.key('probe')])
+        self.clear_counts()
+
+
+breaker = CircuitBreaker('exacttarget', ET_BREAKER_WINDOW,
+                         ET_BREAKER_MIN_CALLS, ET_BREAKER_ERROR_RATE,
+                         ET_BREAKER_SLOW_CALL, ET_BREAKER_OPEN_SECONDS)
+
+
 def logged_in(f):
-    """ Decorator to ensure the request will be authenticated """
+    """
+    Decorator to ensure the request will be authenticated.
+
+    Objects made without a client check one out of the client pool for
+    the duration of each call. Calls fail fast with CircuitOpen while
+    the circuit breaker is open.
+    """
 
     @wraps(f)
     def wrapper(inst, *args, **kwargs):
-        if not inst.client:
-            # Try to re-use existing client instance.
-            inst.client = getattr(logged_in, 'cached_client', None)
-        if not inst.client:
-            # Monkey-patch suds because it always initializes an ObjectCache
-            # before looking at the cache you told it to use, and that tries
-            # to use the same subdir under /tmp even if it already exists
-            # and is owned by another user.
-            # While we're at it, use Django caching instead of temp files.
-            import suds.client
-            suds.client.ObjectCache = SudsDjangoCache
-
-            wsdl_file_name = ('et-sandbox-wsdl.txt' if settings.EXACTTARGET_USE_SANDBOX
-                              else 'et-wsdl.txt')
-
-            # This is just a cached version. The real URL is:
-            # https://webservice.s4.exacttarget.com/etframework.wsdl
-            #
-            # The cached version has been stripped down to make suds run 1000x
-            # faster. I deleted most of the fields in the TriggeredSendDefinition
-            # and TriggeredSend objects that we don't use.
-            wsdl_url = 'file://{0}/{1}'.format(os.path.dirname(os.path.abspath(__file__)),
-                                               wsdl_file_name)
-
-            security = Security()
-            token = UsernameToken(inst.user, inst.pass_)
-            security.tokens.append(token)
-            inst.client = Client(wsdl_url, wsse=security,
-                                 transport=HttpAuthenticated(timeout=ET_TIMEOUT))
-
-            # Save client instance and just re-use it next time.
-            setattr(logged_in, 'cached_client', inst.client)
-        return f(inst, *args, **kwargs)
+        if not ET_BREAKER_ENABLED:
+            return call_with_client(f, inst, args, kwargs)
+
+        probe = breaker.before_call()
+        called = []
+
+        # Only time the call itself, once a client has been checked out:
+        # waiting for one is our problem, not ET's.
+        def timed(inst, *args, **kwargs):
+            called.append(True)
+            ok = False
+            start = time.time()
+            try:
+                result = f(inst, *args, **kwargs)
+                ok = True
+                return result
+            except (NewsletterException, UnauthorizedException):
+                # ET answered, just not with what we wanted.
+                ok = True
+                raise
+            finally:
+                breaker.after_call(probe, ok, time.time() - start)
+
+        try:
+            return call_with_client(timed, inst, args, kwargs)
+        finally:
+            if not called:
+                breaker.cancel(probe)
     return wrapper
 
 
+def call_with_client(f, inst, args, kwargs):
+    if inst.client:
+        return f(inst, *args, **kwargs)
+    with client_pool(inst.user, inst.pass_).client() as client:
+        inst.client = client
+        try:
+            return f(inst, *args, **kwargs)
+        finally:
+            inst.client = None
+
+
+class ClientPool(object):
+    """
+    A bounded pool of suds clients.
+
+    suds clients keep the state of the call in progress, so a client
+    must only be used by one thread at a time. The pool builds ``size``
+    clients up front and hands each to one caller at a time; callers
+    wait up to ``wait`` seconds for one to come back when all are in
+    use.
+    """
+    def __init__(self, factory, size, wait):
+        self.idle = [factory() for i in range(size)]
+        self.size = size
+        self.wait = wait
+        self.condition = threading.Condition()
+
+    def checkout(self):
+        start = time.time()
+        with self.condition:
+            if not self.idle:
+                statsd.incr('news.et.client_pool.exhausted')
+            while not self.idle:
+                remaining = start + self.wait - time.time()
+                if remaining <= 0:
+                    statsd.incr('news.et.client_pool.timeout')
+                    raise NewsletterException(
+                        'Timed out waiting for an ExactTarget client')
+                self.condition.wait(remaining)
+            client = self.idle.pop()
+        statsd.timing('news.et.client_pool.wait',
+                      int((time.time() - start) * 1000))
+        return client
+
+    def checkin(self, client):
+        with self.condition:
+            self.idle.append(client)
+            self.condition.notify()
+
+    @contextmanager
+    def client(self):
+        client = self.checkout()
+        try:
+            yield client
+        finally:
+            self.checkin(client)
+
+
+_client_pools = {}
+_client_pools_pid = None
+_client_pools_lock = threading.Lock()
+
+
+def client_pool(user, pass_):
+    """Return the process's pool of clients for an ET user"""
+    global _client_pools, _client_pools_pid
+    with _client_pools_lock:
+        # Clients made before a fork would share their transports'
+        # sockets with the parent, so a forked worker makes its own.
+        if _client_pools_pid != os.getpid():
+            _client_pools = {}
+            _client_pools_pid = os.getpid()
+        pool = _client_pools.get(user)
+        if pool is None:
+            # Parse the WSDL once; clones share it. Their transports
+            # share the connection pool.
+            template = make_client(user, pass_)
+            pool = ClientPool(template.clone, ET_CLIENT_POOL_SIZE,
+                              ET_CLIENT_POOL_WAIT)
+            _client_pools[user] = pool
+        return pool
+
+
+def clear_client_pools():
+    """Forget all client pools, e.g. after changing the WSDL"""
+    with _client_pools_lock:
+        _client_pools.clear()
+
+
+_lookup_pool = None
+_lookup_pool_pid = None
+_lookup_pool_lock = threading.Lock()
+
+
+def _stop_lookup_pool(pool):
+    # Let its threads finish before the interpreter tears down modules
+    # they're still using.
+    pool.close()
+    pool.join()
+
+
+def lookup_pool():
+    """Return this process's thread pool for concurrent ET calls"""
+    global _lookup_pool, _lookup_pool_pid
+    with _lookup_pool_lock:
+        # Threads don't survive a fork, so a forked worker needs its own.
+        if _lookup_pool is None or _lookup_pool_pid != os.getpid():
+            _lookup_pool = ThreadPool(ET_LOOKUP_THREADS)
+            _lookup_pool_pid = os.getpid()
+            atexit.register(_stop_lookup_pool, _lookup_pool)
+        return _lookup_pool
+
+
+class PendingCall(object):
+    """An ET call running in the lookup pool"""
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    def result(self, deadline):
+        """
+        Return what the call returned, or raise what it raised.
+
+        :param float deadline: time.time() after which to stop waiting
+        :raises: NewsletterException if the call isn't done by then
+        """
+        try:
+            return self.async_result.get(max(0, deadline - time.time()))
+        except TimeoutError:
+            statsd.incr('news.et.lookup.timeout')
+            raise NewsletterException('Timed out waiting for ExactTarget')
+
+
+class Flight(object):
+    """A call in progress that other callers can wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight(object):
+    """
+    Let concurrent identical calls share the result of one of them.
+
+    The first caller for a key makes the call; callers with the same key
+    that come while it's in progress wait up to ``wait`` seconds for its
+    result or exception instead of making their own. With ``shared``,
+    callers in other processes wait for it too: the first caller takes a
+    lock in the cache and leaves the outcome there for them. Callers that
+    wait in vain make the call themselves.
+    """
+    def __init__(self, name, wait, shared=False, poll=0.02):
+        self.name = name
+        self.wait = wait
+        self.shared = shared
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, f, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait(self.wait)
+            if flight.done.is_set():
+                statsd.incr('news.et.single_flight.shared')
+                return flight.outcome()
+            return f(*args)
+
+        try:
+            if self.shared:
+                flight.result = self.do_shared(key, f, args)
+            else:
+                flight.result = f(*args)
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def cache_key(self, key, kind):
+        digest = hashlib.md5(repr(key)).hexdigest()
+        return 'single-flight:%s:%s:%s' % (self.name, digest, kind)
+
+    def do_shared(self, key, f, args):
+        lock_key = self.cache_key(key, 'lock')
+        result_key = self.cache_key(key, 'result')
+        if cache.add(lock_key, True, self.wait):
+            # Don't let anyone pick up the outcome of an earlier call.
+            cache.delete(result_key)
+            try:
+                result = f(*args)
+            except NewsletterException, e:
+                cache.set(result_key, (False, e), self.wait)
+                raise
+            else:
+                cache.set(result_key, (True, result), self.wait)
+                return result
+            finally:
+                cache.delete(lock_key)
+
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            time.sleep(self.poll)
+            outcome = cache.get(result_key)
+            if outcome is not None:
+                statsd.incr('news.et.single_flight.shared')
+                ok, value = outcome
+                if not ok:
+                    raise value
+                return value
+            if not cache.get(lock_key):
+                # The call failed in a way that wasn't shared.
+                break
+        return f(*args)
+
+
+# Waiters give up no sooner than the leader's call can: it may wait for
+# a client, then take up to ET_TIMEOUT to connect and again to read.
+single_flight = SingleFlight('exacttarget',
+                             ET_CLIENT_POOL_WAIT + ET_TIMEOUT * 2,
+                             ET_SINGLE_FLIGHT_SHARED)
+
+
+def _get_record_in_thread(user, pass_, args):
+    return ExactTargetDataExt(user, pass_).get_record(*args)
+
+
 class ExactTargetObject(object):
+    fast_soap = ET_FAST_SOAP
 
     def __init__(self, user, pass_, client=None):
         self.client = client
@@ -148,6 +754,11 @@ class ExactTargetObject(object):
             setattr(obj, key, kwargs[key])
         return obj
 
+    def fast_call(self, action, body):
+        """Make a call rendered with soapcodec through our client"""
+        return soapcodec.call(self.client, self.user, self.pass_, action,
+                              body)
+
 
 class ExactTargetList(ExactTargetObject):
 
@@ -269,26 +880,23 @@ class ExactTargetList(ExactTargetObject):
 
 class ExactTargetDataExt(ExactTargetObject):
 
-    @logged_in
-    def add_record(self, data_ids, fields, records):
-        data_ids = [data_ids] if isinstance(data_ids, basestring) else data_ids
-
-        objs = []
-        for id in data_ids:
-            obj = self.create('DataExtensionObject')
-            props = []
+    def _record(self, data_id, fields, values):
+        """Build a DataExtensionObject for one row of ``data_id``"""
+        obj = self.create('DataExtensionObject')
+        props = []
 
-            for i, v in enumerate(records):
-                prop = self.create('APIProperty')
-                prop.Name = fields[i]
-                prop.Value = v
+        for i, v in enumerate(values):
+            prop = self.create('APIProperty')
+            prop.Name = fields[i]
+            prop.Value = v
 
-                props.append(prop)
+            props.append(prop)
 
-            obj.Properties.Property = props
-            obj.CustomerKey = id
-            objs.append(obj)
+        obj.Properties.Property = props
+        obj.CustomerKey = data_id
+        return obj
 
+    def _update_options(self):
         opt = self.create('SaveOption')
         opt.PropertyName = '*'
         opt.SaveAction = 'UpdateAdd'
@@ -296,29 +904,99 @@ class ExactTargetDataExt(ExactTargetObject):
         self.create('RequestType')
         opts = self.create('UpdateOptions')
         opts.SaveOptions.SaveOption = [opt]
+        return opts
+
+    @logged_in
+    def add_record(self, data_ids, fields, records):
+        data_ids = [data_ids] if isinstance(data_ids, basestring) else data_ids
 
         try:
-            obj = self.client.service.Update(opts, objs)
+            if self.fast_soap:
+                obj = self.fast_call('Update', soapcodec.update_request(
+                    data_ids, fields, records))
+            else:
+                objs = [self._record(id, fields, records) for id in data_ids]
+                obj = self.client.service.Update(self._update_options(), objs)
             assert_status(obj)
         except WebFault, e:
             handle_fault(e)
 
     @logged_in
-    def get_record(self, data_id, token, fields, field='TOKEN'):
+    def add_records(self, data_id, fields, rows):
+        """
+        Add or update many rows of data extension ``data_id``.
+
+        Rows are sent in as few Update calls as ET allows
+        (``ET_BATCH_SIZE`` rows per call).
+
+        :param str data_id: CustomerKey of the data extension
+        :param list fields: Names of the columns
+        :param list rows: Lists of values, each in the order of ``fields``
+        :returns: A list with one entry per row: None if the row was saved,
+            otherwise ET's error message for that row.
+        :raises: NewsletterException if a whole call fails. Rows in
+            earlier calls have been saved by then; as every row is an
+            UpdateAdd, it is safe to send them all again.
+        """
+        opts = self._update_options()
+        errors = []
+        for start in range(0, len(rows), ET_BATCH_SIZE):
+            batch = rows[start:start + ET_BATCH_SIZE]
+            objs = [self._record(data_id, fields, row) for row in batch]
+            try:
+                obj = self.client.service.Update(opts, objs)
+            except WebFault, e:
+                handle_fault(e)
+            errors.extend(result_errors(obj, len(batch)))
+        return errors
+
+    def _retrieve_request(self, data_id, fields, filter_):
         req = self.create('RetrieveRequest')
         req.ObjectType = 'DataExtensionObject[%s]' % data_id
         req.Properties = fields
-
-        filter_ = self.create('SimpleFilterPart')
-        filter_.Value = token
-        filter_.SimpleOperator = 'equals'
-        filter_.Property = field
         req.Filter = filter_
 
         del req.Options
+        return req
+
+    def get_record(self, data_id, token, fields, field='TOKEN'):
+        """
+        Look up the row of data extension ``data_id`` whose ``field`` is
+        ``token``.
+
+        Concurrent lookups of the same row share one call to ET; see
+        SingleFlight. A lookup only shares the call of one that started
+        after the same writes of the row, so that it can't get a record
+        from before a write it came after; see news.usercache.
+
+        :returns: A dict of the ``fields`` of the row
+        :raises: NewsletterNoResultsException if there's no such row
+        """
+        if not ET_SINGLE_FLIGHT:
+            return self._get_record(data_id, token, fields, field)
+        if field == 'EMAIL_ADDRESS_':
+            stamp = user_data_stamp(email=token)
+        else:
+            stamp = user_data_stamp(token=token)
+        key = (self.user, data_id, field, token, tuple(fields), stamp)
+        # Each caller gets its own copy to change.
+        return dict(single_flight.do(key, self._get_record, data_id, token,
+                                     fields, field))
 
+    @logged_in
+    def _get_record(self, data_id, token, fields, field):
         try:
-            obj = self.client.service.Retrieve(req)
+            if self.fast_soap:
+                obj = self.fast_call('Retrieve', soapcodec.retrieve_request(
+                    'DataExtensionObject[%s]' % data_id, fields, field,
+                    'equals', [token]))
+            else:
+                filter_ = self.create('SimpleFilterPart')
+                filter_.Value = token
+                filter_.SimpleOperator = 'equals'
+                filter_.Property = field
+                req = self._retrieve_request(data_id, fields, filter_)
+                obj = self.client.service.Retrieve(req)
             assert_status(obj)
             assert_result(obj)
         except WebFault, e:
@@ -331,6 +1009,67 @@ class ExactTargetDataExt(ExactTargetObject):
         return dict((p.Name, p.Value)
                     for p in obj.Results[0].Properties.Property)
 
+    def get_record_async(self, data_id, token, fields, field='TOKEN'):
+        """
+        Start get_record in the lookup thread pool, so several lookups
+        can wait for ET at the same time.
+
+        :returns: A PendingCall for the record
+        """
+        return PendingCall(lookup_pool().apply_async(
+            _get_record_in_thread,
+            (self.user, self.pass_, (data_id, token, fields, field))))
+
+    @logged_in
+    def get_records(self, data_id, keys, fields, field='TOKEN'):
+        """
+        Look up many rows of data extension ``data_id`` at once.
+
+        Keys are sent ``ET_FILTER_BATCH_SIZE`` at a time in an ``IN``
+        filter on ``field``, and each Retrieve is followed through
+        ``ContinueRequest`` while ET says more data is available.
+
+        :param str data_id: CustomerKey of the data extension
+        :param list keys: Values of ``field`` to look for
+        :param list fields: Names of the columns to return
+        :param str field: Column to match ``keys`` against
+        :returns: A dict mapping each key that was found to a dict of
+            its row, like the ones get_record returns. Keys that ET
+            doesn't know are left out.
+        """
+        if field not in fields:
+            fields = list(fields) + [field]
+        keys = list(keys)
+
+        records = {}
+        for start in range(0, len(keys), ET_FILTER_BATCH_SIZE):
+            batch = keys[start:start + ET_FILTER_BATCH_SIZE]
+            filter_ = self.create('SimpleFilterPart')
+            filter_.Value = batch
+            filter_.SimpleOperator = 'IN' if len(batch) > 1 else 'equals'
+            filter_.Property = field
+            req = self._retrieve_request(data_id, fields, filter_)
+
+            while True:
+                try:
+                    obj = self.client.service.Retrieve(req)
+                    if obj.OverallStatus != 'MoreDataAvailable':
+                        assert_status(obj)
+                except WebFault, e:
+                    handle_fault(e)
+
+                for result in getattr(obj, 'Results', None) or []:
+                    record = dict((p.Name, p.Value)
+                                  for p in result.Properties.Property)
+                    # Like get_record, keep the first of any duplicates.
+                    records.setdefault(record[field], record)
+
+                if obj.OverallStatus != 'MoreDataAvailable':
+                    break
+                req.ContinueRequest = obj.RequestID
+
+        return records
+
     @logged_in
     def delete_record(self, data_id, token):
         """
@@ -369,16 +1108,13 @@ class ExactTargetDataExt(ExactTargetObject):
 
 class ExactTarget(ExactTargetObject):
 
-    @logged_in
     def list(self):
         return ExactTargetList(self.user, self.pass_, self.client)
 
-    @logged_in
     def data_ext(self):
         return ExactTargetDataExt(self.user, self.pass_, self.client)
 
-    @logged_in
-    def trigger_send(self, send_name, fields):
+    def _triggered_send(self, send_name):
         send = self.create('TriggeredSend')
         defn = send.TriggeredSendDefinition
 
@@ -386,7 +1122,9 @@ class ExactTarget(ExactTargetObject):
         defn.Name = send_name
         defn.CustomerKey = send_name
         defn.TriggeredSendStatus = status.Active
+        return send
 
+    def _subscriber(self, fields):
         sub = self.create('Subscriber')
         sub.EmailAddress = fields.pop('EMAIL_ADDRESS_')
         sub.SubscriberKey = fields['TOKEN']
@@ -400,19 +1138,106 @@ class ExactTarget(ExactTargetObject):
             attr.Name = k
             attr.Value = v
             sub.Attributes.append(attr)
+        return sub
 
-        send.Subscribers = [sub]
+    @logged_in
+    def trigger_send(self, send_name, fields):
+        try:
+            if self.fast_soap:
+                email = fields.pop('EMAIL_ADDRESS_')
+                obj = self.fast_call('Create', soapcodec.create_triggered_send(
+                    send_name, [soapcodec.subscriber(email, fields)]))
+            else:
+                send = self._triggered_send(send_name)
+                send.Subscribers = [self._subscriber(fields)]
+
+                self.create('RequestType')
+                opts = self.create('CreateOptions')
+                obj = self.client.service.Create(opts, [send])
+            assert_status(obj)
+            assert_result(obj)
+        except WebFault, e:
+            handle_fault(e)
+
+    @logged_in
+    def trigger_sends(self, sends):
+        """
+        Trigger many sends in a single Create call.
+
+        Sends are grouped by their TriggeredSendDefinition, so each
+        definition gets one TriggeredSend listing all its subscribers.
+
+        :param list sends: (send_name, fields) pairs, with ``fields`` as
+            passed to trigger_send.
+        :returns: A list with one entry per send: None if ET accepted it,
+            otherwise ET's error message for it. A bad subscriber only
+            fails its own send. Sends ET returned no result for count as
+            failed, as there's no telling whether they went out.
+        :raises: NewsletterException if the call fails as a whole.
+        """
+        # send_name -> positions in ``sends``, in order of first use
+        positions = {}
+        send_names = []
+        for i, (send_name, fields) in enumerate(sends):
+            if send_name not in positions:
+                positions[send_name] = []
+                send_names.append(send_name)
+            positions[send_name].append(i)
+
+        objs = []
+        for send_name in send_names:
+            send = self._triggered_send(send_name)
+            send.Subscribers = [self._subscriber(dict(sends[i][1]))
+                                for i in positions[send_name]]
+            objs.append(send)
 
         self.create('RequestType')
         opts = self.create('CreateOptions')
 
         try:
-            obj = self.client.service.Create(opts, [send])
-            assert_status(obj)
-            assert_result(obj)
+            obj = self.client.service.Create(opts, objs)
         except WebFault, e:
             handle_fault(e)
 
+        errors = [None] * len(sends)
+        for send_name, res in zip(send_names, map_results(obj, len(objs))):
+            send_positions = positions[send_name]
+            if res is None:
+                for i in send_positions:
+                    errors[i] = 'No result returned for this send'
+                continue
+            error = result_error(res)
+            failures = getattr(res, 'SubscriberFailures', None) or []
+            if not failures:
+                if error:
+                    for i in send_positions:
+                        errors[i] = error
+                continue
+            # ET says exactly which subscribers failed; the others of
+            # this send went out and must not be reported as failed.
+            for failure in failures:
+                i = self._failed_position(failure, sends, send_positions)
+                if i is not None:
+                    errors[i] = (getattr(failure, 'ErrorDescription', None)
+                                 or getattr(failure, 'ErrorCode', None)
+                                 or error)
+        return errors
+
+    def _failed_position(self, failure, sends, send_positions):
+        """Find which of ``sends`` a SubscriberFailure is about"""
+        try:
+            ordinal = int(getattr(failure, 'Ordinal', None))
+            if 0 <= ordinal < len(send_positions):
+                return send_positions[ordinal]
+        except (TypeError, ValueError):
+            pass
+        key = getattr(getattr(failure, 'Subscriber', None),
+                      'SubscriberKey', None)
+        for i in send_positions:
+            if sends[i][1]['TOKEN'] == key:
+                return i
+        return None
+
     @logged_in
     def trigger_send_sms(self, send_name, mobile_number):
         send = self.create('SMSTriggeredSend')
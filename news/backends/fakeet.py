@@ -0,0 +1,315 @@
+"""
+A stand-in for ExactTarget's SOAP service, for load tests and
+benchmarks that mustn't touch the real ET account.
+
+It answers Retrieve, Update, Create and Delete calls on data extensions
+kept in memory, and records triggered sends instead of sending them.
+Latency, errors and throttling can be dialed in to see how basket copes
+with a slow or failing ET.
+
+Run it with ``./manage.py run_fake_et`` and set ``EXACTTARGET_ENDPOINT``
+to the URL it prints, or start one in a test::
+
+    server = FakeExactTarget(latency=0.05).start()
+    ...
+    server.stop()
+"""
+
+import random
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from uuid import uuid4
+from xml.etree.cElementTree import fromstring
+
+from .soapcodec import text
+
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+    '<soap:Body>%s</soap:Body></soap:Envelope>'
+)
+FAULT = ('<soap:Fault><faultcode>soap:%s</faultcode>'
+         '<faultstring>%s</faultstring></soap:Fault>')
+RESPONSE = ('<%(name)s xmlns="http://exacttarget.com/wsdl/partnerAPI">'
+            '%(results)s<RequestID>%(request_id)s</RequestID>'
+            '<OverallStatus>%(status)s</OverallStatus></%(name)s>')
+RESULT = ('<Results%(type)s><StatusCode>%(code)s</StatusCode>'
+          '<StatusMessage>%(message)s</StatusMessage>'
+          '<OrdinalID>%(ordinal)d</OrdinalID>%(extra)s</Results>')
+RETRIEVE_RESULT = ('<Results xsi:type="DataExtensionObject">'
+                   '<PartnerKey xsi:nil="true"/><ObjectID xsi:nil="true"/>'
+                   '<Type>DataExtensionObject</Type>'
+                   '<Properties>%s</Properties></Results>')
+PROPERTY = '<Property><Name>%s</Name>%s</Property>'
+
+
+class Fault(Exception):
+    """Answer the call with a SOAP fault"""
+    def __init__(self, message, code='Server'):
+        super(Fault, self).__init__(message)
+        self.code = code
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def children(elem, name):
+    return [child for child in elem if local_name(child.tag) == name]
+
+
+def child_text(elem, name, default=None):
+    for child in children(elem, name):
+        return child.text
+    return default
+
+
+def value(value):
+    if value is None:
+        return '<Value/>'
+    return '<Value>%s</Value>' % text(value)
+
+
+def properties(elem):
+    """The (name, value) pairs of an element's Properties or Attributes"""
+    pairs = []
+    for props in children(elem, 'Properties'):
+        for prop in children(props, 'Property'):
+            pairs.append((child_text(prop, 'Name'),
+                          child_text(prop, 'Value')))
+    for attr in children(elem, 'Attributes'):
+        pairs.append((child_text(attr, 'Name'), child_text(attr, 'Value')))
+    return pairs
+
+
+class FakeETHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['Content-Length']))
+        action = self.headers.get('SOAPAction', '').strip('"')
+        status, body = self.server.call(action, request)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, *args)
+
+
+class FakeExactTarget(ThreadingMixIn, HTTPServer):
+    """
+    A fake ET SOAP service.
+
+    :param address: (host, port) to listen on; port 0 picks a free one
+    :param float latency: Seconds every call takes, at least
+    :param float jitter: Up to this many more seconds, at random
+    :param float error_rate: Fraction of calls answered with a fault
+    :param int max_concurrent: Calls handled at once; more are refused
+        with a fault, the way ET throttles
+    :param int page_size: Rows per Retrieve reply before the rest has
+        to be asked for with ContinueRequest
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 error_rate=0, max_concurrent=None, page_size=2500,
+                 verbose=False):
+        HTTPServer.__init__(self, address, FakeETHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.max_concurrent = max_concurrent
+        self.page_size = page_size
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.active = 0
+        # data extension name -> {key: row dict}
+        self.tables = {}
+        # Triggered sends: dicts of definition, email, key and attributes
+        self.sends = []
+        # RequestID -> rows still to be returned for a Retrieve
+        self.pending_rows = {}
+        # action -> number of calls
+        self.calls = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return 'http://%s:%d/Service.asmx' % (host, port)
+
+    def start(self):
+        """Serve in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_rows(self, table, rows):
+        """Put rows (dicts) into a data extension"""
+        with self.lock:
+            for row in rows:
+                self.upsert(table, row.items())
+
+    def rows(self, table):
+        with self.lock:
+            return self.tables.get(table, {}).values()
+
+    def call(self, action, request):
+        """Handle a SOAP call; returns (HTTP status, reply)"""
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = (self.max_concurrent is not None and
+                         self.active >= self.max_concurrent)
+            if not throttled:
+                self.active += 1
+        if throttled:
+            return 500, ENVELOPE % (FAULT % ('Server', 'Throttled: too many '
+                                             'concurrent requests'))
+        try:
+            time.sleep(self.latency + random.random() * self.jitter)
+            if random.random() < self.error_rate:
+                raise Fault('Server was unable to process request.')
+            handler = getattr(self, 'soap_%s' % action, None)
+            if handler is None:
+                raise Fault('Unsupported action %r' % action, 'Client')
+            body = children(fromstring(request), 'Body')[0][0]
+            with self.lock:
+                return 200, ENVELOPE % handler(body)
+        except Fault, e:
+            return 500, ENVELOPE % (FAULT % (e.code, text(e.message)))
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def response(self, name, results, status='OK'):
+        return RESPONSE % {'name': name, 'results': ''.join(results),
+                           'request_id': uuid4(), 'status': status}
+
+    def result(self, ordinal, ok=True, message='', type_='', extra=''):
+        return RESULT % {'type': type_ and ' xsi:type="%s"' % type_,
+                         'code': 'OK' if ok else 'Error',
+                         'message': text(message), 'ordinal': ordinal,
+                         'extra': extra}
+
+    def upsert(self, table, pairs):
+        """Add or update a row; rows are keyed by their token"""
+        row = dict(pairs)
+        key = row.get('TOKEN', row.get('Token'))
+        if key is None:
+            key = pairs[0][1]
+        self.tables.setdefault(table, {}).setdefault(key, {}).update(row)
+
+    def soap_Update(self, body):
+        results = []
+        for i, obj in enumerate(children(body, 'Objects')):
+            self.upsert(child_text(obj, 'CustomerKey'), properties(obj))
+            results.append(self.result(i, message='Updated '
+                                       'DataExtensionObject'))
+        return self.response('UpdateResponse', results)
+
+    def soap_Create(self, body):
+        results = []
+        for i, obj in enumerate(children(body, 'Objects')):
+            type_ = local_name(obj.get(
+                '{http://www.w3.org/2001/XMLSchema-instance}type', ''))
+            if type_.endswith('TriggeredSend'):
+                definition = children(obj, 'TriggeredSendDefinition')[0]
+                for sub in children(obj, 'Subscribers'):
+                    self.sends.append({
+                        'definition': child_text(definition, 'CustomerKey'),
+                        'email': child_text(sub, 'EmailAddress'),
+                        'key': child_text(sub, 'SubscriberKey'),
+                        'attributes': dict(properties(sub)),
+                    })
+                results.append(self.result(
+                    i, message='Created TriggeredSend',
+                    type_='TriggeredSendCreateResult',
+                    extra='<NewID>0</NewID>'))
+            elif type_.endswith('DataExtensionObject'):
+                self.upsert(child_text(obj, 'CustomerKey'), properties(obj))
+                results.append(self.result(
+                    i, message='Created DataExtensionObject'))
+            else:
+                results.append(self.result(
+                    i, ok=False, message='Unsupported object %s' % type_))
+        return self.response('CreateResponse', results)
+
+    def soap_Delete(self, body):
+        results = []
+        for i, obj in enumerate(children(body, 'Objects')):
+            table = self.tables.get(child_text(obj, 'CustomerKey'), {})
+            keys = [(child_text(key, 'Name'), child_text(key, 'Value'))
+                    for keys in children(obj, 'Keys')
+                    for key in children(keys, 'Key')]
+            for row_key, row in table.items():
+                if all(row.get(name) == val for name, val in keys):
+                    del table[row_key]
+            results.append(self.result(i, message='Deleted '
+                                       'DataExtensionObject'))
+        return self.response('DeleteResponse', results)
+
+    def soap_Retrieve(self, body):
+        req = children(body, 'RetrieveRequest')[0]
+        continue_id = child_text(req, 'ContinueRequest')
+        if continue_id:
+            rows = self.pending_rows.pop(continue_id, None)
+            if rows is None:
+                raise Fault('Unknown ContinueRequest', 'Client')
+        else:
+            rows = self.retrieve_rows(req)
+
+        page, rest = rows[:self.page_size], rows[self.page_size:]
+        results = [RETRIEVE_RESULT % ''.join(PROPERTY % (text(name),
+                                                         value(val))
+                                             for name, val in row)
+                   for row in page]
+        reply = self.response('RetrieveResponseMsg', results,
+                              'MoreDataAvailable' if rest else 'OK')
+        if rest:
+            request_id = reply.split('<RequestID>')[1].split('<')[0]
+            self.pending_rows[request_id] = rest
+        return reply
+
+    def retrieve_rows(self, req):
+        object_type = child_text(req, 'ObjectType')
+        if not object_type.startswith('DataExtensionObject['):
+            # Lists, subscribers and the like aren't kept.
+            return []
+        table = self.tables.get(object_type[len('DataExtensionObject['):-1],
+                                {})
+        fields = [p.text for p in children(req, 'Properties')]
+
+        filters = children(req, 'Filter')
+        if filters:
+            field = child_text(filters[0], 'Property')
+            operator = child_text(filters[0], 'SimpleOperator')
+            wanted = set(v.text for v in children(filters[0], 'Value'))
+            if operator not in ('equals', 'IN'):
+                raise Fault('Unsupported filter operator %r' % operator,
+                            'Client')
+            if field in ('TOKEN', 'Token'):
+                matches = [table[key] for key in wanted if key in table]
+            else:
+                matches = [row for row in table.values()
+                           if row.get(field) in wanted]
+        else:
+            matches = table.values()
+        return [[(name, row.get(name)) for name in fields]
+                for row in matches]
@@ -0,0 +1,208 @@
+"""
+A suds transport that keeps HTTP(S) connections to ExactTarget open
+between SOAP calls.
+
+suds' own transports go through urllib2, which opens a new connection,
+and so does a new TCP and TLS handshake, for every request. For small
+calls like a single Retrieve that handshake is most of the latency.
+"""
+
+import httplib
+import os
+import socket
+import threading
+import time
+from StringIO import StringIO
+from urllib2 import URLError
+from urlparse import urlparse
+
+from django.conf import settings
+from django_statsd.clients import statsd
+
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
+
+
+# How many idle connections to keep per host. 0 disables pooling.
+POOL_SIZE = getattr(settings, 'EXACTTARGET_POOL_SIZE', 10)
+# Seconds an idle connection is kept before we stop trusting it. ET
+# closes idle connections on its side after a while.
+POOL_MAX_IDLE = getattr(settings, 'EXACTTARGET_POOL_MAX_IDLE', 60)
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of persistent connections to one host.
+
+    Connections are handed out most recently used first. When none is
+    idle a new one is made, so callers never wait for each other; at
+    most ``size`` connections are kept once they're checked back in.
+    """
+    def __init__(self, scheme, host, port, size, max_idle, timeout):
+        self.connection_class = (httplib.HTTPSConnection if scheme == 'https'
+                                 else httplib.HTTPConnection)
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        # (time checked in, connection), most recently used last
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return self.connection_class(self.host, self.port,
+                                     timeout=self.timeout)
+
+    def checkout(self):
+        """Return (connection, True if it was reused from the pool)"""
+        expired = []
+        conn = None
+        with self.lock:
+            now = time.time()
+            while self.idle:
+                last_used, candidate = self.idle.pop()
+                if now - last_used < self.max_idle:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+            # Anything left below an expired connection is older still.
+            if conn is None:
+                expired.extend(c for t, c in self.idle)
+                self.idle = []
+        for old in expired:
+            old.close()
+
+        if conn is not None:
+            statsd.incr('news.et.pool.hit')
+            return conn, True
+        statsd.incr('news.et.pool.miss')
+        return self.connect(), False
+
+    def checkin(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((time.time(), conn))
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for last_used, conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, host, port, timeout):
+    """Return the process-wide connection pool for a host."""
+    global _pools, _pools_pid
+    key = (scheme, host, port)
+    with _pools_lock:
+        # A forked worker must not share its parent's sockets; it starts
+        # with pools of its own.
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        if key not in _pools:
+            _pools[key] = ConnectionPool(scheme, host, port, POOL_SIZE,
+                                         POOL_MAX_IDLE, timeout)
+        return _pools[key]
+
+
+def clear_pools():
+    """Close all idle pooled connections, e.g. between tests."""
+    with _pools_lock:
+        pools = _pools.values()
+    for pool in pools:
+        pool.clear()
+
+
+def is_stale(error):
+    """
+    Return True if ``error``, raised while sending a request over a
+    reused connection, means the server had already closed it, so the
+    request can't have been processed and is safe to send again on a
+    new connection.
+    """
+    if isinstance(error, socket.timeout):
+        # The server may well be working on it.
+        return False
+    return isinstance(error, (httplib.HTTPException, socket.error))
+
+
+def is_closed_before_response(error):
+    """
+    Return True if ``error``, raised while waiting for the response to
+    a request sent over a reused connection, means the server closed the
+    connection without reading it: it sent not a single byte back.
+
+    Anything else may have come after the server acted on the request,
+    so it must not be sent again.
+    """
+    if not isinstance(error, httplib.BadStatusLine):
+        return False
+    # How httplib describes an empty status line depends on its version.
+    return (error.line in ('', "''") or
+            error.line.startswith('No status line received'))
+
+
+class PooledHttpTransport(HttpTransport):
+    """
+    suds transport that sends SOAP requests over pooled persistent
+    connections.
+
+    Documents (the WSDL and the schemas it imports) are still opened
+    with urllib2, as they're only read once.
+
+    The pools are shared by every transport in the process, so clients
+    cloned from each other share connections too.
+    """
+    def send(self, request):
+        url = urlparse(request.url)
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        pool = get_pool(url.scheme, url.hostname, url.port,
+                        self.options.timeout)
+
+        conn, reused = pool.checkout()
+        try:
+            sent = False
+            try:
+                conn.request('POST', path, request.message, request.headers)
+                sent = True
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if sent:
+                    safe = is_closed_before_response(e)
+                else:
+                    safe = is_stale(e)
+                if not (reused and safe):
+                    raise
+                statsd.incr('news.et.pool.stale')
+                conn = pool.connect()
+                conn.request('POST', path, request.message, request.headers)
+                response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            # Callers expect the errors urllib2 would raise.
+            raise URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            pool.checkin(conn)
+
+        if response.status >= 300:
+            raise TransportError(response.reason, response.status,
+                                 StringIO(body))
+        # Like urllib2, and so suds' own transport, take any 2xx as a
+        # reply, an empty one for 202 and 204.
+        return Reply(200, dict(response.getheaders()), body)
@@ -0,0 +1,69 @@
+import cPickle as pickle
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from news.models import Newsletter
+from news.newsletters import build_newsletters_data
+
+
+class Command(BaseCommand):
+    help = ("Compare the cached newsletter data as Newsletter model "
+            "objects with the compact form basket caches: its pickled "
+            "size, the CPU time to unpickle it and to look up a "
+            "newsletter's vendor ID in it. Nothing is saved.")
+    option_list = BaseCommand.option_list + (
+        make_option('--newsletters', type='int', default=50,
+                    help='Number of made up newsletters. Default: 50'),
+        make_option('--calls', type='int', default=1000,
+                    help='Number of times to time each operation. '
+                         'Default: 1000'),
+    )
+
+    def handle(self, *args, **options):
+        newsletters = [
+            Newsletter(slug='newsletter-%d' % i,
+                       title='Newsletter %d' % i,
+                       vendor_id='NEWSLETTER_%d' % i,
+                       languages='de,en,es,fr,id,pt-BR,ru',
+                       welcome='WELCOME_%d' % i,
+                       requires_double_optin=bool(i % 2))
+            for i in range(options['newsletters'])]
+        models = {
+            'by_name': dict((nl.slug, nl) for nl in newsletters),
+            'by_vendor_id': dict((nl.vendor_id, nl) for nl in newsletters),
+        }
+        compact = build_newsletters_data(newsletters)
+        slug = newsletters[-1].slug
+        calls = options['calls']
+
+        self.stdout.write("%-16s %12s %12s\n" % ('', 'models', 'compact'))
+        sizes = [len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+                 for data in (models, compact)]
+        self.stdout.write("%-16s %11dB %11dB\n" % ('pickled size',
+                                                   sizes[0], sizes[1]))
+        timings = [self.timed(self.unpickler(data), calls)
+                   for data in (models, compact)]
+        self.stdout.write("%-16s %10.0fus %10.0fus\n"
+                          % ('unpickle', timings[0] * 1e6,
+                             timings[1] * 1e6))
+        timings = [
+            self.timed(lambda: models['by_name'][slug].vendor_id, calls),
+            self.timed(lambda: compact['vendor_ids'][slug], calls),
+        ]
+        self.stdout.write("%-16s %10.2fus %10.2fus\n"
+                          % ('vendor ID lookup', timings[0] * 1e6,
+                             timings[1] * 1e6))
+
+    def unpickler(self, data):
+        pickled = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        return lambda: pickle.loads(pickled)
+
+    def timed(self, operation, calls):
+        # Warm up caches before timing
+        operation()
+        start = time.clock()
+        for i in range(calls):
+            operation()
+        return (time.clock() - start) / calls
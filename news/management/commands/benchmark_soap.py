@@ -0,0 +1,115 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from suds.transport import Reply, Transport
+
+from news.backends.exacttarget import (ExactTarget, ExactTargetDataExt,
+                                       make_client)
+
+
+ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+    '<soap:Body>%s</soap:Body></soap:Envelope>'
+)
+
+# Replies shaped like the ones ET sends for our calls
+REPLIES = {
+    'Update': ENVELOPE % (
+        '<UpdateResponse xmlns="http://exacttarget.com/wsdl/partnerAPI">'
+        '<Results><StatusCode>OK</StatusCode>'
+        '<StatusMessage>Updated DataExtensionObject</StatusMessage>'
+        '<OrdinalID>0</OrdinalID>'
+        '<Object xsi:type="DataExtensionObject"><PartnerKey xsi:nil="true"/>'
+        '<ObjectID xsi:nil="true"/><CustomerKey>Master_Subscribers'
+        '</CustomerKey></Object></Results>'
+        '<RequestID>60fb4c2a</RequestID><OverallStatus>OK</OverallStatus>'
+        '</UpdateResponse>'),
+    'Retrieve': ENVELOPE % (
+        '<RetrieveResponseMsg xmlns="http://exacttarget.com/wsdl/partnerAPI">'
+        '<OverallStatus>OK</OverallStatus><RequestID>2b1e7a0c</RequestID>'
+        '<Results xsi:type="DataExtensionObject">'
+        '<PartnerKey xsi:nil="true"/><ObjectID xsi:nil="true"/>'
+        '<Type>DataExtensionObject</Type><Properties>%s</Properties>'
+        '</Results></RetrieveResponseMsg>' % ''.join(
+            '<Property><Name>%s</Name><Value>%s</Value></Property>' % prop
+            for prop in [('TOKEN', 'c2b4e1f6-5d4a-4b7e-9a43-1f0e5b2b7c3d'),
+                         ('EMAIL_ADDRESS_', 'someone@example.com'),
+                         ('EMAIL_FORMAT_', 'H'),
+                         ('COUNTRY_', 'us'),
+                         ('LANGUAGE_ISO2', 'en'),
+                         ('FIREFOX_AND_YOU_FLG', 'Y'),
+                         ('FIREFOX_AND_YOU_DATE', '2014-01-01')])),
+    'Create': ENVELOPE % (
+        '<CreateResponse xmlns="http://exacttarget.com/wsdl/partnerAPI">'
+        '<Results xsi:type="TriggeredSendCreateResult">'
+        '<StatusCode>OK</StatusCode>'
+        '<StatusMessage>Created TriggeredSend</StatusMessage>'
+        '<OrdinalID>0</OrdinalID><NewID>0</NewID></Results>'
+        '<RequestID>9d2c58e1</RequestID><OverallStatus>OK</OverallStatus>'
+        '</CreateResponse>'),
+}
+
+
+class CannedTransport(Transport):
+    """Answers every call with the canned reply for its SOAP action"""
+    def send(self, request):
+        action = request.headers['SOAPAction'].strip('"')
+        return Reply(200, {}, REPLIES[action])
+
+
+class Command(BaseCommand):
+    help = ("Measure the CPU time per ExactTarget call spent building "
+            "requests and parsing replies, with suds and with the fast "
+            "SOAP codec. Nothing is sent to ExactTarget.")
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', type='int', default=1000,
+                    help='Number of calls to time for each operation and '
+                         'path. Default: 1000'),
+    )
+
+    def handle(self, *args, **options):
+        user, pass_ = settings.EXACTTARGET_USER, settings.EXACTTARGET_PASS
+        client = make_client(user, pass_)
+        client.set_options(transport=CannedTransport())
+        data_ext = ExactTargetDataExt(user, pass_, client)
+        et = ExactTarget(user, pass_, client)
+
+        fields = ['TOKEN', 'EMAIL_ADDRESS_', 'EMAIL_FORMAT_', 'COUNTRY_',
+                  'LANGUAGE_ISO2', 'FIREFOX_AND_YOU_FLG',
+                  'FIREFOX_AND_YOU_DATE']
+        values = ['c2b4e1f6-5d4a-4b7e-9a43-1f0e5b2b7c3d',
+                  'someone@example.com', 'H', 'us', 'en', 'Y', '2014-01-01']
+        operations = [
+            ('add_record', lambda: data_ext.add_record(
+                'Master_Subscribers', fields, values)),
+            ('get_record', lambda: data_ext.get_record(
+                'Master_Subscribers', values[0], fields)),
+            ('trigger_send', lambda: et.trigger_send('WELCOME', {
+                'EMAIL_ADDRESS_': values[1],
+                'TOKEN': values[0],
+                'EMAIL_FORMAT_': 'H',
+            })),
+        ]
+
+        self.stdout.write("%-14s %12s %12s\n" % ('CPU per call', 'suds',
+                                                 'fast'))
+        for name, operation in operations:
+            timings = []
+            for fast in (False, True):
+                data_ext.fast_soap = et.fast_soap = fast
+                timings.append(self.timed(operation, options['calls']))
+            self.stdout.write("%-14s %10.0fus %10.0fus\n"
+                              % (name, timings[0] * 1e6, timings[1] * 1e6))
+
+    def timed(self, operation, calls):
+        # Warm up caches before timing
+        operation()
+        start = time.clock()
+        for i in range(calls):
+            operation()
+        return (time.clock() - start) / calls
@@ -0,0 +1,57 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from suds.cache import NoCache
+
+from news.backends.exacttarget import (WSDLSnapshotCache, make_client,
+                                       wsdl_path)
+
+
+class Command(BaseCommand):
+    help = ("Parse the ExactTarget WSDL once and save a snapshot of it "
+            "that web and worker processes load at startup.")
+    option_list = BaseCommand.option_list + (
+        make_option('--benchmark', action='store_true', default=False,
+                    help='Also time building a client with and without '
+                         'the snapshot.'),
+        make_option('--runs', type='int', default=5,
+                    help='Number of clients to build for each timing. '
+                         'Default: 5'),
+    )
+
+    def handle(self, *args, **options):
+        wsdl_file = wsdl_path()
+        snapshot = WSDLSnapshotCache(wsdl_file, writable=True)
+        snapshot.purge(None)
+        # Building a client with a writable snapshot cache makes suds
+        # parse the WSDL and put the result into the snapshot.
+        make_client(settings.EXACTTARGET_USER, settings.EXACTTARGET_PASS,
+                    cache=snapshot)
+        if not snapshot.is_valid():
+            raise Exception("Failed to write WSDL snapshot %s"
+                            % snapshot.snapshot_file)
+        self.stdout.write("Wrote %s\n" % snapshot.snapshot_file)
+
+        if options['benchmark']:
+            self.benchmark(wsdl_file, options['runs'])
+
+    def benchmark(self, wsdl_file, runs):
+        def timed(cache):
+            start = time.time()
+            for i in range(runs):
+                make_client(settings.EXACTTARGET_USER,
+                            settings.EXACTTARGET_PASS,
+                            cache=cache)
+            return (time.time() - start) / runs
+
+        # NoCache means every client parses the WSDL and downloads its
+        # imports, which is what a fresh process without a snapshot does.
+        parsed = timed(NoCache())
+        loaded = timed(WSDLSnapshotCache(wsdl_file))
+        self.stdout.write("Cold client build without snapshot: %.3fs\n"
+                          % parsed)
+        self.stdout.write("Cold client build with snapshot:    %.3fs\n"
+                          % loaded)
@@ -0,0 +1,78 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import now
+
+from news import writebuffer
+from news.backends.exacttarget import ET_FILTER_BATCH_SIZE
+from news.models import Subscriber
+from news.views import fetch_users_data
+
+
+# Where fetch_users_data looks users up
+DATA_IDS = (settings.EXACTTARGET_DATA, settings.EXACTTARGET_OPTIN_STAGE,
+            settings.EXACTTARGET_CONFIRMATION)
+
+
+class Command(BaseCommand):
+    help = ("Sync the mirror of subscribers' ExactTarget data kept with "
+            "USER_DATA_MIRROR for subscribers not synced lately. Meant to "
+            "be run periodically, e.g. from cron.")
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', type='int', default=None,
+                    help='Sync subscribers not synced in this many seconds. '
+                         'Default: half of USER_DATA_MIRROR_MAX_AGE'),
+        make_option('--limit', type='int', default=None,
+                    help='Most subscribers to sync. Default: all of them'),
+        make_option('--batch-size', type='int', default=ET_FILTER_BATCH_SIZE,
+                    help='Subscribers to look up in ExactTarget at once. '
+                         'Default: %d' % ET_FILTER_BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        if not settings.USER_DATA_MIRROR:
+            self.stdout.write("USER_DATA_MIRROR is off, nothing to sync\n")
+            return
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = settings.USER_DATA_MIRROR_MAX_AGE / 2
+        cutoff = now() - timedelta(seconds=older_than)
+        tokens = Subscriber.objects\
+            .filter(Q(et_synced__isnull=True) | Q(et_synced__lt=cutoff))\
+            .order_by('et_synced')\
+            .values_list('token', flat=True)
+        if options['limit']:
+            tokens = tokens[:options['limit']]
+        tokens = list(tokens)
+
+        found = 0
+        batch_size = options['batch_size']
+        for start in range(0, len(tokens), batch_size):
+            batch = tokens[start:start + batch_size]
+            # To the second, as MySQL keeps et_synced
+            fetched_at = now().replace(microsecond=0)
+            users = fetch_users_data(batch)
+            # ET doesn't have their latest writes yet; they're synced
+            # once it has.
+            pending = writebuffer.pending_tokens(DATA_IDS, batch)
+            for token, user_data in users.items():
+                if token not in pending:
+                    # Unless a write-through came in since
+                    Subscriber.objects.mirror(user_data,
+                                              fetched_at=fetched_at)
+            # Don't ask again about users ET doesn't know until they're
+            # due again, but don't answer from the mirror for them.
+            unknown = [t for t in batch if t not in users and
+                       t not in pending]
+            Subscriber.objects\
+                .filter(token__in=unknown)\
+                .filter(Q(et_synced__isnull=True) |
+                        Q(et_synced__lt=fetched_at))\
+                .update(et_data=None, et_synced=now())
+            found += len(users)
+
+        self.stdout.write("Synced %d subscribers, %d of them found in "
+                          "ExactTarget\n" % (len(tokens), found))
@@ -0,0 +1,73 @@
+from optparse import make_option
+from uuid import UUID
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from news.backends.fakeet import FakeExactTarget
+
+
+class Command(BaseCommand):
+    help = ("Run a fake ExactTarget SOAP service for load tests and "
+            "benchmarks. Point basket at it by setting EXACTTARGET_ENDPOINT "
+            "to the URL it prints, with EXACTTARGET_FAST_SOAP = True or a "
+            "WSDL that suds can load.")
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default='127.0.0.1',
+                    help='Address to listen on. Default: 127.0.0.1'),
+        make_option('--port', type='int', default=8099,
+                    help='Port to listen on. Default: 8099'),
+        make_option('--latency', type='float', default=0,
+                    help='Seconds each call takes. Default: 0'),
+        make_option('--jitter', type='float', default=0,
+                    help='Up to this many more seconds per call, at '
+                         'random. Default: 0'),
+        make_option('--error-rate', type='float', default=0,
+                    help='Fraction of calls answered with a fault. '
+                         'Default: 0'),
+        make_option('--max-concurrent', type='int', default=None,
+                    help='Calls handled at once before more are refused. '
+                         'Default: no limit'),
+        make_option('--page-size', type='int', default=2500,
+                    help='Rows per Retrieve reply. Default: 2500'),
+        make_option('--users', type='int', default=0,
+                    help='Number of users to put in the main data '
+                         'extension at start. Their tokens are '
+                         '00000000-0000-0000-0000-000000000001 and up, '
+                         'their emails user1@example.com and up.'),
+        make_option('--verbose', action='store_true', default=False,
+                    help='Log every call.'),
+    )
+
+    def handle(self, *args, **options):
+        server = FakeExactTarget(
+            (options['host'], options['port']),
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            max_concurrent=options['max_concurrent'],
+            page_size=options['page_size'],
+            verbose=options['verbose'],
+        )
+        if options['users']:
+            server.add_rows(settings.EXACTTARGET_DATA, [
+                self.user(i) for i in range(1, options['users'] + 1)])
+
+        self.stdout.write("Fake ExactTarget at %s with %d users\n"
+                          % (server.url, options['users']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def user(self, i):
+        return {
+            'TOKEN': str(UUID(int=i)),
+            'EMAIL_ADDRESS_': 'user%d@example.com' % i,
+            'EMAIL_FORMAT_': 'H',
+            'COUNTRY_': 'us',
+            'LANGUAGE_ISO2': 'en',
+            'CREATED_DATE_': '2014-01-01',
+        }
@@ -1,3 +1,4 @@
+from datetime import timedelta
 from uuid import uuid4
 
 from celery.task import subtask
@@ -6,10 +7,13 @@ from jsonfield import JSONField
 
 from django.conf import settings
 from django.db import models
-from django.db.models.signals import post_delete
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.timezone import now
 
+from news.usercache import forget_unknown_user
+
 
 class SubscriberManager(models.Manager):
     def get_and_sync(self, email, token, fxa_id=None):
@@ -32,6 +36,56 @@ class SubscriberManager(models.Manager):
 
         return sub
 
+    def get_mirrored(self, token=None, email=None):
+        """
+        Return the user data mirrored from ET for the subscriber with
+        this email if given, otherwise this token, as get_user_data()
+        would. Returns None if we don't have it or it was last synced
+        with ET more than USER_DATA_MIRROR_MAX_AGE seconds ago.
+        """
+        synced_since = now() - timedelta(
+            seconds=settings.USER_DATA_MIRROR_MAX_AGE)
+        subs = self.filter(et_synced__gte=synced_since)
+        if email:
+            subs = subs.filter(email=email)
+        else:
+            subs = subs.filter(token=token)
+        for sub in subs[:1]:
+            # The mirror is by token; ET might have another email for it.
+            if sub.et_data and (not email or sub.et_data['email'] == email):
+                return dict(sub.et_data, status='ok')
+        return None
+
+    def mirror(self, user_data, fetched_at=None, synced=True):
+        """
+        Store user data that matches what ET has now, as get_user_data()
+        returns it, as the mirror of the subscribers with its token, which
+        is what ET keys its records by.
+
+        With ``fetched_at``, when the data was read from ET, subscribers
+        synced since are left alone, as what they have is newer. Unless
+        ``synced``, the data is stored without marking it as matching
+        ET, e.g. while the write it comes from is still on its way there.
+        """
+        data = dict((key, value) for key, value in user_data.items()
+                    if key not in ('status', 'status_code'))
+        subs = self.filter(token=user_data['token'])
+        if fetched_at is not None:
+            subs = subs.filter(Q(et_synced__isnull=True) |
+                               Q(et_synced__lt=fetched_at))
+        if synced:
+            subs.update(et_data=data, et_synced=now())
+        else:
+            subs.update(et_data=data)
+
+    def update_mirror(self, token, **changes):
+        """Change the mirrored user data of subscribers with this token,
+        if they have any"""
+        for sub in self.filter(token=token, et_synced__isnull=False):
+            if sub.et_data:
+                sub.et_data.update(changes)
+                sub.save()
+
 
 class Subscriber(models.Model):
     email = models.EmailField(primary_key=True)
@@ -39,10 +93,20 @@ class Subscriber(models.Model):
                              db_index=True)
     fxa_id = models.CharField(max_length=100, null=True, blank=True,
                               db_index=True)
+    # The user's data in ET as get_user_data() returns it, and when it
+    # was last known to match ET. Only kept with USER_DATA_MIRROR set.
+    et_data = JSONField(null=True, blank=True, default=None)
+    et_synced = models.DateTimeField(null=True, blank=True, db_index=True)
 
     objects = SubscriberManager()
 
 
+@receiver(post_save, sender=Subscriber)
+def post_subscriber_save(sender, instance, **kwargs):
+    # The token or email might have been remembered as unknown
+    forget_unknown_user(instance.token, instance.email)
+
+
 class Newsletter(models.Model):
     slug = models.SlugField(
         unique=True,
@@ -4,16 +4,51 @@ backend-specific data for working with them in the email provider.
 It's used to lookup the backend-specific newsletter name from a
 generic one passed by the user. This decouples the API from any
 specific email provider."""
+import hashlib
+import json
+import logging
+import time
+from collections import namedtuple
+
 from django.core.cache import cache
 
 from news.models import Newsletter
 
 
-__all__ = ('clear_newsletter_cache', 'newsletter_field', 'newsletter_name',
-           'newsletter_fields')
+log = logging.getLogger(__name__)
+
+
+__all__ = ('clear_newsletter_cache', 'message_router', 'mogrify_message_id',
+           'newsletter_field', 'newsletter_flags', 'newsletter_name',
+           'newsletter_fields', 'newsletters_etag',
+           'newsletters_exempt_from_confirmation', 'newsletters_generation',
+           'newsletters_json')
+
+
+# Base message ID for confirmation email
+CONFIRMATION_MESSAGE = "confirmation_email"
 
+# Vendor IDs for Firefox OS and Firefox & You:
+FFOS_VENDOR_ID = 'FIREFOX_OS'
+FFAY_VENDOR_ID = 'MOZILLA_AND_YOU'
 
 CACHE_KEY = "newsletters_cache_data"
+GENERATION_KEY = "newsletters_cache_generation"
+
+# (generation, data) of the newsletter data this process last used
+_memo = (None, None)
+
+
+def _generation():
+    """The current generation of the newsletter data.
+    clear_newsletter_cache() bumps it."""
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the time so that a generation evicted from the
+        # cache isn't reused for different data.
+        cache.add(GENERATION_KEY, int(time.time() * 1000))
+        generation = cache.get(GENERATION_KEY)
+    return generation
 
 
 def _newsletters():
@@ -21,53 +56,290 @@ def _newsletters():
     It's cached until clear_newsletter_cache() is called, so we're
     not constantly hitting the database for data that rarely changes.
 
+    Each process also keeps the data it last used, and only fetches it
+    from the cache again when the generation number in the cache has
+    changed, which is a much smaller fetch.
+
     The returned data structure looks like::
 
         {
             'by_name': {
-                'newsletter_name_1': a Newsletter object,
-                'newsletter_name_2': another Newsletter object,
+                'newsletter_name_1': a NewsletterInfo,
+                'newsletter_name_2': another NewsletterInfo,
             },
             'by_vendor_id': {
-                'NEWSLETTER_ID_1': a Newsletter object,
-                'NEWSLETTER_ID_2': another Newsletter object,
-            }
+                'NEWSLETTER_ID_1': a NewsletterInfo,
+                'NEWSLETTER_ID_2': another NewsletterInfo,
+            },
+            'vendor_ids': {'newsletter_name_1': 'NEWSLETTER_ID_1', ...},
+            'slugs': {'NEWSLETTER_ID_1': 'newsletter_name_1', ...},
+            'languages': frozenset of all their language codes,
+            'language_codes': frozenset of the same, as lowercase
+                two-letter codes,
+            'no_double_optin': frozenset of the names of the newsletters
+                that don't require double opt-in,
+            'flags': a NewsletterFlags for all of them,
+            'messages': a MessageRouter for all of them,
+            'json': the body of the newsletters API's response,
+            'etag': a strong ETag for that body,
         }
     """
-    data = cache.get(CACHE_KEY)
+    global _memo
+    generation = _generation()
+    if _memo[0] == generation:
+        return _memo[1]
+
+    key = '%s:%s' % (CACHE_KEY, generation)
+    data = cache.get(key)
     if data is None:
         data = _get_newsletters_data()
-        cache.set(CACHE_KEY, data)
+        cache.set(key, data)
 
+    _memo = (generation, data)
+    return data
+
+
+# What basket needs to know about a newsletter, without the weight of a
+# model instance in the cache.
+NewsletterInfo = namedtuple('NewsletterInfo', [
+    'slug',
+    'vendor_id',
+    'languages',  # tuple of language codes
+    'language_codes',  # frozenset of lowercase two-letter language codes
+    'welcome',
+    'confirm_message',
+    'requires_double_optin',
+])
+
+
+def _intern(value):
+    """Intern the string, so each distinct one is pickled and kept once"""
+    try:
+        return intern(value.encode('ascii'))
+    except UnicodeError:
+        return value
+
+
+def _newsletter_info(nl):
+    return NewsletterInfo(
+        slug=_intern(nl.slug),
+        vendor_id=_intern(nl.vendor_id),
+        languages=tuple(_intern(lang) for lang in nl.language_list),
+        language_codes=frozenset(_intern(lang[:2].lower())
+                                 for lang in nl.language_list),
+        welcome=_intern(nl.welcome),
+        confirm_message=_intern(nl.confirm_message),
+        requires_double_optin=nl.requires_double_optin,
+    )
+
+
+class NewsletterFlags(object):
+    """
+    Decodes the newsletter flags of an ET record.
+
+    Built once along with the rest of the newsletter data, so decoding a
+    user's record is one pass over the flag fields instead of a lookup
+    per newsletter.
+
+    Newsletters that share a vendor ID share its flag field, which is
+    listed once; a 'Y' in it subscribes the user to all of them.
+    """
+    __slots__ = ('flags', 'fields')
+
+    def __init__(self, newsletters):
+        # ET flag field -> slugs of the newsletters that use it
+        slugs = {}
+        for nl in newsletters:
+            slugs.setdefault('%s_FLG' % nl.vendor_id, []).append(nl.slug)
+        for field, shared in slugs.items():
+            if len(shared) > 1:
+                log.warn('Newsletters %s share the flag field %s' %
+                         (', '.join(sorted(shared)), field))
+        self.__setstate__(tuple((field, tuple(shared))
+                                for field, shared in sorted(slugs.items())))
+
+    def __getstate__(self):
+        return self.flags
+
+    def __setstate__(self, flags):
+        self.flags = flags
+        self.fields = tuple(field for field, slugs in flags)
+
+    def decode(self, record):
+        """Return the slugs of the newsletters flagged 'Y' in the record"""
+        return [slug for field, slugs in self.flags
+                if record.get(field, 'N') == 'Y'
+                for slug in slugs]
+
+
+def mogrify_message_id(message_id, lang, format):
+    """Given a bare message ID, a language code, and a format (T or H),
+    return a message ID modified to specify that language and format.
+
+    E.g. on input ('MESSAGE', 'fr', 'T') it returns 'fr_MESSAGE_T',
+    or on input ('MESSAGE', 'pt', 'H') it returns 'pt_MESSAGE'
+
+    If `lang` is None or empty, it skips prefixing the language.
+    """
+    if lang:
+        result = "%s_%s" % (lang.lower()[:2], message_id)
+    else:
+        result = message_id
+    if format == 'T':
+        result += "_T"
+    return result
+
+
+class MessageRouter(object):
+    """
+    Works out the ET messages to send to users who subscribe to or
+    confirm a set of newsletters.
+
+    What each newsletter contributes is worked out once along with the
+    rest of the newsletter data; the answer for each set of newsletters,
+    language and format is remembered, up to MAX_ROUTES of them, until
+    the newsletters change.
+    """
+    MAX_ROUTES = 1000
+
+    def __init__(self, newsletters):
+        """:param newsletters: NewsletterInfo in display order"""
+        newsletters = list(newsletters)
+        # slug: (welcome message ID, language codes)
+        self.welcomes = dict((nl.slug, (nl.welcome, nl.language_codes))
+                             for nl in newsletters if nl.welcome)
+        # (slug, confirm message ID), in display order
+        self.confirm_messages = tuple((nl.slug, nl.confirm_message)
+                                      for nl in newsletters
+                                      if nl.confirm_message)
+        # Slugs of the newsletters with each vendor ID, which they may
+        # share
+        self.ffos = frozenset(nl.slug for nl in newsletters
+                              if nl.vendor_id == FFOS_VENDOR_ID)
+        self.ffay = frozenset(nl.slug for nl in newsletters
+                              if nl.vendor_id == FFAY_VENDOR_ID)
+        self.routes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['routes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.routes = {}
+
+    def route(self, key, get):
+        message_ids = self.routes.get(key)
+        if message_ids is None:
+            message_ids = get(*key[1:])
+            if len(self.routes) >= self.MAX_ROUTES:
+                self.routes.clear()
+            self.routes[key] = message_ids
+        return message_ids
+
+    def welcomes_for(self, slugs, lang, format):
+        """
+        Return the frozenset of welcome message IDs to send for the
+        newsletters, without duplicates.
+
+        Newsletters that don't support the language send their English
+        welcome. If the newsletters include Firefox OS, its welcome is
+        sent but not the Firefox & You one.
+        """
+        return self.route(('welcome', frozenset(slugs), lang, format),
+                          self._welcomes_for)
+
+    def _welcomes_for(self, slugs, lang, format):
+        if not self.ffos.isdisjoint(slugs):
+            slugs = slugs - self.ffay
+        lang = (lang or '')[:2].lower()
+        message_ids = set()
+        for slug in slugs:
+            if slug not in self.welcomes:
+                continue
+            welcome, language_codes = self.welcomes[slug]
+            lang_code = lang if lang in language_codes else 'en'
+            message_ids.add(mogrify_message_id(welcome, lang_code, format))
+        return frozenset(message_ids)
+
+    def confirm_message_for(self, slugs, lang, format):
+        """
+        Return the ID of the confirmation message to send for the
+        newsletters: the custom one of the first of them that has one,
+        otherwise the default one.
+        """
+        return self.route(('confirm', frozenset(slugs), lang, format),
+                          self._confirm_message_for)
+
+    def _confirm_message_for(self, slugs, lang, format):
+        message_id = CONFIRMATION_MESSAGE
+        for slug, confirm_message in self.confirm_messages:
+            if slug in slugs:
+                message_id = confirm_message
+                break
+        return mogrify_message_id(message_id, lang, format)
+
+
+def _api_data(nl):
+    """The newsletter as the newsletters API shows it: all its fields,
+    except the ones the caller doesn't need to know"""
+    data = dict((field.attname, getattr(nl, field.attname))
+                for field in nl._meta.fields
+                if field.attname not in ('id', 'slug'))
+    data['languages'] = nl.languages.split(",")
     return data
 
 
 def _get_newsletters_data():
+    return build_newsletters_data(Newsletter.objects.all())
+
+
+def build_newsletters_data(newsletters):
+    """Build the data _newsletters() returns from Newsletter objects"""
     by_name = {}
     by_vendor_id = {}
-    for nl in Newsletter.objects.all():
+    languages = set()
+    language_codes = set()
+    no_double_optin = set()
+    ordered = []
+    api_data = {}
+    for nl in newsletters:
+        api_data[nl.slug] = _api_data(nl)
+        nl = _newsletter_info(nl)
+        ordered.append(nl)
         by_name[nl.slug] = nl
         by_vendor_id[nl.vendor_id] = nl
+        languages.update(nl.languages)
+        language_codes.update(nl.language_codes)
+        if not nl.requires_double_optin:
+            no_double_optin.add(nl.slug)
+    # Sorted so that every process makes the same body and ETag
+    body = json.dumps({'status': 'ok', 'newsletters': api_data},
+                      sort_keys=True)
     return {
         'by_name': by_name,
         'by_vendor_id': by_vendor_id,
+        'vendor_ids': dict((nl.slug, nl.vendor_id) for nl in by_name.values()),
+        'slugs': dict((nl.vendor_id, nl.slug) for nl in by_name.values()),
+        'languages': frozenset(languages),
+        'language_codes': frozenset(language_codes),
+        'no_double_optin': frozenset(no_double_optin),
+        'flags': NewsletterFlags(by_name.values()),
+        'messages': MessageRouter(ordered),
+        'json': body,
+        'etag': hashlib.md5(body).hexdigest(),
     }
 
 
 def newsletter_field(name):
     """Lookup the backend-specific field (vendor ID) for the newsletter"""
-    try:
-        return _newsletters()['by_name'][name].vendor_id
-    except KeyError:
-        return None
+    return _newsletters()['vendor_ids'].get(name)
 
 
 def newsletter_name(field):
     """Lookup the generic name for this newsletter field"""
-    try:
-        return _newsletters()['by_vendor_id'][field].slug
-    except KeyError:
-        return None
+    return _newsletters()['slugs'].get(field)
 
 
 def newsletter_slugs():
@@ -80,7 +352,7 @@ def newsletter_slugs():
 
 def slug_to_vendor_id(slug):
     """Given a newsletter's slug, return its vendor_id"""
-    return _newsletters()['by_name'][slug].vendor_id
+    return _newsletters()['vendor_ids'][slug]
 
 
 def newsletter_fields():
@@ -88,15 +360,44 @@ def newsletter_fields():
     return _newsletters()['by_vendor_id'].keys()
 
 
+def newsletter_flags():
+    """Get the NewsletterFlags for all the newsletters"""
+    return _newsletters()['flags']
+
+
+def message_router():
+    """Get the MessageRouter for all the newsletters"""
+    return _newsletters()['messages']
+
+
+def newsletters_generation():
+    """Get the current generation of the newsletter data, for caching
+    things made from it; it changes whenever the newsletters do"""
+    return _generation()
+
+
+def newsletters_json():
+    """Get the JSON body of the newsletters API's response"""
+    return _newsletters()['json']
+
+
+def newsletters_etag():
+    """Get the ETag of newsletters_json(), unquoted"""
+    return _newsletters()['etag']
+
+
+def newsletters_exempt_from_confirmation(slugs):
+    """Whether any of the newsletters doesn't require double opt-in, so
+    subscribing to it confirms the user straight away"""
+    return not _newsletters()['no_double_optin'].isdisjoint(slugs)
+
+
 def newsletter_languages():
     """
-    Return a set of the 2 or 5 char codes of all the languages
+    Return a frozenset of the 2 or 5 char codes of all the languages
     supported by newsletters.
     """
-    lang_set = set()
-    for newsletter in _newsletters()['by_name'].values():
-        lang_set |= set(newsletter.language_list)
-    return lang_set
+    return _newsletters()['languages']
 
 
 def is_supported_newsletter_language(code):
@@ -104,8 +405,12 @@ def is_supported_newsletter_language(code):
     Return True if the given language code is supported by any of the
     newsletters. (Only compares first two chars; case-insensitive.)
     """
-    return code[:2].lower() in [lang[:2].lower() for lang in newsletter_languages()]
+    return code[:2].lower() in _newsletters()['language_codes']
 
 
 def clear_newsletter_cache():
-    cache.delete(CACHE_KEY)
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not in the cache; the next _generation() starts a new one.
+        pass
@@ -1,23 +1,35 @@
 from __future__ import absolute_import
+import copy
 import datetime
+import hashlib
+import inspect
+import json
 import logging
+import threading
 from datetime import date
 from email.utils import formatdate
 from functools import wraps
 from time import mktime
 from urllib2 import URLError
+from uuid import uuid4
 
 from django.conf import settings
-from django.core.cache import get_cache
+from django.core.cache import cache, get_cache
 from django_statsd.clients import statsd
 
+from celery.exceptions import RetryTaskError
 from celery.task import Task, task
 
-from .backends.common import NewsletterException, NewsletterNoResultsException
-from .backends.exacttarget import (ExactTarget, ExactTargetDataExt)
-from .models import FailedTask, Newsletter, Subscriber
-from .newsletters import (is_supported_newsletter_language, newsletter_field,
-                          newsletter_slugs)
+from .backends.common import (CircuitOpen, NewsletterException,
+                              NewsletterNoResultsException)
+from .backends.exacttarget import (ExactTarget, ExactTargetDataExt, breaker)
+from .models import FailedTask, Subscriber
+from .newsletters import (is_supported_newsletter_language, message_router,
+                          mogrify_message_id, newsletter_field,
+                          newsletter_slugs,
+                          newsletters_exempt_from_confirmation)
+from .usercache import forget_user_data
+from . import writebuffer
 
 
 log = logging.getLogger(__name__)
@@ -32,9 +44,6 @@ SUBSCRIBE = 'SUBSCRIBE'
 UNSUBSCRIBE = 'UNSUBSCRIBE'
 SET = 'SET'
 
-# Base message ID for confirmation email
-CONFIRMATION_MESSAGE = "confirmation_email"
-
 SMS_MESSAGES = (
     'SMS_Android',
 )
@@ -79,10 +88,6 @@ PHONEBOOK_GROUPS = (
 RECOVERY_MESSAGE_ID = 'recovery_message'
 FXACCOUNT_WELCOME = 'FxAccounts_Welcome'
 
-# Vendor IDs for Firefox OS and Firefox & You:
-FFOS_VENDOR_ID = 'FIREFOX_OS'
-FFAY_VENDOR_ID = 'MOZILLA_AND_YOU'
-
 ## Error messages
 MSG_TOKEN_REQUIRED = 'Must have valid token for this request'
 MSG_EMAIL_OR_TOKEN_REQUIRED = 'Must have valid token OR email for this request'
@@ -99,10 +104,126 @@ class BasketError(Exception):
         super(BasketError, self).__init__(msg)
 
 
+class StepJournal(object):
+    """
+    The steps a task has done, with their results, kept in the cache
+    across its retries so that a retry doesn't do them again.
+
+    A journal without a task ID isn't kept; see current_journal().
+    """
+    # Longer than a task keeps being retried
+    TIMEOUT = 60 * 60
+
+    def __init__(self, task_id=None):
+        self.key = task_id and 'task_journal:%s' % task_id
+        self.steps = (self.key and cache.get(self.key)) or {}
+
+    def __contains__(self, step):
+        return step in self.steps
+
+    def result(self, step):
+        statsd.incr('news.tasks.journal.skipped')
+        return copy.deepcopy(self.steps[step])
+
+    def record(self, step, result=None):
+        # A copy, so what the step saw isn't changed by later steps
+        self.steps[step] = copy.deepcopy(result)
+        if self.key:
+            cache.set(self.key, self.steps, self.TIMEOUT)
+
+    def clear(self):
+        if self.key:
+            cache.delete(self.key)
+
+
+_journals = threading.local()
+
+
+def current_journal():
+    """The StepJournal of the task running in this thread, if it keeps
+    one, otherwise one that's thrown away"""
+    return getattr(_journals, 'journal', None) or StepJournal()
+
+
 class ETTask(Task):
     abstract = True
     default_retry_delay = 60 * 5  # 5 minutes
     max_retries = 6  # ~ 30 min
+    # Drop calls identical to the latest one queued for the same user
+    # while it's queued or running; see et_task
+    dedupe = False
+    # Arguments that don't change what the task does, so calls that
+    # differ only in them are duplicates
+    dedupe_ignore = ()
+    # Keep a StepJournal across retries; see et_task
+    journal = False
+    # Names of the task function's arguments, set by et_task
+    arg_names = ()
+
+    # These are classmethods, like apply_async in celery's old task API.
+    @classmethod
+    def call_args(cls, args, kwargs):
+        """The arguments of a call of this task, by name"""
+        call = dict(zip(cls.arg_names, args or ()))
+        call.update(kwargs or {})
+        return call
+
+    @classmethod
+    def fingerprint(cls, args, kwargs):
+        """Digest of the arguments of a call of this task, but for the
+        ones in dedupe_ignore"""
+        call = cls.call_args(args, kwargs)
+        for name in cls.dedupe_ignore:
+            call.pop(name, None)
+        call = json.dumps(call, sort_keys=True, default=repr)
+        return hashlib.md5(call).hexdigest()
+
+    @classmethod
+    def dedupe_key(cls, args, kwargs):
+        """Cache key for the latest call of this task about the user with
+        the token, or failing that the email, of this call; None if it
+        has neither"""
+        call = cls.call_args(args, kwargs)
+        user = call.get('token') or call.get('email')
+        if not user:
+            return None
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        return 'task_dedupe:%s:%s' % (cls.name, hashlib.md5(user).hexdigest())
+
+    @classmethod
+    def apply_async(cls, args=None, kwargs=None, **options):
+        key = (cls.dedupe and settings.TASK_DEDUPE_TIMEOUT and
+               cls.dedupe_key(args, kwargs))
+        if key:
+            fingerprint = cls.fingerprint(args, kwargs)
+            # Only a repeat of the latest call changes nothing: a repeat
+            # of an earlier one undoes the calls since.
+            if cache.get(key) == fingerprint:
+                statsd.incr(cls.name + '.duplicate')
+                log.info("Dropped duplicate task: %s(args=%r, kwargs=%r)"
+                         % (cls.name, args, kwargs))
+                return None
+            cache.set(key, fingerprint, settings.TASK_DEDUPE_TIMEOUT)
+        return super(ETTask, cls).apply_async(args, kwargs, **options)
+
+    def defer(self, args, kwargs, exc):
+        """Queue this call again for when ET may be back, without
+        counting it against max_retries: an ET outage isn't the call's
+        fault, however long it lasts."""
+        self.apply_async(args, kwargs, task_id=self.request.id,
+                         retries=self.request.retries,
+                         countdown=breaker.open_seconds)
+        raise RetryTaskError('Deferred while ExactTarget is unavailable',
+                             exc)
+
+    @classmethod
+    def done(cls, args, kwargs):
+        """Let calls with these arguments be queued again, unless another
+        call for the same user was queued since"""
+        key = cls.dedupe and cls.dedupe_key(args, kwargs)
+        if key and cache.get(key) == cls.fingerprint(args, kwargs):
+            cache.delete(key)
 
     def on_success(self, retval, task_id, args, kwargs):
         """Success handler.
@@ -169,18 +290,67 @@ class ETTask(Task):
         log.warn("Task retrying: %s" % self.name, exc_info=einfo.exc_info)
 
 
-def et_task(func):
-    """Decorator to standardize ET Celery tasks."""
-    @task(base=ETTask)
+def et_task(func=None, **options):
+    """Decorator to standardize ET Celery tasks.
+
+    Options are passed on to celery's task decorator. With dedupe=True,
+    a call identical to the latest one queued for the same user (by
+    token, or else email) is dropped while that one is queued or
+    running, e.g. from double-submitted forms; arguments named in
+    dedupe_ignore aren't compared. settings.TASK_DEDUPE_TIMEOUT is how
+    long a call that never finishes holds up identical ones.
+
+    With journal=True, the task keeps a StepJournal across its retries,
+    so that a retry skips the ET writes and sends its earlier tries
+    made. Tasks it calls directly use the same journal.
+
+    While the circuit breaker is open the task is deferred until it may
+    let calls through again, however many times, without using up its
+    retries.
+    """
+    if func is None:
+        return lambda func: et_task(func, **options)
+    options.setdefault('arg_names', tuple(inspect.getargspec(func).args))
+
+    @task(base=ETTask, **options)
     @wraps(func)
     def wrapped(*args, **kwargs):
         statsd.incr(wrapped.name + '.total')
+        # Not when called directly, e.g. by another task, or it could
+        # let a queued call identical to this one be queued again.
+        queued = wrapped.request.id is not None
+        journal = None
+        if wrapped.journal and getattr(_journals, 'journal', None) is None:
+            journal = _journals.journal = StepJournal(wrapped.request.id)
+        retrying = False
         try:
-            return func(*args, **kwargs)
+            try:
+                if breaker.is_open():
+                    # ET is down; don't tie up a worker finding that out
+                    # again.
+                    raise CircuitOpen('ExactTarget is unavailable')
+                return func(*args, **kwargs)
+            finally:
+                # Before any retry is queued, or it would be dropped
+                if queued:
+                    wrapped.done(args, kwargs)
+        except CircuitOpen as e:
+            # Called directly, the task that called us defers instead.
+            if not queued:
+                raise
+            retrying = True
+            statsd.incr(wrapped.name + '.deferred')
+            wrapped.defer(args, kwargs, e)
         except (URLError, NewsletterException) as e:
             # URLError or NewsletterException could be a connection issue,
             # so try again later.
+            retrying = True
             wrapped.retry(exc=e)
+        finally:
+            if journal is not None:
+                _journals.journal = None
+                if not retrying:
+                    journal.clear()
 
     return wrapped
 
@@ -310,6 +480,8 @@ def update_fxa_info(email, lang, fxa_id, source_url=None):
     welcome = mogrify_message_id(FXACCOUNT_WELCOME, lang, format)
     send_message(welcome, email, token, format)
     apply_updates(settings.EXACTTARGET_DATA, record)
+    if settings.USER_DATA_MIRROR and 'LANGUAGE_ISO2' in record:
+        Subscriber.objects.update_mirror(token, lang=lang)
 
 
 @et_task
@@ -345,7 +517,8 @@ UU_MUST_CONFIRM_PENDING = 4
 UU_MUST_CONFIRM_NEW = 5
 
 
-@et_task
+# A double submit has created=False where the first one created the user
+@et_task(dedupe=True, dedupe_ignore=('created',), journal=True)
 def update_user(data, email, token, created, type, optin):
     """Task for updating user's preferences and newsletters.
 
@@ -388,11 +561,9 @@ def update_user(data, email, token, created, type, optin):
 
     lang = record.get('LANGUAGE_ISO2', '') or ''
 
-    # Can't import this earlier, circular import
-    from .views import get_user_data
-
-    # Get the user's current settings from ET, if any
-    user_data = get_user_data(token=token)
+    # Get the user's current settings from ET, if any. Not from the
+    # mirror, which might not know yet which database they're in now.
+    user_data = get_user_data_once(token=token, use_mirror=False)
     # If we don't find the user, get_user_data returns None. Create
     # a minimal dictionary to use going forward. This will happen
     # often due to new people signing up.
@@ -447,9 +618,8 @@ def update_user(data, email, token, created, type, optin):
     # When including any newsletter that does not
     # require confirmation, user gets a pass on confirming and goes straight
     # to confirmed.
-    exempt_from_confirmation = optin or Newsletter.objects\
-        .filter(slug__in=to_subscribe, requires_double_optin=False)\
-        .exists()
+    exempt_from_confirmation = optin or \
+        newsletters_exempt_from_confirmation(to_subscribe)
 
     # Send welcomes when type is SUBSCRIBE and trigger_welcome arg
     # is absent or 'Y'.
@@ -500,19 +670,168 @@ def update_user(data, email, token, created, type, optin):
         # reminding them) to confirm.
         apply_updates(OPT_IN, record)
         send_confirm_notice(email, token, lang, fmt, to_subscribe)
+
+    if settings.USER_DATA_MIRROR:
+        mirror_update(user_data, record, fmt, to_subscribe, to_unsubscribe,
+                      return_code)
     return return_code
 
 
+def get_user_data_once(**kwargs):
+    """
+    get_user_data(), except that a retried task gets the answer its
+    first try got, so that it makes the same decisions whatever that try
+    changed in ET before failing.
+    """
+    from .views import get_user_data  # Avoid circular import
+    journal = current_journal()
+    if 'get_user_data' in journal:
+        return journal.result('get_user_data')
+    user_data = get_user_data(**kwargs)
+    if user_data is None or user_data.get('status') == 'ok':
+        journal.record('get_user_data', user_data)
+    return user_data
+
+
+def mirror_update(user_data, record, fmt, to_subscribe, to_unsubscribe,
+                  return_code):
+    """Store the user's data as update_user left it in ET as their
+    mirror, so reads don't need to go to ET."""
+    newsletters = set(user_data.get('newsletters') or [])
+    newsletters.update(to_subscribe)
+    newsletters.difference_update(to_unsubscribe)
+    user_data = dict(user_data,
+                     email=record['EMAIL_ADDRESS_'],
+                     format=fmt,
+                     country=record.get('COUNTRY_',
+                                        user_data.get('country')) or '',
+                     lang=user_data.get('lang') or '',
+                     newsletters=sorted(newsletters))
+    if not user_data.get('created-date'):
+        user_data['created-date'] = record.get('CREATED_DATE_')
+    if return_code == UU_EXEMPT_NEW:
+        user_data.update(confirmed=True, pending=False, master=True)
+    elif return_code == UU_EXEMPT_PENDING:
+        user_data.update(confirmed=True, pending=False)
+    # Only synced once the writes are in ET; until then a lookup in ET
+    # sees them laid over by news.writebuffer.
+    pending = writebuffer.pending_tokens(
+        [settings.EXACTTARGET_DATA, settings.EXACTTARGET_OPTIN_STAGE,
+         settings.EXACTTARGET_CONFIRMATION], [user_data['token']])
+    Subscriber.objects.mirror(user_data, synced=not pending)
+
+
 def apply_updates(target_et, record):
     """Send the record data to ET to update the database named
     target_et.
 
+    With EXACTTARGET_WRITE_BUFFER_SECONDS set, the record is merged with
+    the other writes of the same row in that many seconds and written
+    with them by flush_updates; see news.writebuffer.
+
     :param str target_et: Target database, e.g. settings.EXACTTARGET_DATA
         or settings.EXACTTARGET_CONFIRMATION.
     :param dict record: Data to send
     """
+    token = record.get('TOKEN')
+    journal = current_journal()
+    step = 'apply_updates:%s:%s' % (target_et, token)
+    if step in journal:
+        return journal.result(step)
+
+    if writebuffer.WINDOW and token:
+        # Comes back, over any write of the row still pending, if it
+        # can't be buffered
+        record = writebuffer.buffer_update(target_et, record)
+        if record is None:
+            forget_user_data(token)
+            if writebuffer.claim_flush(target_et):
+                flush_updates.apply_async((target_et,),
+                                          countdown=writebuffer.WINDOW)
+            journal.record(step)
+            return
+
     et = ExactTarget(settings.EXACTTARGET_USER, settings.EXACTTARGET_PASS)
-    et.data_ext().add_record(target_et, record.keys(), record.values())
+    try:
+        et.data_ext().add_record(target_et, record.keys(), record.values())
+    finally:
+        # Even a failed call might have changed the record
+        forget_user_data(token)
+    journal.record(step)
+
+
+@et_task
+def flush_updates(target_et):
+    """Write the updates buffered for database target_et by
+    apply_updates, in as few calls as ET allows.
+
+    Rows ET rejects are put back in the buffer, under any newer updates,
+    for another flush; once one has been rejected
+    writebuffer.MAX_FAILURES times in a row, it's recorded as a failed
+    write_update task instead."""
+    updates = writebuffer.take_updates(target_et)
+    if not updates:
+        return
+
+    # add_records needs the same fields in every row of a call
+    by_fields = {}
+    for record in updates.values():
+        by_fields.setdefault(tuple(sorted(record)), []).append(record)
+
+    ext = ExactTargetDataExt(settings.EXACTTARGET_USER,
+                             settings.EXACTTARGET_PASS)
+    unsaved = dict(updates)
+    failed = {}
+    try:
+        for fields, records in by_fields.items():
+            rows = [[record[field] for field in fields]
+                    for record in records]
+            errors = ext.add_records(target_et, fields, rows)
+            for record, error in zip(records, errors):
+                if error:
+                    log.error("Buffered update of %s in %s failed: %s"
+                              % (record['TOKEN'], target_et, error))
+                    statsd.incr('news.et_write_buffer.failed')
+                    failed[record['TOKEN']] = error
+                else:
+                    del unsaved[record['TOKEN']]
+    except Exception:
+        # Retry them with the next flush, unless newer updates
+        # of the same fields have come since.
+        writebuffer.restore_updates(target_et, unsaved)
+        raise
+    finally:
+        for token in updates:
+            forget_user_data(token)
+    writebuffer.clear_failures(target_et,
+                               [token for token in updates
+                                if token not in failed])
+    statsd.incr('news.et_write_buffer.flushed', len(updates) - len(failed))
+
+    for token, error in failed.items():
+        failures = writebuffer.count_failure(target_et, token)
+        if failures >= writebuffer.MAX_FAILURES:
+            del unsaved[token]
+            writebuffer.clear_failures(target_et, [token])
+            statsd.incr('news.et_write_buffer.gave_up')
+            FailedTask.objects.create(
+                task_id=str(uuid4()),
+                name=write_update.name,
+                args=[target_et, updates[token]],
+                exc=repr(error),
+            )
+    if unsaved:
+        writebuffer.restore_updates(target_et, unsaved)
+        if writebuffer.claim_flush(target_et):
+            flush_updates.apply_async(
+                (target_et,), countdown=flush_updates.default_retry_delay)
+
+
+@et_task
+def write_update(target_et, record):
+    """Write the record to database target_et; how a buffered update that
+    flush_updates gave up on is recorded, so that it can be retried"""
+    apply_updates(target_et, record)
 
 
 def send_message(message_id, email, token, format):
@@ -531,6 +850,10 @@ def send_message(message_id, email, token, format):
 
     if BAD_MESSAGE_ID_CACHE.get(message_id, False):
         return
+    journal = current_journal()
+    step = send_step(message_id, token)
+    if step in journal:
+        return journal.result(step)
     log.debug("Sending message %s to %s %s in %s" %
               (message_id, email, token, format))
     et = ExactTarget(settings.EXACTTARGET_USER, settings.EXACTTARGET_PASS)
@@ -544,35 +867,86 @@ def send_message(message_id, email, token, format):
             }
         )
     except NewsletterException as e:
-        # Better error messages for some cases. Also there's no point in
-        # retrying these
-        if 'Invalid Customer Key' in e.message:
-            # Raise the error so it gets logged once, but remember it's a
-            # bad message ID so we don't try again during this process.
-            BAD_MESSAGE_ID_CACHE.set(message_id, True)
-            raise BasketError("ET says no such message ID: %r" % message_id)
-        elif 'There are no valid subscribers.' in e.message:
-            raise BasketError("ET says: there are no valid subscribers.")
+        error = send_error(message_id, e.message)
+        if error:
+            raise error
         # we should retry
         raise
+    journal.record(step)
 
 
-def mogrify_message_id(message_id, lang, format):
-    """Given a bare message ID, a language code, and a format (T or H),
-    return a message ID modified to specify that language and format.
+def send_step(message_id, token):
+    """Name of the StepJournal step of sending the message to the user"""
+    return 'send_message:%s:%s' % (message_id, token)
 
-    E.g. on input ('MESSAGE', 'fr', 'T') it returns 'fr_MESSAGE_T',
-    or on input ('MESSAGE', 'pt', 'H') it returns 'pt_MESSAGE'
 
-    If `lang` is None or empty, it skips prefixing the language.
+def send_error(message_id, message):
     """
-    if lang:
-        result = "%s_%s" % (lang.lower()[:2], message_id)
-    else:
-        result = message_id
-    if format == 'T':
-        result += "_T"
-    return result
+    Given ET's error message for a send of ``message_id``, return a
+    BasketError if it's an error that there's no point in retrying,
+    otherwise None.
+    """
+    # Better error messages for some cases.
+    if 'Invalid Customer Key' in message:
+        # Raise the error so it gets logged once, but remember it's a
+        # bad message ID so we don't try again during this process.
+        BAD_MESSAGE_ID_CACHE.set(message_id, True)
+        return BasketError("ET says no such message ID: %r" % message_id)
+    elif 'There are no valid subscribers.' in message:
+        return BasketError("ET says: there are no valid subscribers.")
+    return None
+
+
+def send_messages(messages):
+    """
+    Ask ET to send several messages, in one call if there's more than
+    one.
+
+    :param list messages: (message_id, email, token, format) tuples, with
+        the same meaning as the arguments of send_message.
+    :returns: A list with one entry per message: None if it was sent (or
+        skipped because the message ID is known to be bad), otherwise a
+        BasketError for fatal errors or a NewsletterException for
+        retryable ones.
+    """
+    if len(messages) == 1:
+        try:
+            send_message(*messages[0])
+        except (BasketError, NewsletterException) as e:
+            return [e]
+        return [None]
+
+    results = [None] * len(messages)
+    sends = []
+    positions = []
+    journal = current_journal()
+    for i, (message_id, email, token, format) in enumerate(messages):
+        if BAD_MESSAGE_ID_CACHE.get(message_id, False):
+            continue
+        if send_step(message_id, token) in journal:
+            # Sent by an earlier try of this task
+            statsd.incr('news.tasks.journal.skipped')
+            continue
+        log.debug("Sending message %s to %s %s in %s" %
+                  (message_id, email, token, format))
+        sends.append((message_id, {
+            'EMAIL_ADDRESS_': email,
+            'TOKEN': token,
+            'EMAIL_FORMAT_': format,
+        }))
+        positions.append(i)
+    if not sends:
+        return results
+
+    et = ExactTarget(settings.EXACTTARGET_USER, settings.EXACTTARGET_PASS)
+    errors = et.trigger_sends(sends)
+    for i, (message_id, fields), error in zip(positions, sends, errors):
+        if error:
+            results[i] = (send_error(message_id, error) or
+                          NewsletterException(error))
+        else:
+            journal.record(send_step(message_id, fields['TOKEN']))
+    return results
 
 
 def send_confirm_notice(email, token, lang, format, newsletter_slugs):
@@ -595,16 +969,10 @@ def send_confirm_notice(email, token, lang, format, newsletter_slugs):
         msg = "Cannot send confirmation in unsupported language '%s'." % lang
         raise BasketError(msg)
 
-    # See if any newsletters have a custom confirmation message
-    # We only need to find one; if so, we'll use the first we find.
-    newsletters = Newsletter.objects.filter(slug__in=newsletter_slugs)\
-        .exclude(confirm_message='')[:1]
-    if newsletters:
-        welcome = newsletters[0].confirm_message
-    else:
-        welcome = CONFIRMATION_MESSAGE
-
-    welcome = mogrify_message_id(welcome, lang, format)
+    # Use the first custom confirmation message of the newsletters, if
+    # any have one.
+    welcome = message_router().confirm_message_for(newsletter_slugs, lang,
+                                                   format)
     send_message(welcome, email, token, format)
 
 
@@ -623,41 +991,34 @@ def send_welcomes(user_data, newsletter_slugs, format):
                   % user_data)
         return
 
-    newsletters = Newsletter.objects.filter(
-        slug__in=newsletter_slugs
-    )
-
-    # If newsletters include FIREFOX_OS, then remove FIREFOX & YOU
-    # from the list so we don't send its welcome.
-    if newsletters.filter(vendor_id=FFOS_VENDOR_ID).exists():
-        newsletters = newsletters.exclude(vendor_id=FFAY_VENDOR_ID)
-
-    # We don't want any duplicate welcome messages, so make a set
-    # of the ones to send, then send them
-    welcomes_to_send = set()
-    for nl in newsletters:
-        welcome = nl.welcome.strip()
-        if not welcome:
-            continue
-        languages = [lang[:2].lower() for lang in nl.language_list]
-        lang_code = user_data.get('lang', 'en')[:2].lower()
-        if lang_code not in languages:
-            # Newsletter does not support their preferred language, so
-            # it doesn't have a welcome in that language either. Settle
-            # for English, same as they'll be getting the newsletter in.
-            lang_code = 'en'
-        welcome = mogrify_message_id(welcome, lang_code, format)
-        welcomes_to_send.add(welcome)
+    # A set of the welcomes to send, without duplicates. Newsletters
+    # that don't support their preferred language don't have a welcome
+    # in it either, so they get the English one, same as they'll be
+    # getting the newsletter in.
+    welcomes_to_send = message_router().welcomes_for(
+        newsletter_slugs, user_data.get('lang', 'en'), format)
     # Note: it's okay not to send a welcome if none of the newsletters
     # have one configured.
+    messages = []
     for welcome in welcomes_to_send:
         log.info("Sending welcome %s to user %s %s" %
                  (welcome, user_data['email'], user_data['token']))
-        send_message(welcome, user_data['email'], user_data['token'],
-                     format)
-
-
-@et_task
+        messages.append((welcome, user_data['email'], user_data['token'],
+                         format))
+    if messages:
+        # Send them all in one call, then raise an error if any failed.
+        # A retryable one wins over a fatal one, so that the task is
+        # retried for the messages that can still go out.
+        errors = [error for error in send_messages(messages) if error]
+        retryable = [error for error in errors
+                     if isinstance(error, NewsletterException)]
+        if retryable:
+            raise retryable[0]
+        if errors:
+            raise errors[0]
+
+
+@et_task(dedupe=True, journal=True)
 def confirm_user(token, user_data):
     """
     Confirm any pending subscriptions for the user with this token.
@@ -674,8 +1035,7 @@ def confirm_user(token, user_data):
     """
     # Get user data if we don't already have it
     if user_data is None:
-        from .views import get_user_data   # Avoid circular import
-        user_data = get_user_data(token=token)
+        user_data = get_user_data_once(token=token)
     if user_data is None:
         raise BasketError(MSG_USER_NOT_FOUND)
     if user_data['status'] == 'error':
@@ -690,6 +1050,8 @@ def confirm_user(token, user_data):
     # Add user's token to the confirmation database at ET. A nightly
     # task will somehow do something about it.
     apply_updates(settings.EXACTTARGET_CONFIRMATION, {'TOKEN': token})
+    if settings.USER_DATA_MIRROR:
+        Subscriber.objects.update_mirror(token, confirmed=True, pending=False)
 
     # Now, if they're subscribed to any newsletters with confirmation
     # welcome messages, send those.
@@ -744,7 +1106,8 @@ def send_recovery_message_task(email):
     # We should check ET so we can get format and lang if they exist.
     # If they don't exist, then we can create a basket subscriber.
 
-    user_data = get_user_data(email=email, sync_data=True)
+    user_data = get_user_data(email=email, sync_data=True,
+                              projection=('lang', 'format'))
     if not user_data:
         log.warn("In send_recovery_message_task, email not known: %s" % email)
         return
@@ -1,17 +1,37 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib2 import URLError
+
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from mock import patch, Mock
-from nose.tools import ok_
+from nose.tools import eq_, ok_
 
-from news.backends.exacttarget import logged_in
+from news.backends.common import CircuitOpen, NewsletterException, \
+    NewsletterNoResultsException
+from news.backends.exacttarget import (ET_CLIENT_POOL_WAIT, ET_TIMEOUT,
+                                       CircuitBreaker, ClientPool,
+                                       ExactTarget,
+                                       ExactTargetDataExt, SingleFlight,
+                                       SudsDjangoCache,
+                                       WSDLSnapshotCache, clear_client_pools,
+                                       client_pool, logged_in, make_client,
+                                       single_flight, wsdl_snapshot_path)
+from news.backends.fakeet import FakeExactTarget
+from news.backends.transport import PooledHttpTransport, clear_pools
+from news.usercache import forget_user_data
 
 
 @patch('news.backends.exacttarget.Client')
 class TestWSDLSwitch(TestCase):
     def setUp(self):
-        # clear the cached client
-        logged_in.cached_client = None
+        # clear the cached clients
+        clear_client_pools()
         self.test_function = logged_in(lambda x: None)
 
     @override_settings(EXACTTARGET_USE_SANDBOX=True)
@@ -29,3 +49,713 @@ class TestWSDLSwitch(TestCase):
 
         call_args = client_mock.call_args
         ok_(call_args[0][0].endswith('et-wsdl.txt'))
+
+
+class TestWSDLSnapshot(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.wsdl_file = os.path.join(self.tmpdir, 'test-wsdl.txt')
+        with open(self.wsdl_file, 'w') as f:
+            f.write('<definitions/>')
+        self.snapshot_file = wsdl_snapshot_path(self.wsdl_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """A written snapshot is read back while the WSDL is unchanged."""
+        WSDLSnapshotCache(self.wsdl_file, writable=True).put('x', {'a': 1})
+        snapshot = WSDLSnapshotCache(self.wsdl_file)
+        ok_(snapshot.is_valid())
+        eq_({'a': 1}, snapshot.get('x'))
+
+    def test_wsdl_changed(self):
+        """A snapshot of a different WSDL is ignored."""
+        WSDLSnapshotCache(self.wsdl_file, writable=True).put('x', {'a': 1})
+        with open(self.wsdl_file, 'w') as f:
+            f.write('<definitions name="changed"/>')
+        snapshot = WSDLSnapshotCache(self.wsdl_file)
+        ok_(not snapshot.is_valid())
+        eq_(None, snapshot.get('x'))
+
+    def test_missing(self):
+        """No snapshot means a cache miss, not an error."""
+        snapshot = WSDLSnapshotCache(self.wsdl_file)
+        ok_(not snapshot.is_valid())
+        eq_(None, snapshot.get('x'))
+
+    def test_read_only(self):
+        """Runtime processes don't write snapshots."""
+        WSDLSnapshotCache(self.wsdl_file).put('x', {'a': 1})
+        ok_(not os.path.exists(self.snapshot_file))
+
+    @patch('news.backends.exacttarget.Client')
+    @patch('news.backends.exacttarget.wsdl_path')
+    def test_client_uses_snapshot(self, wsdl_path_mock, client_mock):
+        """make_client loads the WSDL from a valid snapshot."""
+        wsdl_path_mock.return_value = self.wsdl_file
+        make_client('user', 'pass')
+        ok_('cache' not in client_mock.call_args[1])
+
+        WSDLSnapshotCache(self.wsdl_file, writable=True).put('x', {'a': 1})
+        make_client('user', 'pass')
+        kwargs = client_mock.call_args[1]
+        eq_(self.snapshot_file, kwargs['cache'].snapshot_file)
+        eq_(1, kwargs['cachingpolicy'])
+
+    @patch('news.backends.exacttarget.Client')
+    @patch('suds.client.ObjectCache')
+    def test_client_uses_django_cache(self, object_cache, client_mock):
+        """Every client made, including the snapshot's, uses Django's
+        cache instead of suds' temp files"""
+        import suds.client
+        make_client('user', 'pass',
+                    cache=WSDLSnapshotCache(self.wsdl_file, writable=True))
+        ok_(suds.client.ObjectCache is SudsDjangoCache)
+
+
+class Result(object):
+    """Stand-in for a suds result object; unset attributes don't exist."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestAddRecords(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.ext = ExactTargetDataExt('user', 'pass', self.client)
+
+    def test_one_call_per_batch(self):
+        """Rows are packed into as few Update calls as the limit allows."""
+        self.client.service.Update.side_effect = [
+            Result(OverallStatus='OK', Results=[Result(StatusCode='OK')] * 2),
+            Result(OverallStatus='OK', Results=[Result(StatusCode='OK')]),
+        ]
+        rows = [['t1', 'e1'], ['t2', 'e2'], ['t3', 'e3']]
+        with patch('news.backends.exacttarget.ET_BATCH_SIZE', 2):
+            errors = self.ext.add_records('DATA', ['TOKEN', 'EMAIL'], rows)
+        eq_([None, None, None], errors)
+        calls = self.client.service.Update.call_args_list
+        eq_(2, len(calls))
+        eq_(2, len(calls[0][0][1]))
+        eq_(1, len(calls[1][0][1]))
+
+    def test_per_row_errors(self):
+        """Errors are reported against the rows they belong to."""
+        self.client.service.Update.return_value = Result(
+            OverallStatus='Has Errors',
+            Results=[
+                Result(StatusCode='Error', StatusMessage='Bad email',
+                       OrdinalID=1),
+                Result(StatusCode='OK', StatusMessage='Updated',
+                       OrdinalID=0),
+            ])
+        errors = self.ext.add_records('DATA', ['TOKEN', 'EMAIL'],
+                                      [['t1', 'e1'], ['t2', 'bad']])
+        eq_([None, 'Bad email'], errors)
+
+    def test_call_failed(self):
+        """A call that fails as a whole raises."""
+        self.client.service.Update.return_value = Result(
+            OverallStatus='Error', Results=[])
+        with self.assertRaises(NewsletterException):
+            self.ext.add_records('DATA', ['TOKEN'], [['t1']])
+
+
+def retrieve_result(**props):
+    return Result(Properties=Result(Property=[
+        Result(Name=name, Value=value) for name, value in props.items()]))
+
+
+class TestGetRecords(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.factory.create.side_effect = lambda name: Mock()
+        self.ext = ExactTargetDataExt('user', 'pass', self.client)
+
+    def test_in_filter_batches(self):
+        """Keys are looked up in batches with an IN filter."""
+        self.client.service.Retrieve.side_effect = [
+            Result(OverallStatus='OK', Results=[
+                retrieve_result(TOKEN='t1', EMAIL='e1'),
+                retrieve_result(TOKEN='t2', EMAIL='e2'),
+            ]),
+            Result(OverallStatus='OK', Results=[]),
+        ]
+        with patch('news.backends.exacttarget.ET_FILTER_BATCH_SIZE', 2):
+            records = self.ext.get_records('DATA', ['t1', 't2', 't3'],
+                                           ['EMAIL'])
+        eq_({'t1': {'TOKEN': 't1', 'EMAIL': 'e1'},
+             't2': {'TOKEN': 't2', 'EMAIL': 'e2'}}, records)
+        calls = self.client.service.Retrieve.call_args_list
+        eq_(2, len(calls))
+        first_req = calls[0][0][0]
+        eq_('IN', first_req.Filter.SimpleOperator)
+        eq_(['EMAIL', 'TOKEN'], first_req.Properties)
+
+    def test_continue_request(self):
+        """More results are fetched while ET has more data available."""
+        self.client.service.Retrieve.side_effect = [
+            Result(OverallStatus='MoreDataAvailable', RequestID='REQ1',
+                   Results=[retrieve_result(TOKEN='t1')]),
+            Result(OverallStatus='OK', RequestID='REQ2',
+                   Results=[retrieve_result(TOKEN='t2')]),
+        ]
+        records = self.ext.get_records('DATA', ['t1', 't2'], ['TOKEN'])
+        eq_(set(['t1', 't2']), set(records))
+        last_req = self.client.service.Retrieve.call_args[0][0]
+        eq_('REQ1', last_req.ContinueRequest)
+
+    def test_error(self):
+        """An error status raises."""
+        self.client.service.Retrieve.return_value = Result(
+            OverallStatus='Error: something broke')
+        with self.assertRaises(NewsletterException):
+            self.ext.get_records('DATA', ['t1'], ['TOKEN'])
+
+
+class TestGetRecord(TestCase):
+    def test_no_results(self):
+        """A lookup that finds nothing raises NewsletterNoResultsException"""
+        client = Mock()
+        client.factory.create.side_effect = lambda name: Mock()
+        client.service.Retrieve.return_value = Result(OverallStatus='OK',
+                                                      Results=[])
+        ext = ExactTargetDataExt('user', 'pass', client)
+        with self.assertRaises(NewsletterNoResultsException):
+            ext.get_record('DATA', 'token', ['TOKEN'])
+
+
+class TestTriggerSends(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.factory.create.side_effect = lambda name: Mock()
+        self.et = ExactTarget('user', 'pass', self.client)
+
+    def fields(self, token):
+        return {
+            'EMAIL_ADDRESS_': '%s@example.com' % token,
+            'TOKEN': token,
+            'EMAIL_FORMAT_': 'H',
+        }
+
+    def test_grouped_by_definition(self):
+        """One TriggeredSend per definition, all in one Create call."""
+        self.client.service.Create.return_value = Result(
+            OverallStatus='OK',
+            Results=[Result(StatusCode='OK'), Result(StatusCode='OK')])
+        sends = [('WELCOME', self.fields('t1')),
+                 ('OTHER', self.fields('t2')),
+                 ('WELCOME', self.fields('t3'))]
+        errors = self.et.trigger_sends(sends)
+        eq_([None, None, None], errors)
+        eq_(1, self.client.service.Create.call_count)
+        objs = self.client.service.Create.call_args[0][1]
+        eq_(2, len(objs))
+        eq_('WELCOME', objs[0].TriggeredSendDefinition.CustomerKey)
+        eq_(2, len(objs[0].Subscribers))
+        eq_(1, len(objs[1].Subscribers))
+        # The caller's dicts are left alone
+        ok_('EMAIL_ADDRESS_' in sends[0][1])
+
+    def test_subscriber_failure(self):
+        """A bad subscriber only fails its own send."""
+        self.client.service.Create.return_value = Result(
+            OverallStatus='Has Errors',
+            Results=[Result(
+                StatusCode='Error', StatusMessage='Has subscriber errors',
+                OrdinalID=0,
+                SubscriberFailures=[Result(
+                    Subscriber=Result(SubscriberKey='t2'),
+                    ErrorCode='24', ErrorDescription='Invalid email')])])
+        errors = self.et.trigger_sends([('WELCOME', self.fields('t1')),
+                                        ('WELCOME', self.fields('t2'))])
+        eq_([None, 'Invalid email'], errors)
+
+    def test_subscriber_failure_without_error(self):
+        """A subscriber failure without an error code or description
+        fails with the send's error."""
+        self.client.service.Create.return_value = Result(
+            OverallStatus='Has Errors',
+            Results=[Result(
+                StatusCode='Error', StatusMessage='Has subscriber errors',
+                OrdinalID=0,
+                SubscriberFailures=[Result(
+                    Subscriber=Result(SubscriberKey='t2'))])])
+        errors = self.et.trigger_sends([('WELCOME', self.fields('t1')),
+                                        ('WELCOME', self.fields('t2'))])
+        eq_([None, 'Has subscriber errors'], errors)
+
+    def test_definition_failure(self):
+        """A bad definition fails all its sends."""
+        self.client.service.Create.return_value = Result(
+            OverallStatus='Has Errors',
+            Results=[
+                Result(StatusCode='Error', StatusMessage='Invalid Customer Key',
+                       OrdinalID=0),
+                Result(StatusCode='OK', OrdinalID=1),
+            ])
+        errors = self.et.trigger_sends([('BAD', self.fields('t1')),
+                                        ('GOOD', self.fields('t2')),
+                                        ('BAD', self.fields('t3'))])
+        eq_(['Invalid Customer Key', None, 'Invalid Customer Key'], errors)
+
+    def test_no_result(self):
+        """A send ET returns no result for isn't reported as sent."""
+        self.client.service.Create.return_value = Result(
+            OverallStatus='OK',
+            Results=[Result(StatusCode='OK', OrdinalID=0)])
+        errors = self.et.trigger_sends([('WELCOME', self.fields('t1')),
+                                        ('OTHER', self.fields('t2'))])
+        eq_(None, errors[0])
+        ok_(errors[1])
+
+
+class TestClientPool(TestCase):
+    def test_exclusive(self):
+        """A client is only handed to one caller at a time"""
+        pool = ClientPool(Mock, 2, 0.05)
+        first, second = pool.checkout(), pool.checkout()
+        ok_(first is not second)
+        with self.assertRaises(NewsletterException):
+            pool.checkout()
+        pool.checkin(first)
+        ok_(pool.checkout() is first)
+
+    def test_logged_in_checks_in(self):
+        """Objects without a client borrow one for each call"""
+        pool = ClientPool(Mock, 1, 0.05)
+        ext = ExactTargetDataExt('user', 'pass')
+        with patch('news.backends.exacttarget.client_pool',
+                   return_value=pool):
+            with patch.object(ExactTargetDataExt, 'add_record',
+                              logged_in(lambda inst: inst.client)):
+                client = ext.add_record()
+                eq_(client, ext.add_record())
+        eq_([client], pool.idle)
+        eq_(None, ext.client)
+
+    @patch('news.backends.exacttarget.make_client')
+    @patch('news.backends.exacttarget.os')
+    def test_pools_per_process(self, os, make_client):
+        """A forked process doesn't use its parent's clients"""
+        clear_client_pools()
+        self.addCleanup(clear_client_pools)
+        os.getpid.return_value = 1
+        parent = client_pool('user', 'pass')
+        ok_(parent is client_pool('user', 'pass'))
+        os.getpid.return_value = 2
+        ok_(parent is not client_pool('user', 'pass'))
+
+    def stress(self, server, size, threads=8, calls=2):
+        """
+        Have `threads` threads make `calls` lookups each through a pool
+        of `size` clients, and return the most clients that were checked
+        out at once. The server holds the first calls until as many as
+        the pool allows have arrived, so they overlap for sure.
+        """
+        pool = CountingPool(Mock, size, 10)
+        for client in pool.idle:
+            client.options.location = server.url
+            client.options.transport = PooledHttpTransport(timeout=5)
+
+        lock = threading.Lock()
+        arrived = []
+        all_in = threading.Event()
+        handle = server.call
+
+        def call(action, request):
+            with lock:
+                arrived.append(action)
+                if len(arrived) >= min(size, threads):
+                    all_in.set()
+            all_in.wait(5)
+            return handle(action, request)
+        server.call = call
+
+        found = []
+
+        def lookups(token):
+            ext = ExactTargetDataExt('user', 'pass')
+            ext.fast_soap = True
+            for i in range(calls):
+                found.append(ext.get_record('DATA', token, ['TOKEN']))
+
+        with patch('news.backends.exacttarget.client_pool',
+                   return_value=pool):
+            # Different rows, or the lookups would share ET calls
+            workers = [threading.Thread(target=lookups, args=('t%d' % i,))
+                       for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        server.call = handle
+        eq_(threads * calls, len(found))
+        ok_(all_in.is_set())
+        return pool.peak
+
+    def test_scales(self):
+        """Threads make ET calls in parallel, up to the pool size"""
+        server = FakeExactTarget().start()
+        server.add_rows('DATA', [{'TOKEN': 't%d' % i} for i in range(8)])
+        try:
+            eq_(1, self.stress(server, size=1))
+            eq_(4, self.stress(server, size=4))
+            eq_(8, self.stress(server, size=8))
+        finally:
+            clear_pools()
+            server.stop()
+
+
+class CountingPool(ClientPool):
+    """A ClientPool that counts the most clients out at once"""
+    def __init__(self, *args):
+        super(CountingPool, self).__init__(*args)
+        self.out = 0
+        self.peak = 0
+
+    def checkout(self):
+        client = super(CountingPool, self).checkout()
+        with self.condition:
+            self.out += 1
+            self.peak = max(self.peak, self.out)
+        return client
+
+    def checkin(self, client):
+        with self.condition:
+            self.out -= 1
+        super(CountingPool, self).checkin(client)
+
+
+def watch_waiters(flight_obj, key, count):
+    """
+    Return an Event that is set once ``count`` callers wait for the call
+    with ``key`` that is in flight in ``flight_obj``, and the list of
+    timeouts they wait with.
+    """
+    with flight_obj.lock:
+        flight = flight_obj.flights[key]
+    all_waiting = threading.Event()
+    waiting = []
+    lock = threading.Lock()
+    wait = flight.done.wait
+
+    def counted_wait(timeout=None):
+        with lock:
+            waiting.append(timeout)
+            if len(waiting) >= count:
+                all_waiting.set()
+        return wait(timeout)
+    flight.done.wait = counted_wait
+    return all_waiting, waiting
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.flight = SingleFlight('test', wait=2)
+        self.calls = 0
+        self.lock = threading.Condition()
+        self.release = threading.Event()
+
+    def slow(self, value):
+        with self.lock:
+            self.calls += 1
+            self.lock.notify_all()
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def wait_for_calls(self, count):
+        with self.lock:
+            deadline = time.time() + 5
+            while self.calls < count and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+        eq_(count, self.calls)
+
+    def run_threads(self, n, key, value, shared=True):
+        """
+        Run n calls with the same key: one that leads, and, once it's
+        making its call, n - 1 that come while it's in flight. With
+        ``shared``, the leader's call is only let finish once they all
+        wait for it; otherwise once they all made their own.
+        """
+        outcomes = []
+
+        def run():
+            try:
+                outcomes.append(self.flight.do(key, self.slow, value))
+            except Exception, e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(n)]
+        threads[0].start()
+        self.wait_for_calls(1)
+        all_waiting, self.timeouts = watch_waiters(self.flight, key, n - 1)
+        for t in threads[1:]:
+            t.start()
+        if shared:
+            ok_(all_waiting.wait(5))
+        else:
+            self.wait_for_calls(n)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return outcomes
+
+    def test_shares_result(self):
+        """Concurrent calls with the same key make one call"""
+        eq_(['x'] * 5, self.run_threads(5, 'key', 'x'))
+        eq_(1, self.calls)
+        eq_({}, self.flight.flights)
+
+    def test_shares_error(self):
+        error = NewsletterException('nope')
+        outcomes = self.run_threads(3, 'key', error)
+        eq_([error] * 3, outcomes)
+        eq_(1, self.calls)
+
+    def test_different_keys(self):
+        self.release.set()
+        eq_('a', self.flight.do('a', self.slow, 'a'))
+        eq_('b', self.flight.do('b', self.slow, 'b'))
+        eq_(2, self.calls)
+
+    def test_wait_in_vain(self):
+        """Callers that wait too long make the call themselves"""
+        self.flight.wait = 0.01
+        eq_(['x'] * 3, self.run_threads(3, 'key', 'x', shared=False))
+        eq_(3, self.calls)
+
+    def test_waits_out_the_leader(self):
+        """Lookups wait for a leader that's slow as a call can be: one
+        that waited for a client, then took ET_TIMEOUT to connect and
+        again to read"""
+        self.flight = single_flight
+        eq_(['x', 'x'], self.run_threads(2, 'key', 'x'))
+        eq_(1, self.calls)
+        timeout, = self.timeouts
+        ok_(timeout >= ET_CLIENT_POOL_WAIT + ET_TIMEOUT * 2, timeout)
+
+    def test_shared(self):
+        """Other processes' calls are waited for through the cache"""
+        self.flight.shared = True
+        self.release.set()
+        cache.add(self.flight.cache_key('key', 'lock'), True)
+
+        def other_process():
+            time.sleep(0.1)
+            cache.set(self.flight.cache_key('key', 'result'), (True, 'x'))
+
+        t = threading.Thread(target=other_process)
+        t.start()
+        eq_('x', self.flight.do('key', self.slow, 'y'))
+        t.join()
+        eq_(0, self.calls)
+
+    def test_shared_error(self):
+        self.flight.shared = True
+        self.release.set()
+        with self.assertRaises(NewsletterException):
+            self.flight.do('key', self.slow, NewsletterException('nope'))
+        ok_(not cache.get(self.flight.cache_key('key', 'lock')))
+        called_ok, value = cache.get(self.flight.cache_key('key', 'result'))
+        eq_(False, called_ok)
+        eq_('nope', str(value))
+
+    def test_shared_lock_released(self):
+        """If the other process lets go without an outcome, call ET"""
+        self.flight.shared = True
+        self.release.set()
+        lock_key = self.flight.cache_key('key', 'lock')
+        cache.add(lock_key, True)
+        threading.Timer(0.1, cache.delete, [lock_key]).start()
+        eq_('y', self.flight.do('key', self.slow, 'y'))
+        eq_(1, self.calls)
+
+    def test_get_record(self):
+        """Concurrent lookups of the same row make one ET call"""
+        server = FakeExactTarget().start()
+        self.addCleanup(server.stop)
+        self.addCleanup(clear_pools)
+        server.add_rows('DATA', [{'TOKEN': 'tok', 'COUNTRY_': 'de'}])
+        client = Mock()
+        client.options.location = server.url
+        client.options.transport = PooledHttpTransport(timeout=5)
+        records = []
+
+        # Hold the first call until the other lookups wait for it
+        leading = threading.Event()
+        proceed = threading.Event()
+        handle = server.call
+
+        def call(action, request):
+            leading.set()
+            proceed.wait(5)
+            return handle(action, request)
+        server.call = call
+
+        def lookup():
+            ext = ExactTargetDataExt('user', 'pass', client)
+            ext.fast_soap = True
+            records.append(ext.get_record('DATA', 'tok', ['COUNTRY_']))
+
+        threads = [threading.Thread(target=lookup) for i in range(4)]
+        threads[0].start()
+        ok_(leading.wait(5))
+        with single_flight.lock:
+            key, = single_flight.flights.keys()
+        all_waiting = watch_waiters(single_flight, key, 3)[0]
+        for t in threads[1:]:
+            t.start()
+        ok_(all_waiting.wait(5))
+        proceed.set()
+        for t in threads:
+            t.join()
+        eq_([{'COUNTRY_': 'de'}] * 4, records)
+        eq_(1, server.calls['Retrieve'])
+        # Copies, so callers can't change each other's results
+        records[0]['COUNTRY_'] = 'fr'
+        eq_('de', records[1]['COUNTRY_'])
+
+    def test_write_in_between(self):
+        """A lookup that comes after a write of the row doesn't share
+        the call of one that started before it"""
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def get_record(data_id, token, fields, field):
+            if not started.is_set():
+                started.set()
+                release.wait(5)
+                return {'COUNTRY_': 'before'}
+            return {'COUNTRY_': 'after'}
+
+        def lookup():
+            ext = ExactTargetDataExt('user', 'pass')
+            return ext.get_record('DATA', 'tok', ['COUNTRY_'])
+
+        with patch.object(ExactTargetDataExt, '_get_record',
+                          side_effect=get_record):
+            first = threading.Thread(target=lambda: results.append(lookup()))
+            first.start()
+            started.wait(5)
+            forget_user_data('tok')
+            eq_({'COUNTRY_': 'after'}, lookup())
+            release.set()
+            first.join()
+        eq_([{'COUNTRY_': 'before'}], results)
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        patcher = patch('news.backends.exacttarget.time')
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.time.time.return_value = 1000
+        self.breaker = CircuitBreaker('test', window=60, min_calls=4,
+                                      error_rate=0.5, slow_call=2,
+                                      open_seconds=30)
+        self.breaker.reset()
+
+    def calls(self, *outcomes):
+        """Record calls; each outcome is (ok, elapsed)"""
+        for ok, elapsed in outcomes:
+            self.breaker.after_call(self.breaker.before_call(), ok, elapsed)
+
+    def test_trips_on_errors(self):
+        self.calls((True, 0.1), (False, 3), (True, 0.1))
+        ok_(not self.breaker.is_open())
+        self.calls((False, 3))
+        ok_(self.breaker.is_open())
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+
+    def test_trips_on_slow_calls(self):
+        """Calls that got an answer, but slowly, count against ET too"""
+        self.calls((True, 0.1), (True, 2.5), (True, 0.1), (True, 2.5))
+        ok_(self.breaker.is_open())
+
+    def test_min_calls(self):
+        """A few failures in a quiet window don't trip the breaker"""
+        self.calls((False, 3), (False, 3), (False, 3))
+        ok_(not self.breaker.is_open())
+
+    def test_half_open(self):
+        """After a while one probe is let through, and closes it if OK"""
+        self.breaker.trip()
+        self.time.time.return_value = 1031
+        ok_(not self.breaker.is_open())
+        probe = self.breaker.before_call()
+        ok_(probe)
+        # Only one probe at a time
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+        self.breaker.after_call(probe, True, 0.1)
+        eq_(False, self.breaker.before_call())
+
+    def test_failed_probe(self):
+        """A failed probe keeps the breaker open for another period"""
+        self.breaker.trip()
+        self.time.time.return_value = 1031
+        self.breaker.after_call(self.breaker.before_call(), False, 3)
+        ok_(self.breaker.is_open())
+        self.time.time.return_value = 1060
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_call()
+
+
+class TestLoggedInBreaker(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', window=60, min_calls=2,
+                                      error_rate=0.5, slow_call=2,
+                                      open_seconds=30)
+        self.breaker.reset()
+        self.client = Mock()
+        self.client.factory.create.side_effect = lambda name: Mock()
+        self.ext = ExactTargetDataExt('user', 'pass', self.client)
+
+    def test_fails_fast(self):
+        """Once ET keeps failing, calls fail without going to ET"""
+        self.client.service.Retrieve.side_effect = URLError('timed out')
+        with patch('news.backends.exacttarget.breaker', self.breaker):
+            for i in range(2):
+                with self.assertRaises(URLError):
+                    self.ext.get_record('DATA', 'token', ['TOKEN'])
+            with self.assertRaises(CircuitOpen):
+                self.ext.get_record('DATA', 'token', ['TOKEN'])
+        eq_(2, self.client.service.Retrieve.call_count)
+
+    def test_et_errors_are_answers(self):
+        """Errors reported by ET mean it's up"""
+        self.client.service.Retrieve.return_value = Result(
+            OverallStatus='Error: bad filter')
+        with patch('news.backends.exacttarget.breaker', self.breaker):
+            for i in range(3):
+                with self.assertRaises(NewsletterException):
+                    self.ext.get_record('DATA', 'token', ['TOKEN'])
+        ok_(not self.breaker.is_open())
+
+    def test_pool_wait_not_timed(self):
+        """Waiting for a client from the pool doesn't count against ET"""
+        pool = ClientPool(Mock, 1, 1)
+        checkout = pool.checkout
+
+        def slow_checkout():
+            time.sleep(0.2)
+            return checkout()
+        pool.checkout = slow_checkout
+        ext = ExactTargetDataExt('user', 'pass')
+        with patch('news.backends.exacttarget.client_pool',
+                   return_value=pool):
+            with patch('news.backends.exacttarget.breaker') as breaker:
+                breaker.before_call.return_value = False
+                with patch.object(ExactTargetDataExt, 'add_record',
+                                  logged_in(lambda inst: None)):
+                    ext.add_record()
+        probe, ok, elapsed = breaker.after_call.call_args[0]
+        ok_(ok)
+        ok_(elapsed < 0.2, elapsed)
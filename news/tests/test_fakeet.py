@@ -0,0 +1,100 @@
+from django.test import TestCase
+
+from mock import Mock
+from nose.tools import eq_, ok_
+
+from news.backends import soapcodec
+from news.backends.common import NewsletterException
+from news.backends.exacttarget import ExactTarget, ExactTargetDataExt
+from news.backends.fakeet import FakeExactTarget
+from news.backends.transport import PooledHttpTransport, clear_pools
+
+
+class TestFakeExactTarget(TestCase):
+    def setUp(self):
+        self.server = FakeExactTarget(page_size=2).start()
+        self.addCleanup(self.server.stop)
+        self.addCleanup(clear_pools)
+        client = Mock()
+        client.options.location = self.server.url
+        client.options.transport = PooledHttpTransport(timeout=5)
+        self.client = client
+        self.ext = ExactTargetDataExt('user', 'pass', client)
+        self.ext.fast_soap = True
+
+    def retrieve(self, body):
+        return soapcodec.call(self.client, 'user', 'pass', 'Retrieve', body)
+
+    def test_round_trip(self):
+        """Rows added with Update come back from Retrieve"""
+        self.ext.add_record('DATA', ['TOKEN', 'EMAIL_ADDRESS_'],
+                            ['tok', 'a@example.com'])
+        self.ext.add_record('DATA', ['TOKEN', 'COUNTRY_'], ['tok', 'de'])
+        record = self.ext.get_record('DATA', 'tok',
+                                     ['EMAIL_ADDRESS_', 'COUNTRY_'])
+        eq_({'EMAIL_ADDRESS_': 'a@example.com', 'COUNTRY_': 'de'}, record)
+        eq_(2, self.server.calls['Update'])
+
+    def test_non_ascii(self):
+        """Replies are sent as UTF-8 with their length in bytes"""
+        self.ext.add_record('DATA', ['TOKEN', 'CITY'], ['tok', u'M\xfcnchen'])
+        record = self.ext.get_record('DATA', 'tok', ['CITY'])
+        eq_({'CITY': u'M\xfcnchen'}, record)
+
+    def test_no_results(self):
+        with self.assertRaises(NewsletterException):
+            self.ext.get_record('DATA', 'nope', ['TOKEN'])
+
+    def test_trigger_send(self):
+        et = ExactTarget('user', 'pass', self.client)
+        et.fast_soap = True
+        et.trigger_send('WELCOME', {'EMAIL_ADDRESS_': 'a@example.com',
+                                    'TOKEN': 'tok', 'EMAIL_FORMAT_': 'H'})
+        eq_(1, len(self.server.sends))
+        send = self.server.sends[0]
+        eq_('WELCOME', send['definition'])
+        eq_('a@example.com', send['email'])
+        eq_('tok', send['attributes']['TOKEN'])
+
+    def test_paging(self):
+        """Retrieve replies hold page_size rows; the rest are continued"""
+        self.server.add_rows('DATA', [{'TOKEN': str(i)} for i in range(3)])
+        body = soapcodec.retrieve_request(
+            'DataExtensionObject[DATA]', ['TOKEN'], 'TOKEN', 'IN',
+            ['0', '1', '2'])
+        first = self.retrieve(body)
+        eq_('MoreDataAvailable', first.OverallStatus)
+        eq_(2, len(first.Results))
+        rest = self.retrieve(
+            '<ns0:RetrieveRequestMsg><ns0:RetrieveRequest>'
+            '<ns0:ContinueRequest>%s</ns0:ContinueRequest>'
+            '</ns0:RetrieveRequest></ns0:RetrieveRequestMsg>'
+            % first.RequestID)
+        eq_('OK', rest.OverallStatus)
+        eq_(1, len(rest.Results))
+
+    def test_delete(self):
+        self.server.add_rows('DATA', [{'TOKEN': 'a'}, {'TOKEN': 'b'}])
+        soapcodec.call(self.client, 'user', 'pass', 'Delete',
+                       '<ns0:DeleteRequest><ns0:Objects '
+                       'xsi:type="ns0:DataExtensionObject">'
+                       '<ns0:CustomerKey>DATA</ns0:CustomerKey><ns0:Keys>'
+                       '<ns0:Key><ns0:Name>TOKEN</ns0:Name>'
+                       '<ns0:Value>a</ns0:Value></ns0:Key></ns0:Keys>'
+                       '</ns0:Objects></ns0:DeleteRequest>')
+        eq_([{'TOKEN': 'b'}], self.server.rows('DATA'))
+
+    def test_errors(self):
+        """Injected errors are SOAP faults"""
+        self.server.error_rate = 1
+        with self.assertRaises(NewsletterException) as cm:
+            self.ext.add_record('DATA', ['TOKEN'], ['tok'])
+        ok_('unable to process' in str(cm.exception))
+        eq_([], self.server.rows('DATA'))
+
+    def test_throttling(self):
+        """Calls over max_concurrent are refused"""
+        self.server.max_concurrent = 0
+        with self.assertRaises(NewsletterException) as cm:
+            self.ext.get_record('DATA', 'tok', ['TOKEN'])
+        ok_('Throttled' in str(cm.exception))
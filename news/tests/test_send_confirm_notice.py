@@ -3,7 +3,8 @@ from django.test import TestCase
 from mock import patch
 
 from news.models import Newsletter
-from news.tasks import CONFIRMATION_MESSAGE, BasketError, mogrify_message_id, send_confirm_notice
+from news.newsletters import CONFIRMATION_MESSAGE
+from news.tasks import BasketError, mogrify_message_id, send_confirm_notice
 
 
 @patch('news.tasks.send_message', autospec=True)
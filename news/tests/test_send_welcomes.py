@@ -1,11 +1,15 @@
+import cPickle as pickle
+
 from django.test import TestCase
 
 from mock import patch
+from nose.tools import eq_
 
 from news.backends.common import NewsletterException
 from news.models import Newsletter
+from news.newsletters import FFAY_VENDOR_ID, FFOS_VENDOR_ID, message_router
 from news.tasks import BasketError, confirm_user, mogrify_message_id, \
-    send_message
+    send_message, send_messages, send_welcomes
 
 
 class TestSendMessage(TestCase):
@@ -24,6 +28,37 @@ class TestSendMessage(TestCase):
         send_message(message_id, 'email', 'token', 'format')
 
 
+class TestSendMessages(TestCase):
+    @patch('news.tasks.ExactTarget')
+    def test_batched_errors(self, mock_ExactTarget):
+        """Several messages go out in one call, with errors per message"""
+        mock_et = mock_ExactTarget()
+        mock_et.trigger_sends.return_value = [
+            None,
+            'Invalid Customer Key',
+            'Temporary failure',
+        ]
+        results = send_messages([
+            ('GOOD', 'email', 'token', 'H'),
+            ('BATCH_BAD_ID', 'email', 'token', 'H'),
+            ('FLAKY', 'email', 'token', 'H'),
+        ])
+        self.assertEqual(1, mock_et.trigger_sends.call_count)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], BasketError)
+        self.assertIsInstance(results[2], NewsletterException)
+
+        # The bad message ID is remembered and skipped from now on
+        mock_et.trigger_sends.reset_mock()
+        results = send_messages([
+            ('BATCH_BAD_ID', 'email', 'token', 'H'),
+            ('GOOD', 'email', 'token', 'H'),
+        ])
+        self.assertEqual([None, None], results)
+        sends = mock_et.trigger_sends.call_args[0][0]
+        self.assertEqual(['GOOD'], [send[0] for send in sends])
+
+
 class TestSendWelcomes(TestCase):
 
     def test_mogrify_message_id_text(self):
@@ -234,3 +269,69 @@ class TestSendWelcomes(TestCase):
         confirm_user(token, user_data)
         expected_welcome = 'en_' + welcome
         send_message.assert_called_with(expected_welcome, email, token, format)
+
+    @patch('news.tasks.send_messages')
+    def test_no_queries(self, send_messages):
+        """Welcomes are worked out without going to the database"""
+        Newsletter.objects.create(slug='ffos', vendor_id=FFOS_VENDOR_ID,
+                                  welcome='FFOS_WELCOME', languages='en,de')
+        Newsletter.objects.create(slug='ffay', vendor_id=FFAY_VENDOR_ID,
+                                  welcome='FFAY_WELCOME', languages='en')
+        Newsletter.objects.create(slug='other', vendor_id='OTHER',
+                                  welcome='FFAY_WELCOME', languages='en')
+        send_messages.return_value = [None]
+        user_data = {'email': 'dude@example.com', 'token': 'TOKEN',
+                     'lang': 'de'}
+        message_router()
+        with self.assertNumQueries(0):
+            send_welcomes(user_data, ['ffos', 'ffay', 'other'], 'T')
+        # Firefox OS's welcome replaces Firefox & You's; the other
+        # newsletter only has English.
+        eq_(set([('de_FFOS_WELCOME_T', 'dude@example.com', 'TOKEN', 'T'),
+                 ('en_FFAY_WELCOME_T', 'dude@example.com', 'TOKEN', 'T')]),
+            set(send_messages.call_args[0][0]))
+
+    def test_shared_vendor_ids(self):
+        """Any Firefox OS newsletter replaces the welcomes of all the
+        Firefox & You ones"""
+        for slug, vendor_id in (('ffos', FFOS_VENDOR_ID),
+                                ('ffos2', FFOS_VENDOR_ID),
+                                ('ffay', FFAY_VENDOR_ID),
+                                ('ffay2', FFAY_VENDOR_ID)):
+            Newsletter.objects.create(slug=slug, vendor_id=vendor_id,
+                                      welcome=slug.upper(), languages='en')
+        router = message_router()
+        eq_(frozenset(['en_FFOS2']),
+            router.welcomes_for(['ffos2', 'ffay', 'ffay2'], 'en', 'H'))
+        eq_(frozenset(['en_FFOS', 'en_FFOS2']),
+            router.welcomes_for(['ffos', 'ffos2', 'ffay2'], 'en', 'H'))
+        eq_(frozenset(['en_FFAY', 'en_FFAY2']),
+            router.welcomes_for(['ffay', 'ffay2'], 'en', 'H'))
+
+    @patch('news.tasks.send_messages')
+    def test_retryable_error_wins(self, send_messages):
+        """A retryable failure is raised even after a fatal one, so the
+        task is retried"""
+        Newsletter.objects.create(slug='a', vendor_id='A', welcome='A_WEL',
+                                  languages='en')
+        Newsletter.objects.create(slug='b', vendor_id='B', welcome='B_WEL',
+                                  languages='en')
+        send_messages.return_value = [BasketError('bad'),
+                                      NewsletterException('flaky')]
+        user_data = {'email': 'dude@example.com', 'token': 'TOKEN',
+                     'lang': 'en'}
+        with self.assertRaises(NewsletterException):
+            send_welcomes(user_data, ['a', 'b'], 'H')
+
+    def test_routes_remembered(self):
+        Newsletter.objects.create(slug='slug', vendor_id='VENDOR',
+                                  welcome='welcome', languages='en')
+        router = message_router()
+        eq_(frozenset(['en_welcome']),
+            router.welcomes_for(['slug'], 'fr', 'H'))
+        eq_(1, len(router.routes))
+        eq_(frozenset(['en_welcome']),
+            router.welcomes_for(set(['slug']), 'fr', 'H'))
+        eq_(1, len(router.routes))
+        # Not pickled with the rest of the newsletter data
+        eq_({}, pickle.loads(pickle.dumps(router)).routes)
@@ -0,0 +1,133 @@
+from StringIO import StringIO
+from urllib2 import URLError
+
+from django.test import TestCase
+
+from mock import Mock
+from nose.tools import eq_, ok_
+from suds import WebFault
+from suds.transport import Reply, TransportError
+
+from news.backends import soapcodec
+from news.backends.common import NewsletterException, UnauthorizedException
+from news.backends.exacttarget import ExactTarget, ExactTargetDataExt, \
+    make_client, result_errors
+from news.backends.fakeet import FakeExactTarget
+from news.backends.transport import clear_pools
+from news.management.commands.benchmark_soap import ENVELOPE, REPLIES
+
+
+FAULT = ENVELOPE % ('<soap:Fault><faultcode>soap:Client</faultcode>'
+                    '<faultstring>Login Failed</faultstring></soap:Fault>')
+
+
+class TestEncode(TestCase):
+    def test_escaping(self):
+        """Values are escaped and None renders as an empty element"""
+        body = soapcodec.update_request(['DATA'], ['TOKEN', 'LANG', 'N'],
+                                        [u'a<b&c\xe9', None, 5])
+        ok_(u'<ns0:Value>a&lt;b&amp;c\xe9</ns0:Value>' in body)
+        ok_('<ns0:Name>LANG</ns0:Name><ns0:Value/>' in body)
+        ok_('<ns0:Value>5</ns0:Value>' in body)
+
+    def test_envelope_is_utf8(self):
+        xml = soapcodec.envelope('user', u'p\xe4ss', u'<ns0:X>\xfc</ns0:X>')
+        ok_(isinstance(xml, str))
+        ok_('<wsse:Password>p\xc3\xa4ss</wsse:Password>' in xml)
+
+    def test_subscriber(self):
+        xml = soapcodec.subscriber('a@example.com', {'TOKEN': 'tok',
+                                                     'EMAIL_FORMAT_': 'T'})
+        ok_(xml.startswith('<ns0:Subscribers><ns0:EmailAddress>'
+                           'a@example.com</ns0:EmailAddress>'))
+        ok_('<ns0:SubscriberKey>tok</ns0:SubscriberKey>'
+            '<ns0:EmailTypePreference>Text</ns0:EmailTypePreference>' in xml)
+
+
+class TestDecode(TestCase):
+    def test_retrieve(self):
+        obj = soapcodec.parse_response(REPLIES['Retrieve'])
+        eq_('OK', obj.OverallStatus)
+        eq_(1, len(obj.Results))
+        props = dict((p.Name, p.Value)
+                     for p in obj.Results[0].Properties.Property)
+        eq_('someone@example.com', props['EMAIL_ADDRESS_'])
+
+    def test_result_helpers(self):
+        """Decoded replies work with the helpers made for suds objects"""
+        obj = soapcodec.parse_response(ENVELOPE % (
+            '<UpdateResponse><Results><StatusCode>Error</StatusCode>'
+            '<StatusMessage>Bad</StatusMessage><OrdinalID>1</OrdinalID>'
+            '</Results><Results><StatusCode>OK</StatusCode>'
+            '<OrdinalID>0</OrdinalID></Results>'
+            '<OverallStatus>Has Errors</OverallStatus></UpdateResponse>'))
+        eq_([None, 'Bad'], result_errors(obj, 2))
+
+    def test_fault(self):
+        with self.assertRaises(WebFault) as cm:
+            soapcodec.parse_response(FAULT)
+        eq_('Login Failed', cm.exception.fault.faultstring)
+
+
+class TestFastPath(TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.client.options.location = 'https://et.example.com/Service.asmx'
+        self.send = self.client.options.transport.send
+
+    def test_get_record(self):
+        self.send.return_value = Reply(200, {}, REPLIES['Retrieve'])
+        ext = ExactTargetDataExt('user', 'pass', self.client)
+        ext.fast_soap = True
+        record = ext.get_record('DATA', 'tok', ['TOKEN', 'EMAIL_ADDRESS_'])
+        eq_('H', record['EMAIL_FORMAT_'])
+        request = self.send.call_args[0][0]
+        eq_('https://et.example.com/Service.asmx', request.url)
+        eq_('"Retrieve"', request.headers['SOAPAction'])
+        ok_('<ns0:ObjectType>DataExtensionObject[DATA]</ns0:ObjectType>'
+            in request.message)
+        ok_(not self.client.service.Retrieve.called)
+
+    def test_fault(self):
+        """Faults come with a 500 and are handled like suds' are"""
+        self.send.side_effect = TransportError('Error', 500,
+                                               StringIO(FAULT))
+        et = ExactTarget('user', 'pass', self.client)
+        et.fast_soap = True
+        fields = {'EMAIL_ADDRESS_': 'a@example.com', 'TOKEN': 'tok',
+                  'EMAIL_FORMAT_': 'H'}
+        with self.assertRaises(UnauthorizedException):
+            et.trigger_send('WELCOME', fields)
+
+    def test_http_error(self):
+        """Other error statuses raise a URLError, like a failed connection"""
+        self.send.side_effect = TransportError('Service Unavailable', 503,
+                                               StringIO('busy'))
+        ext = ExactTargetDataExt('user', 'pass', self.client)
+        ext.fast_soap = True
+        with self.assertRaises(URLError) as cm:
+            ext.add_record('DATA', ['TOKEN'], ['tok'])
+        eq_(503, cm.exception.code)
+
+
+class TestSameErrors(TestCase):
+    def setUp(self):
+        self.server = FakeExactTarget(error_rate=1).start()
+        self.addCleanup(self.server.stop)
+        self.addCleanup(clear_pools)
+        self.client = make_client('user', 'pass')
+        self.client.set_options(location=self.server.url)
+
+    def test_fault(self):
+        """A fault raises the same error with and without suds"""
+        errors = []
+        for fast_soap in (False, True):
+            ext = ExactTargetDataExt('user', 'pass', self.client)
+            ext.fast_soap = fast_soap
+            with self.assertRaises(NewsletterException) as cm:
+                ext.add_record('DATA', ['TOKEN'], ['tok'])
+            errors.append(cm.exception)
+        eq_(type(errors[0]), type(errors[1]))
+        for error in errors:
+            ok_('unable to process' in str(error), str(error))
+        eq_(2, self.server.calls['Update'])
@@ -1,11 +1,16 @@
 import celery
+from celery.exceptions import RetryTaskError
 from mock import Mock, patch
 
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from news.models import FailedTask, Subscriber
-from news.tasks import (RECOVERY_MESSAGE_ID, mogrify_message_id,
-    send_recovery_message_task, update_phonebook)
+from news.backends.common import CircuitOpen, NewsletterException
+from news.models import FailedTask, Newsletter, Subscriber
+from news.tasks import (RECOVERY_MESSAGE_ID, SUBSCRIBE, UNSUBSCRIBE,
+    UU_MUST_CONFIRM_NEW, StepJournal, confirm_user, mogrify_message_id,
+    send_recovery_message_task, update_phonebook, update_user)
 
 
 class FailedTaskTest(TestCase):
@@ -59,6 +64,7 @@ class RetryTaskTest(TestCase):
 class RecoveryMessageTask(TestCase):
     def setUp(self):
         self.email = "dude@example.com"
+        cache.clear()
 
     def test_unknown_email(self, mock_look_for_user, mock_send):
         """Email not in basket or ET"""
@@ -116,3 +122,209 @@ class RecoveryMessageTask(TestCase):
         message_id = mogrify_message_id(RECOVERY_MESSAGE_ID, lang, format)
         mock_send.assert_called_with(message_id, self.email,
                                      subscriber.token, format)
+
+
+class CircuitBreakerTaskTest(TestCase):
+    @patch('news.tasks.ExactTarget', autospec=True)
+    @patch('news.tasks.breaker')
+    def test_deferred_while_open(self, breaker, mock_exact_target):
+        """Tasks are queued again later without calling ET while ET is
+        down"""
+        breaker.is_open.return_value = True
+        breaker.open_seconds = 30
+        args = [{}, 'foo@example.com', 'token']
+        with patch.object(update_phonebook, 'apply_async') as apply_async:
+            update_phonebook.apply(args, task_id='task-1', retries=2)
+        apply_async.assert_called_with(args, {}, task_id='task-1',
+                                       retries=2, countdown=30)
+        self.assertFalse(mock_exact_target.called)
+
+    @patch('news.tasks.ExactTarget', autospec=True)
+    @patch('news.tasks.breaker')
+    def test_outage_longer_than_retries(self, breaker, mock_exact_target):
+        """An outage outlasting max_retries doesn't fail tasks"""
+        breaker.is_open.return_value = True
+        args = [{}, 'foo@example.com', 'token']
+        retries = 0
+        with patch.object(update_phonebook, 'apply_async') as apply_async:
+            for i in range(update_phonebook.max_retries + 2):
+                update_phonebook.apply(args, task_id='task-1',
+                                       retries=retries)
+                retries = apply_async.call_args[1]['retries']
+        self.assertEqual(update_phonebook.max_retries + 2,
+                         apply_async.call_count)
+        self.assertEqual(0, retries)
+        self.assertEqual(0, FailedTask.objects.count())
+        self.assertFalse(mock_exact_target.called)
+
+        # Once ET is back, the task runs
+        breaker.is_open.return_value = False
+        update_phonebook.apply(args, task_id='task-1', retries=retries)
+        self.assertTrue(mock_exact_target.called)
+
+    @patch('news.tasks.breaker')
+    def test_direct_call(self, breaker):
+        """A task called by another one leaves deferring to that one"""
+        breaker.is_open.return_value = True
+        with self.assertRaises(CircuitOpen):
+            update_phonebook({}, 'foo@example.com', 'token')
+
+
+@override_settings(TASK_DEDUPE_TIMEOUT=600)
+class TaskDedupeTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.args = ['token', {'status': 'ok', 'confirmed': False,
+                               'email': 'dude@example.com', 'token': 'token',
+                               'newsletters': []}]
+
+    def queued(self, task, args):
+        """Pretend the call is queued, as the worker won't run it here"""
+        cache.set(task.dedupe_key(args, {}), task.fingerprint(args, {}))
+
+    @patch('news.tasks.statsd')
+    @patch('news.tasks.apply_updates')
+    def test_duplicate_dropped(self, apply_updates, statsd):
+        """A call identical to one queued or running is dropped"""
+        self.queued(confirm_user, self.args)
+        self.assertEqual(None, confirm_user.delay(*self.args))
+        self.assertFalse(apply_updates.called)
+        statsd.incr.assert_called_with('news.tasks.confirm_user.duplicate')
+
+        # Once it's done, the same call can be made again
+        confirm_user.done(self.args, {})
+        confirm_user.delay(*self.args)
+        self.assertTrue(apply_updates.called)
+        self.assertEqual(None,
+                         cache.get(confirm_user.dedupe_key(self.args, {})))
+
+    def test_only_latest_call(self):
+        """Repeating an earlier call for the user, which a later one
+        undid, isn't a duplicate"""
+        subscribe = [{'newsletters': 'slug'}, 'dude@example.com', 'token',
+                     False, SUBSCRIBE, True]
+        unsubscribe = [{'newsletters': 'slug'}, 'dude@example.com', 'token',
+                       False, UNSUBSCRIBE, True]
+        # Both still queued
+        self.queued(update_user, subscribe)
+        self.queued(update_user, unsubscribe)
+        with patch('celery.task.Task.apply_async') as apply_async:
+            update_user.delay(*subscribe)
+            self.assertTrue(apply_async.called)
+            apply_async.reset_mock()
+            update_user.delay(*subscribe)
+            self.assertFalse(apply_async.called)
+
+    def test_created_ignored(self):
+        """A double submit that finds the user the first one created is
+        still a duplicate"""
+        first = [{'newsletters': 'slug'}, 'dude@example.com', 'token',
+                 True, SUBSCRIBE, True]
+        again = [{'newsletters': 'slug'}, 'dude@example.com', 'token',
+                 False, SUBSCRIBE, True]
+        self.queued(update_user, first)
+        with patch('celery.task.Task.apply_async') as apply_async:
+            update_user.delay(*again)
+            self.assertFalse(apply_async.called)
+        # And it finishing lets both be queued again
+        update_user.done(again, {})
+        self.assertEqual(None, cache.get(update_user.dedupe_key(first, {})))
+
+    @override_settings(TASK_DEDUPE_TIMEOUT=0)
+    def test_off(self):
+        """With no timeout, nothing is dropped"""
+        self.queued(confirm_user, self.args)
+        with patch('celery.task.Task.apply_async') as apply_async:
+            confirm_user.delay(*self.args)
+            self.assertTrue(apply_async.called)
+
+    @patch('news.tasks.apply_updates')
+    def test_retry_not_dropped(self, apply_updates):
+        """A call that will be retried lets the retry be queued"""
+        apply_updates.side_effect = NewsletterException('down')
+        key = confirm_user.dedupe_key(self.args, {})
+        self.queued(confirm_user, self.args)
+
+        at_retry = []
+
+        def retry(exc):
+            at_retry.append(cache.get(key))
+            raise RetryTaskError
+
+        with patch.object(confirm_user, 'retry', side_effect=retry):
+            confirm_user.apply(self.args)
+        self.assertEqual([None], at_retry)
+
+    @patch('news.tasks.apply_updates')
+    def test_direct_call(self, apply_updates):
+        """A call not made through the queue, e.g. from another task,
+        doesn't let an identical queued one be queued again"""
+        self.queued(confirm_user, self.args)
+        confirm_user(*self.args)
+        self.assertTrue(apply_updates.called)
+        self.assertEqual(confirm_user.fingerprint(self.args, {}),
+                         cache.get(confirm_user.dedupe_key(self.args, {})))
+
+    @patch('news.tasks.ExactTarget', autospec=True)
+    def test_other_tasks(self, mock_exact_target):
+        """Only tasks that ask for it are deduplicated"""
+        args = [{}, 'foo@example.com', 'token']
+        self.queued(update_phonebook, args)
+        update_phonebook.delay(*args)
+        self.assertTrue(mock_exact_target.called)
+
+
+class StepJournalTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        Newsletter.objects.create(slug='slug', vendor_id='VEND',
+                                  languages='en', requires_double_optin=True)
+        self.args = [{'newsletters': 'slug', 'lang': 'en'},
+                     'dude@example.com', 'token', True, SUBSCRIBE, False]
+
+    @patch('news.views.get_user_data')
+    @patch('news.tasks.ExactTarget')
+    def test_retry_skips_done_steps(self, et_mock, get_user_data):
+        """A retry doesn't repeat the lookup and write its first try made"""
+        et = et_mock()
+        get_user_data.return_value = None
+        et.trigger_send.side_effect = NewsletterException('timed out')
+        with patch.object(update_user, 'retry',
+                          side_effect=RetryTaskError) as retry:
+            update_user.apply(self.args, task_id='task-1')
+        self.assertTrue(retry.called)
+        self.assertEqual(1, et.data_ext().add_record.call_count)
+
+        et.trigger_send.side_effect = None
+        result = update_user.apply(self.args, task_id='task-1')
+        self.assertEqual(UU_MUST_CONFIRM_NEW, result.get())
+        self.assertEqual(1, get_user_data.call_count)
+        self.assertEqual(1, et.data_ext().add_record.call_count)
+        self.assertEqual(2, et.trigger_send.call_count)
+        # Done with it
+        self.assertEqual(None, cache.get('task_journal:task-1'))
+
+    @patch('news.views.get_user_data')
+    @patch('news.tasks.ExactTarget')
+    def test_other_tasks_unaffected(self, et_mock, get_user_data):
+        """Another task with the same arguments does everything again"""
+        et = et_mock()
+        get_user_data.return_value = None
+        update_user.apply(self.args, task_id='task-1')
+        update_user.apply(self.args, task_id='task-2')
+        self.assertEqual(2, get_user_data.call_count)
+        self.assertEqual(2, et.data_ext().add_record.call_count)
+        self.assertEqual(2, et.trigger_send.call_count)
+
+    def test_records_copies(self):
+        """Changes to a step's result after it's recorded aren't kept"""
+        journal = StepJournal('task-1')
+        user_data = {'lang': 'en', 'newsletters': ['slug']}
+        journal.record('get_user_data', user_data)
+        user_data['lang'] = 'de'
+        user_data['newsletters'].append('other')
+        journal = StepJournal('task-1')
+        result = journal.result('get_user_data')
+        self.assertEqual({'lang': 'en', 'newsletters': ['slug']}, result)
+        result['lang'] = 'de'
+        self.assertEqual('en', journal.result('get_user_data')['lang'])
@@ -0,0 +1,181 @@
+import httplib
+import socket
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from urllib2 import URLError
+
+from django.test import TestCase
+
+from mock import Mock, patch
+from suds.transport import Request, TransportError
+
+from news.backends.transport import ConnectionPool, PooledHttpTransport, \
+    clear_pools, get_pool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.clients.add(self.client_address)
+        status = int(self.path.strip('/') or 200)
+        body = '' if status == 204 else '<soap>%d</soap>' % status
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPooledHttpTransport(TestCase):
+    def setUp(self):
+        clear_pools()
+        self.server = HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.clients = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        clear_pools()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self, path=''):
+        request = Request(self.url + path, '<soap/>')
+        request.headers = {'Content-Type': 'text/xml'}
+        return PooledHttpTransport(timeout=5).send(request)
+
+    @patch('news.backends.transport.statsd')
+    def test_connection_reused(self, statsd):
+        """Consecutive calls go over one connection"""
+        for i in range(3):
+            reply = self.send()
+            self.assertEqual('<soap>200</soap>', reply.message)
+        self.assertEqual(1, len(self.server.clients))
+        statsd.incr.assert_any_call('news.et.pool.miss')
+        self.assertEqual(2, statsd.incr.call_args_list.count(
+            (('news.et.pool.hit',), {})))
+
+    def test_error_status(self):
+        """Non-2xx replies raise TransportError with the body, like suds"""
+        with self.assertRaises(TransportError) as cm:
+            self.send('500')
+        self.assertEqual(500, cm.exception.httpcode)
+        self.assertEqual('<soap>500</soap>', cm.exception.fp.read())
+        # The connection is still fine to reuse
+        self.send()
+        self.assertEqual(1, len(self.server.clients))
+
+    def test_accepted_status(self):
+        """202 and 204 are replies, like with suds' own transport"""
+        self.assertEqual('<soap>202</soap>', self.send('202').message)
+        self.assertEqual('', self.send('204').message)
+
+
+class TestConnectionPool(TestCase):
+    def make_pool(self, size=2, max_idle=60):
+        pool = ConnectionPool('https', 'example.com', None, size, max_idle, 3)
+        pool.connect = Mock(side_effect=lambda: Mock())
+        return pool
+
+    def test_bounded(self):
+        """No more than `size` idle connections are kept"""
+        pool = self.make_pool(size=2)
+        conns = [pool.checkout()[0] for i in range(3)]
+        for conn in conns:
+            pool.checkin(conn)
+        self.assertEqual(2, len(pool.idle))
+        self.assertTrue(conns[2].close.called)
+
+    @patch('news.backends.transport.time')
+    def test_idle_eviction(self, time):
+        """Connections idle for too long are closed instead of reused"""
+        pool = self.make_pool(max_idle=60)
+        time.time.return_value = 1000
+        conn, reused = pool.checkout()
+        pool.checkin(conn)
+        time.time.return_value = 1061
+        new_conn, reused = pool.checkout()
+        self.assertFalse(reused)
+        self.assertNotEqual(conn, new_conn)
+        self.assertTrue(conn.close.called)
+
+    @patch('news.backends.transport.get_pool')
+    def test_stale_reconnect(self, get_pool):
+        """A reused connection the server closed is retried once"""
+        stale, fresh = Mock(), Mock()
+        stale.getresponse.side_effect = httplib.BadStatusLine('')
+        fresh.getresponse.return_value.status = 200
+        fresh.getresponse.return_value.read.return_value = 'ok'
+        fresh.getresponse.return_value.getheaders.return_value = []
+        pool = get_pool.return_value
+        pool.checkout.return_value = (stale, True)
+        pool.connect.return_value = fresh
+
+        reply = PooledHttpTransport().send(
+            Request('https://example.com/Service.asmx', '<soap/>'))
+        self.assertEqual('ok', reply.message)
+        self.assertTrue(stale.close.called)
+
+    @patch('news.backends.transport.get_pool')
+    def test_timeout_not_retried(self, get_pool):
+        """A timeout might mean the request went through; don't resend"""
+        conn = Mock()
+        conn.getresponse.side_effect = socket.timeout()
+        get_pool.return_value.checkout.return_value = (conn, True)
+
+        with self.assertRaises(URLError):
+            PooledHttpTransport().send(
+                Request('https://example.com/Service.asmx', '<soap/>'))
+        self.assertEqual(1, conn.request.call_count)
+        self.assertFalse(get_pool.return_value.connect.called)
+
+    @patch('news.backends.transport.get_pool')
+    def test_write_error_retried(self, get_pool):
+        """A reused connection that fails while the request is written is
+        retried on a new one"""
+        stale, fresh = Mock(), Mock()
+        stale.request.side_effect = socket.error(32, 'Broken pipe')
+        fresh.getresponse.return_value.status = 200
+        fresh.getresponse.return_value.read.return_value = 'ok'
+        fresh.getresponse.return_value.getheaders.return_value = []
+        pool = get_pool.return_value
+        pool.checkout.return_value = (stale, True)
+        pool.connect.return_value = fresh
+
+        reply = PooledHttpTransport().send(
+            Request('https://example.com/Service.asmx', '<soap/>'))
+        self.assertEqual('ok', reply.message)
+
+    @patch('news.backends.transport.get_pool')
+    def test_response_error_not_retried(self, get_pool):
+        """Once the request is sent, only a connection closed without a
+        byte of response is retried; anything else may come after ET
+        acted on it"""
+        for error in (socket.error(104, 'Connection reset by peer'),
+                      httplib.BadStatusLine('HTTP/1.1 2')):
+            conn = Mock()
+            conn.getresponse.side_effect = error
+            get_pool.return_value.checkout.return_value = (conn, True)
+            get_pool.return_value.connect.reset_mock()
+
+            with self.assertRaises(URLError):
+                PooledHttpTransport().send(
+                    Request('https://example.com/Service.asmx', '<soap/>'))
+            self.assertEqual(1, conn.request.call_count)
+            self.assertFalse(get_pool.return_value.connect.called)
+
+    @patch('news.backends.transport.os')
+    def test_pools_per_process(self, os):
+        """A forked process doesn't use its parent's connections"""
+        os.getpid.return_value = 1
+        parent = get_pool('https', 'example.com', None, 3)
+        self.assertIs(parent, get_pool('https', 'example.com', None, 3))
+        os.getpid.return_value = 2
+        self.assertIsNot(parent, get_pool('https', 'example.com', None, 3))
@@ -4,15 +4,16 @@ import json
 from django.conf import settings
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.utils.unittest import skip
 
 from mock import patch, ANY
 
 from news import models, views, tasks
 from news.backends.common import NewsletterException
+from news.newsletters import FFAY_VENDOR_ID, FFOS_VENDOR_ID
 from news.tasks import update_user, SUBSCRIBE, UU_EXEMPT_NEW, \
-    UU_ALREADY_CONFIRMED, SET, FFOS_VENDOR_ID, \
-    FFAY_VENDOR_ID, MSG_EMAIL_OR_TOKEN_REQUIRED, UNSUBSCRIBE
+    UU_ALREADY_CONFIRMED, SET, MSG_EMAIL_OR_TOKEN_REQUIRED, UNSUBSCRIBE
 
 
 class UpdateUserTest(TestCase):
@@ -327,13 +328,15 @@ class UpdateUserTest(TestCase):
         # )
 
     @patch('news.tasks.apply_updates')
-    @patch('news.tasks.send_message')
+    @patch('news.tasks.ExactTarget')
     @patch('news.views.get_user_data')
     def test_update_send_newsletters_welcome(self, get_user_data,
-                                             send_message,
+                                             mock_ExactTarget,
                                              apply_updates):
         # If we subscribe to multiple newsletters, and no confirmation is
-        # needed, we send each of their welcome messages
+        # needed, we send each of their welcome messages, in one call
+        et = mock_ExactTarget()
+        et.trigger_sends.return_value = [None, None]
         get_user_data.return_value = None  # Does not exist yet
         nl1 = models.Newsletter.objects.create(
             slug='slug',
@@ -364,12 +367,16 @@ class UpdateUserTest(TestCase):
                          type=SUBSCRIBE,
                          optin=True)
         self.assertEqual(UU_EXEMPT_NEW, rc)
-        self.assertEqual(2, send_message.call_count)
-        calls_args = [x[0] for x in send_message.call_args_list]
-        self.assertIn(('en_WELCOME1', self.sub.email, self.sub.token, 'H'),
-                      calls_args)
-        self.assertIn(('en_WELCOME2', self.sub.email, self.sub.token, 'H'),
-                      calls_args)
+        self.assertEqual(1, et.trigger_sends.call_count)
+        sends = et.trigger_sends.call_args[0][0]
+        fields = {
+            'EMAIL_ADDRESS_': self.sub.email,
+            'TOKEN': self.sub.token,
+            'EMAIL_FORMAT_': 'H',
+        }
+        self.assertEqual(2, len(sends))
+        self.assertIn(('en_WELCOME1', fields), sends)
+        self.assertIn(('en_WELCOME2', fields), sends)
 
     @patch('news.tasks.apply_updates')
     @patch('news.tasks.send_message')
@@ -486,10 +493,8 @@ class UpdateUserTest(TestCase):
     @patch('news.tasks.apply_updates')
     @patch('news.tasks.send_message')
     @patch('news.views.get_user_data')
-    @patch('news.views.newsletter_fields')
     @patch('news.tasks.ExactTarget')
     def test_update_user_set_works_if_no_newsletters(self, et_mock,
-                                                     newsletter_fields,
                                                      get_user_data,
                                                      send_message,
                                                      apply_updates):
@@ -499,7 +504,7 @@ class UpdateUserTest(TestCase):
         caused exceptions because '' is not a valid newsletter name.
         """
         et = et_mock()
-        nl1 = models.Newsletter.objects.create(
+        models.Newsletter.objects.create(
             slug='slug',
             title='title',
             active=True,
@@ -513,8 +518,6 @@ class UpdateUserTest(TestCase):
             'format': 'H',
         }
 
-        newsletter_fields.return_value = [nl1.vendor_id]
-
         # Mock user data - we want our user subbed to our newsletter to start
         self.get_user_data['confirmed'] = True
         self.get_user_data['newsletters'] = ['slug']
@@ -544,11 +547,9 @@ class UpdateUserTest(TestCase):
     @patch('news.tasks.apply_updates')
     @patch('news.tasks.send_message')
     @patch('news.views.get_user_data')
-    @patch('news.views.newsletter_fields')
     @patch('news.views.ExactTargetDataExt')
     @patch('news.tasks.ExactTarget')
     def test_resubscribe_doesnt_update_newsletter(self, et_mock, etde_mock,
-                                                  newsletter_fields,
                                                   get_user_data,
                                                   send_message,
                                                   apply_updates):
@@ -559,7 +560,7 @@ class UpdateUserTest(TestCase):
         """
         et_mock()
         etde = etde_mock()
-        nl1 = models.Newsletter.objects.create(
+        models.Newsletter.objects.create(
             slug='slug',
             title='title',
             active=True,
@@ -576,8 +577,6 @@ class UpdateUserTest(TestCase):
 
         get_user_data.return_value = self.get_user_data
 
-        newsletter_fields.return_value = [nl1.vendor_id]
-
         # Mock user data - we want our user subbed to our newsletter to start
         etde.get_record.return_value = self.user_data
 
@@ -598,10 +597,8 @@ class UpdateUserTest(TestCase):
                                           })
 
     @patch('news.views.get_user_data')
-    @patch('news.views.newsletter_fields')
     @patch('news.tasks.ExactTarget')
     def test_set_doesnt_update_newsletter(self, et_mock,
-                                          newsletter_fields,
                                           get_user_data):
         """
         When setting the newsletters to ones the user is already subscribed
@@ -609,7 +606,7 @@ class UpdateUserTest(TestCase):
         don't want that newsletter's _DATE to be updated for no reason.
         """
         et = et_mock()
-        nl1 = models.Newsletter.objects.create(
+        models.Newsletter.objects.create(
             slug='slug',
             title='title',
             active=True,
@@ -624,8 +621,6 @@ class UpdateUserTest(TestCase):
             'format': 'H',
         }
 
-        newsletter_fields.return_value = [nl1.vendor_id]
-
         # Mock user data - we want our user subbed to our newsletter to start
         get_user_data.return_value = self.get_user_data
         #etde.get_record.return_value = self.user_data
@@ -731,10 +726,9 @@ class UpdateUserTest(TestCase):
         )
 
     @patch('news.views.get_user_data')
-    @patch('news.views.newsletter_fields')
     @patch('news.views.ExactTargetDataExt')
     @patch('news.tasks.ExactTarget')
-    def test_unsub_is_careful(self, et_mock, etde_mock, newsletter_fields,
+    def test_unsub_is_careful(self, et_mock, etde_mock,
                               get_user_data):
         """
         When unsubscribing, we only unsubscribe things the user is
@@ -742,14 +736,14 @@ class UpdateUserTest(TestCase):
         """
         et = et_mock()
         etde = etde_mock()
-        nl1 = models.Newsletter.objects.create(
+        models.Newsletter.objects.create(
             slug='slug',
             title='title',
             active=True,
             languages='en-US,fr',
             vendor_id='TITLE_UNKNOWN',
         )
-        nl2 = models.Newsletter.objects.create(
+        models.Newsletter.objects.create(
             slug='slug2',
             title='title2',
             active=True,
@@ -765,8 +759,6 @@ class UpdateUserTest(TestCase):
         }
         get_user_data.return_value = self.get_user_data
 
-        newsletter_fields.return_value = [nl1.vendor_id, nl2.vendor_id]
-
         # We're only subscribed to TITLE_UNKNOWN though, not the other one
         etde.get_record.return_value = self.user_data
 
@@ -943,3 +935,50 @@ class UpdateUserTest(TestCase):
              'EMAIL_ADDRESS_': 'dude@example.com',
              'TOKEN': ANY}
         )
+
+    @override_settings(USER_DATA_MIRROR=True)
+    @patch('news.tasks.apply_updates')
+    @patch('news.tasks.send_message')
+    @patch('news.views.get_user_data')
+    def test_update_user_writes_mirror(self, get_user_data, send_message,
+                                       apply_updates):
+        """The user's data as left in ET is stored as their mirror"""
+        self.get_user_data['token'] = self.sub.token
+        get_user_data.return_value = self.get_user_data
+        for slug in ('slug', 'other'):
+            models.Newsletter.objects.create(slug=slug, title=slug,
+                                             languages='en',
+                                             vendor_id=slug.upper())
+        data = {
+            'country': 'de',
+            'format': 'T',
+            'newsletters': 'other',
+        }
+        update_user(data, self.sub.email, self.sub.token, False, SUBSCRIBE,
+                    True)
+        get_user_data.assert_called_with(token=self.sub.token,
+                                         use_mirror=False)
+
+        user_data = models.Subscriber.objects.get_mirrored(
+            token=self.sub.token)
+        self.assertEqual(['other', 'slug'], user_data['newsletters'])
+        self.assertEqual('de', user_data['country'])
+        self.assertEqual('T', user_data['format'])
+        self.assertTrue(user_data['confirmed'])
+
+    @override_settings(USER_DATA_MIRROR=True)
+    @patch('news.tasks.writebuffer.pending_tokens')
+    @patch('news.tasks.apply_updates')
+    @patch('news.tasks.send_message')
+    @patch('news.views.get_user_data')
+    def test_buffered_write_not_synced(self, get_user_data, send_message,
+                                       apply_updates, pending_tokens):
+        """A write still in the write buffer isn't marked as in ET"""
+        self.get_user_data['token'] = self.sub.token
+        get_user_data.return_value = self.get_user_data
+        pending_tokens.return_value = set([self.sub.token])
+        update_user({'country': 'de'}, self.sub.email, self.sub.token,
+                    False, SUBSCRIBE, True)
+        sub = models.Subscriber.objects.get(token=self.sub.token)
+        self.assertEqual('de', sub.et_data['country'])
+        self.assertIsNone(sub.et_synced)
@@ -1,8 +1,14 @@
 import json
+from datetime import timedelta
+from StringIO import StringIO
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
 
 from mock import patch, ANY
 
@@ -11,7 +17,9 @@ from basket import errors
 from news import models, tasks
 from news.backends.common import NewsletterException
 from news.models import Newsletter, APIUser
-from news.views import look_for_user, get_user_data
+from news.usercache import (UNKNOWN_USERS_CACHE, forget_user_data,
+                            is_unknown_user, remember_unknown_user)
+from news.views import get_user_data, look_for_user, lookup_subscriber
 
 
 class UpdateFxAInfoTest(TestCase):
@@ -283,6 +291,8 @@ class TestLookForUser(TestCase):
 
 
 class TestGetUserData(TestCase):
+    def setUp(self):
+        cache.clear()
 
     def check_get_user(self,
                        master,
@@ -376,6 +386,327 @@ class TestGetUserData(TestCase):
         self.check_get_user(None, mock_user, ANY, False, mock_user)
 
 
+@patch('news.views.look_for_user')
+class TestUserDataCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = {
+            'status': 'ok',
+            'email': 'dude@example.com',
+            'token': 'TOKEN',
+        }
+
+    def test_cached(self, look_for_user):
+        """Users found in ET are looked up once, by token or email"""
+        look_for_user.return_value = self.user
+        self.assertEqual('TOKEN', get_user_data(token='TOKEN')['token'])
+        self.assertEqual('TOKEN', get_user_data(token='TOKEN')['token'])
+        self.assertEqual('TOKEN',
+                         get_user_data(email='dude@example.com')['token'])
+        self.assertEqual(1, look_for_user.call_count)
+
+    def test_not_found_or_error(self, look_for_user):
+        """Only users that were found are cached"""
+        look_for_user.return_value = None
+        get_user_data(token='TOKEN')
+        look_for_user.reset_mock()
+        look_for_user.side_effect = NewsletterException()
+        get_user_data(token='TOKEN')
+        look_for_user.reset_mock()
+        look_for_user.side_effect = None
+        get_user_data(token='TOKEN')
+        self.assertTrue(look_for_user.called)
+
+    @patch('news.tasks.ExactTarget')
+    def test_writes_invalidate(self, et, look_for_user):
+        look_for_user.return_value = self.user
+        get_user_data(token='TOKEN')
+        tasks.apply_updates(settings.EXACTTARGET_DATA, {'TOKEN': 'TOKEN'})
+        get_user_data(token='TOKEN')
+        self.assertEqual(2, look_for_user.call_count)
+
+    def test_write_during_lookup(self, look_for_user):
+        """A lookup that a write overtook doesn't cache what it found"""
+        def lookup(*args, **kwargs):
+            # The record is written while ET answers with the old one
+            forget_user_data('TOKEN')
+            return dict(self.user)
+        look_for_user.side_effect = lookup
+        get_user_data(token='TOKEN')
+        look_for_user.side_effect = None
+        look_for_user.return_value = self.user
+        get_user_data(token='TOKEN')
+        get_user_data(token='TOKEN')
+        self.assertEqual(2, look_for_user.call_count)
+
+    def test_changed_email(self, look_for_user):
+        """An email whose user now has another email isn't a hit"""
+        look_for_user.return_value = self.user
+        get_user_data(email='dude@example.com')
+        forget_user_data('TOKEN')
+        self.user['email'] = 'other@example.com'
+        get_user_data(token='TOKEN')
+        get_user_data(email='dude@example.com')
+        self.assertEqual(3, look_for_user.call_count)
+
+    @patch('news.usercache.TIMEOUT', 0)
+    def test_disabled(self, look_for_user):
+        look_for_user.return_value = self.user
+        get_user_data(token='TOKEN')
+        get_user_data(token='TOKEN')
+        self.assertEqual(2, look_for_user.call_count)
+
+
+@patch('news.views.ExactTargetDataExt')
+class TestProjection(TestCase):
+    def setUp(self):
+        cache.clear()
+        Newsletter.objects.create(slug='slug', title='title',
+                                  languages='en', vendor_id='VENDOR')
+        self.record = {
+            'EMAIL_ADDRESS_': 'dude@example.com',
+            'LANGUAGE_ISO2': 'en',
+            'TOKEN': 'TOKEN',
+        }
+
+    def test_projection(self, ext):
+        """Only the fields asked for are looked up"""
+        get_record = ext.return_value.get_record
+        get_record.return_value = self.record
+        user_data = get_user_data(token='TOKEN', projection=('lang',))
+        get_record.assert_called_with(
+            settings.EXACTTARGET_DATA, 'TOKEN',
+            ['EMAIL_ADDRESS_', 'LANGUAGE_ISO2', 'TOKEN'], 'TOKEN')
+        self.assertEqual({
+            'status': 'ok',
+            'email': 'dude@example.com',
+            'token': 'TOKEN',
+            'lang': 'en',
+            'confirmed': True,
+            'pending': False,
+            'master': True,
+        }, user_data)
+
+        # Partial data isn't cached
+        get_user_data(token='TOKEN', projection=('lang',))
+        self.assertEqual(2, get_record.call_count)
+
+    def test_newsletters(self, ext):
+        """Newsletter flags are only looked up when asked for"""
+        get_record = ext.return_value.get_record
+        get_record.return_value = dict(self.record, VENDOR_FLG='Y')
+        user_data = get_user_data(token='TOKEN',
+                                  projection=('newsletters',))
+        self.assertEqual(['EMAIL_ADDRESS_', 'TOKEN', 'VENDOR_FLG'],
+                         get_record.call_args[0][2])
+        self.assertEqual(['slug'], user_data['newsletters'])
+
+
+@override_settings(USER_DATA_MIRROR=True)
+@patch('news.views.look_for_user')
+class TestUserDataMirror(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sub = models.Subscriber.objects.create(email='dude@example.com',
+                                                    token='TOKEN')
+        self.user = {
+            'status': 'ok',
+            'email': 'dude@example.com',
+            'token': 'TOKEN',
+            'lang': 'en',
+        }
+
+    def get_user_data(self, **kwargs):
+        # Skip the short-lived cache to get to the mirror
+        cache.clear()
+        return get_user_data(token='TOKEN', **kwargs)
+
+    def test_mirrored(self, look_for_user):
+        """Users fetched from ET are answered from the mirror after"""
+        look_for_user.return_value = self.user
+        self.assertEqual('en', self.get_user_data()['lang'])
+        look_for_user.reset_mock()
+        user_data = self.get_user_data()
+        self.assertFalse(look_for_user.called)
+        self.assertEqual('ok', user_data['status'])
+        self.assertEqual('en', user_data['lang'])
+        self.assertEqual('en', get_user_data(email='dude@example.com')['lang'])
+
+    def test_stale(self, look_for_user):
+        look_for_user.return_value = self.user
+        self.get_user_data()
+        models.Subscriber.objects.update(
+            et_synced=now() - timedelta(seconds=25 * 60 * 60))
+        look_for_user.reset_mock()
+        self.get_user_data()
+        self.assertTrue(look_for_user.called)
+
+    def test_use_mirror(self, look_for_user):
+        look_for_user.return_value = self.user
+        self.get_user_data()
+        look_for_user.reset_mock()
+        self.get_user_data(use_mirror=False)
+        self.assertTrue(look_for_user.called)
+
+    def test_write_during_lookup(self, look_for_user):
+        """A lookup doesn't mirror what it found over a write-through that
+        came in while it was looking"""
+        def lookup(*args, **kwargs):
+            models.Subscriber.objects.mirror(dict(self.user, lang='de'))
+            return self.user
+        look_for_user.side_effect = lookup
+        self.assertEqual('en', self.get_user_data()['lang'])
+        self.assertEqual('de', models.Subscriber.objects.get_mirrored(
+            token='TOKEN')['lang'])
+
+    @patch('news.views.writebuffer.pending_tokens')
+    def test_pending_write(self, pending_tokens, look_for_user):
+        """Users with a write on its way to ET aren't mirrored from it"""
+        pending_tokens.return_value = set(['TOKEN'])
+        look_for_user.return_value = self.user
+        self.get_user_data()
+        self.assertIsNone(models.Subscriber.objects.get_mirrored(
+            token='TOKEN'))
+
+    @patch('news.tasks.apply_updates')
+    @patch('news.tasks.send_welcomes')
+    def test_confirm_writes_through(self, send_welcomes, apply_updates,
+                                    look_for_user):
+        look_for_user.return_value = dict(self.user, confirmed=False,
+                                          newsletters=[])
+        self.get_user_data()
+        tasks.confirm_user('TOKEN', None)
+        look_for_user.reset_mock()
+        self.assertTrue(self.get_user_data()['confirmed'])
+        self.assertFalse(look_for_user.called)
+
+    @patch('news.views.ExactTargetDataExt')
+    def test_reconcile(self, ext, look_for_user):
+        """reconcile_mirror fetches users not synced lately in batches"""
+        models.Subscriber.objects.create(email='new@example.com',
+                                         token='NEW')
+        record = {
+            'EMAIL_ADDRESS_': 'dude@example.com',
+            'EMAIL_FORMAT_': 'T',
+            'COUNTRY_': 'de',
+            'LANGUAGE_ISO2': 'de',
+            'TOKEN': 'TOKEN',
+            'CREATED_DATE_': '2014-01-01',
+        }
+        ext.return_value.get_records.side_effect = lambda database, *args: {
+            settings.EXACTTARGET_DATA: {'TOKEN': record},
+        }.get(database, {})
+        call_command('reconcile_mirror', stdout=StringIO())
+
+        user_data = self.get_user_data()
+        self.assertFalse(look_for_user.called)
+        self.assertEqual('de', user_data['lang'])
+        self.assertTrue(user_data['master'])
+        # Unknown to ET: synced, but not answered from the mirror
+        new = models.Subscriber.objects.get(token='NEW')
+        self.assertTrue(new.et_synced)
+        self.assertIsNone(models.Subscriber.objects.get_mirrored(token='NEW'))
+
+    @patch('news.views.ExactTargetDataExt')
+    def test_reconcile_other_email(self, ext, look_for_user):
+        """A subscriber ET has another email for is still synced, by
+        token"""
+        record = {
+            'EMAIL_ADDRESS_': 'moved@example.com',
+            'TOKEN': 'TOKEN',
+        }
+        ext.return_value.get_records.side_effect = lambda database, *args: {
+            settings.EXACTTARGET_DATA: {'TOKEN': record},
+        }.get(database, {})
+        call_command('reconcile_mirror', stdout=StringIO())
+
+        self.assertTrue(models.Subscriber.objects.get(token='TOKEN').et_synced)
+        self.assertEqual('moved@example.com',
+                         self.get_user_data()['email'])
+        self.assertFalse(look_for_user.called)
+        # Not an answer for the email we have for them
+        self.assertIsNone(models.Subscriber.objects.get_mirrored(
+            email='dude@example.com'))
+
+    @patch('news.views.ExactTargetDataExt')
+    def test_reconcile_write_through(self, ext, look_for_user):
+        """A write-through made while reconcile_mirror looks the user up
+        isn't overwritten with what ET had before it"""
+        before = {'EMAIL_ADDRESS_': 'dude@example.com', 'TOKEN': 'TOKEN',
+                  'LANGUAGE_ISO2': 'en'}
+
+        def get_records(database, *args):
+            if database != settings.EXACTTARGET_DATA:
+                return {}
+            models.Subscriber.objects.mirror(dict(self.user, lang='fr'))
+            return {'TOKEN': before}
+        ext.return_value.get_records.side_effect = get_records
+        call_command('reconcile_mirror', stdout=StringIO())
+        self.assertEqual('fr', self.get_user_data()['lang'])
+        self.assertFalse(look_for_user.called)
+
+    @patch('news.views.ExactTargetDataExt')
+    def test_reconcile_pending_write(self, ext, look_for_user):
+        """Users with a write still in the write buffer are left for
+        later"""
+        ext.return_value.get_records.return_value = {}
+        with patch('news.writebuffer.pending_tokens',
+                   return_value=set(['TOKEN'])):
+            call_command('reconcile_mirror', stdout=StringIO())
+        self.assertIsNone(models.Subscriber.objects.get(
+            token='TOKEN').et_synced)
+
+    @override_settings(USER_DATA_MIRROR=False)
+    @patch('news.views.ExactTargetDataExt')
+    def test_reconcile_off(self, ext, look_for_user):
+        call_command('reconcile_mirror', stdout=StringIO())
+        self.assertFalse(ext.called)
+        self.assertIsNone(models.Subscriber.objects.get(
+            token='TOKEN').et_synced)
+
+
+@patch('news.views.look_for_user')
+class TestUnknownUsers(TestCase):
+    def setUp(self):
+        cache.clear()
+        UNKNOWN_USERS_CACHE.clear()
+
+    def test_remembered(self, look_for_user):
+        """A token in neither basket nor ET is only looked up once"""
+        look_for_user.return_value = None
+        for i in range(2):
+            resp = self.client.get('/news/user/junk/')
+            self.assertEqual(403, resp.status_code)
+        self.assertEqual(2, look_for_user.call_count)  # master and optin
+
+    def test_errors_not_remembered(self, look_for_user):
+        look_for_user.side_effect = NewsletterException()
+        self.client.get('/news/user/junk/')
+        self.client.get('/news/user/junk/')
+        self.assertEqual(2, look_for_user.call_count)
+
+    @patch('news.views.get_user_data')
+    def test_forgotten_on_save(self, get_user_data, look_for_user):
+        """A token is forgotten once a subscriber has it"""
+        get_user_data.return_value = None
+        self.client.get('/news/user/junk/')
+        self.assertTrue(is_unknown_user(token='junk'))
+        models.Subscriber.objects.create(email='dude@example.com',
+                                         token='junk')
+        self.assertFalse(is_unknown_user(token='junk'))
+
+    def test_saved_in_other_process(self, look_for_user):
+        """A token another process saved a subscriber with isn't unknown,
+        though that process couldn't forget it here"""
+        remember_unknown_user(token='junk')
+        with patch('news.models.forget_unknown_user'):
+            sub = models.Subscriber.objects.create(email='dude@example.com',
+                                                   token='junk')
+        with patch('news.views.is_unknown_user') as is_unknown:
+            self.assertEqual(sub, lookup_subscriber(token='junk')[0])
+        self.assertFalse(is_unknown.called)
+
+
 class UserTest(TestCase):
     @patch('news.views.update_user.delay')
     def test_user_set(self, update_user):
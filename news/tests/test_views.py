@@ -1,15 +1,30 @@
+import gzip
+import hashlib
 import json
+import threading
+from StringIO import StringIO
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
 from basket import errors
 from mock import ANY, Mock, patch
 
 from news import models, views
+from news.backends.common import CircuitOpen, NewsletterNoResultsException
+from news.backends.exacttarget import ExactTargetDataExt
 from news.models import APIUser, Newsletter
-from news.newsletters import newsletter_languages, newsletter_fields
+from news.newsletters import (GENERATION_KEY, NewsletterInfo,
+                              clear_newsletter_cache,
+                              is_supported_newsletter_language,
+                              newsletter_field, newsletter_fields,
+                              newsletter_flags, newsletter_languages,
+                              newsletter_name,
+                              newsletters_exempt_from_confirmation)
 from news.views import language_code_is_valid
 
 
@@ -475,6 +490,33 @@ class TestNewslettersAPI(TestCase):
         for lang in ['en-US', 'fr']:
             self.assertIn(lang, obj['languages'])
 
+    def test_newsletters_etag(self):
+        """Requests with the current ETag get a 304 without queries"""
+        nl = models.Newsletter.objects.create(slug='slug', title='title',
+                                               vendor_id='VENDOR1',
+                                               languages='en-US,fr')
+        resp = views.newsletters(self.rf.get(self.url))
+        etag = resp['ETag']
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('"%s"' % hashlib.md5(resp.content).hexdigest(),
+                         etag)
+        self.assertEqual('max-age=300', resp['Cache-Control'])
+
+        req = self.rf.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        with self.assertNumQueries(0):
+            resp = views.newsletters(req)
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual('', resp.content)
+
+        # Changing a newsletter changes the ETag
+        nl.title = 'new title'
+        nl.save()
+        resp = views.newsletters(req)
+        self.assertEqual(200, resp.status_code)
+        self.assertNotEqual(etag, resp['ETag'])
+        data = json.loads(resp.content)
+        self.assertEqual('new title', data['newsletters']['slug']['title'])
+
     def test_strip_languages(self):
         # If someone edits Newsletter and puts whitespace in the languages
         # field, we strip it on save
@@ -533,6 +575,65 @@ class TestNewslettersAPI(TestCase):
             newsletter_fields()
         self.assertFalse(get.called)
 
+    def test_newsletters_memo(self):
+        """Each process keeps the data until the generation changes"""
+        models.Newsletter.objects.create(slug='slug', title='title',
+                                          vendor_id='VEND1',
+                                          languages='en-US')
+        newsletter_fields()
+        generation = cache.get(GENERATION_KEY)
+        with patch('news.newsletters.cache') as mock_cache:
+            mock_cache.get.return_value = generation
+            self.assertEqual([u'VEND1'], newsletter_fields())
+        mock_cache.get.assert_called_once_with(GENERATION_KEY)
+
+    def test_newsletters_generation(self):
+        """Another process clearing the cache is noticed"""
+        models.Newsletter.objects.create(slug='slug', title='title',
+                                          vendor_id='VEND1',
+                                          languages='en-US')
+        self.assertEqual([u'VEND1'], newsletter_fields())
+        # As if changed by another process, whose post_save cleared it
+        models.Newsletter.objects.filter(slug='slug')\
+            .update(vendor_id='VEND2')
+        self.assertEqual([u'VEND1'], newsletter_fields())
+        clear_newsletter_cache()
+        self.assertEqual([u'VEND2'], newsletter_fields())
+
+    def test_compact_data(self):
+        """The cached data holds no model objects"""
+        models.Newsletter.objects.create(slug='slug', title='title',
+                                          vendor_id='VEND1',
+                                          languages='en-US, fr',
+                                          requires_double_optin=True)
+        models.Newsletter.objects.create(slug='slug2', title='title2',
+                                          vendor_id='VEND2',
+                                          languages='de')
+        newsletter_fields()
+        data = cache.get('newsletters_cache_data:%s'
+                         % cache.get(GENERATION_KEY))
+        self.assertEqual(NewsletterInfo('slug', 'VEND1', ('en-US', 'fr'),
+                                        frozenset(['en', 'fr']), '', '',
+                                        True),
+                         data['by_name']['slug'])
+        self.assertEqual('VEND2', newsletter_field('slug2'))
+        self.assertEqual('slug2', newsletter_name('VEND2'))
+        self.assertEqual(None, newsletter_field('nope'))
+        self.assertFalse(newsletters_exempt_from_confirmation(['slug']))
+        self.assertTrue(newsletters_exempt_from_confirmation(['slug',
+                                                              'slug2']))
+
+    def test_language_codes(self):
+        models.Newsletter.objects.create(slug='slug', title='title',
+                                          vendor_id='VEND1',
+                                          languages='en-US, pt-BR')
+        models.Newsletter.objects.create(slug='slug2', title='title2',
+                                          vendor_id='VEND2',
+                                          languages='DE')
+        self.assertTrue(is_supported_newsletter_language('pt-PT'))
+        self.assertTrue(is_supported_newsletter_language('de'))
+        self.assertFalse(is_supported_newsletter_language('fr'))
+
     def test_cache_clearing(self):
         # Our caching of newsletter data doesn't result in wrong answers
         # when newsletters change
@@ -573,6 +674,90 @@ class TestNewslettersAPI(TestCase):
         vendor_ids = newsletter_fields()
         self.assertEqual([], vendor_ids)
 
+    def test_newsletter_flags(self):
+        """The flag decoder turns an ET record into subscribed slugs"""
+        for slug, vendor_id in (('slug1', 'VEND1'), ('slug2', 'VEND2')):
+            models.Newsletter.objects.create(slug=slug, title=slug,
+                                             vendor_id=vendor_id,
+                                             languages='en-US')
+        flags = newsletter_flags()
+        self.assertEqual(set(['VEND1_FLG', 'VEND2_FLG']), set(flags.fields))
+        self.assertEqual(['slug2'], flags.decode({'VEND1_FLG': 'N',
+                                                  'VEND2_FLG': 'Y'}))
+        self.assertEqual([], flags.decode({}))
+        # It's rebuilt when newsletters change
+        models.Newsletter.objects.create(slug='slug3', title='slug3',
+                                         vendor_id='VEND3',
+                                         languages='en-US')
+        self.assertEqual(['slug3'], newsletter_flags().decode(
+            {'VEND3_FLG': 'Y'}))
+
+    @patch('news.newsletters.log')
+    def test_newsletter_flags_shared(self, log):
+        """Newsletters with the same vendor ID share one flag field"""
+        for slug in ('slug1', 'slug2'):
+            models.Newsletter.objects.create(slug=slug, title=slug,
+                                             vendor_id='VEND1',
+                                             languages='en-US')
+        flags = newsletter_flags()
+        self.assertEqual(('VEND1_FLG',), flags.fields)
+        self.assertEqual(set(['slug1', 'slug2']),
+                         set(flags.decode({'VEND1_FLG': 'Y'})))
+        self.assertTrue(log.warn.called)
+
+
+class TestListNewsletters(TestCase):
+    def setUp(self):
+        self.rf = RequestFactory()
+        models.Newsletter.objects.create(slug='slug', title='Title',
+                                         vendor_id='VENDOR1', active=True,
+                                         languages='en')
+
+    def get(self, **headers):
+        return views.list_newsletters(self.rf.get('/news/', **headers))
+
+    def test_rendered_once(self):
+        """The page is only rendered again when the newsletters change"""
+        resp = self.get()
+        self.assertIn('Title', resp.content)
+        with self.assertNumQueries(0):
+            self.assertEqual(resp.content, self.get().content)
+        models.Newsletter.objects.create(slug='slug2', title='Other',
+                                         vendor_id='VENDOR2', active=True,
+                                         languages='en')
+        self.assertIn('Other', self.get().content)
+
+    def test_fetched_once(self):
+        """The ETag and the body come from one fetch of the page"""
+        self.get()
+        with patch('news.views.newsletters_page',
+                   wraps=views.newsletters_page) as newsletters_page:
+            self.get()
+        self.assertEqual(1, newsletters_page.call_count)
+
+    def test_gzip(self):
+        html = self.get().content
+        resp = self.get(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', resp['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', resp['Vary'])
+        content = gzip.GzipFile(fileobj=StringIO(resp.content)).read()
+        self.assertEqual(html, content)
+
+    def test_conditional_get(self):
+        etag = self.get()['ETag']
+        gzip_etag = self.get(HTTP_ACCEPT_ENCODING='gzip')['ETag']
+        self.assertNotEqual(etag, gzip_etag)
+        resp = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual('Accept-Encoding', resp['Vary'])
+        self.assertEqual(304, self.get(HTTP_IF_NONE_MATCH=gzip_etag,
+                                       HTTP_ACCEPT_ENCODING='gzip')
+                         .status_code)
+        # Not the ETag of the representation they'd get
+        self.assertEqual(200, self.get(HTTP_IF_NONE_MATCH=etag,
+                                       HTTP_ACCEPT_ENCODING='gzip')
+                         .status_code)
+
 
 class TestLanguageCodeIsValid(TestCase):
     def test_empty_string(self):
@@ -627,6 +812,7 @@ class RecoveryViewTest(TestCase):
     # See the task tests for more
     def setUp(self):
         self.url = reverse('send_recovery_message')
+        cache.clear()
 
     def test_no_email(self):
         """email not provided - return 400"""
@@ -660,6 +846,19 @@ class RecoveryViewTest(TestCase):
         self.assertEqual(200, resp.status_code)
         mock_send_recovery_message_task.assert_called_with(email)
 
+    @patch('news.views.validate_email', none_mock)
+    @patch('news.views.look_for_user', autospec=True)
+    @patch('news.views.send_recovery_message_task.delay', autospec=True)
+    def test_et_unavailable(self, mock_send_recovery_message_task,
+                            mock_look_for_user):
+        """ET being down is reported instead of queueing the message"""
+        mock_look_for_user.side_effect = CircuitOpen()
+        resp = self.client.post(self.url, {'email': 'dude@example.com'})
+        self.assertEqual(400, resp.status_code)
+        data = json.loads(resp.content)
+        self.assertEqual(errors.BASKET_NETWORK_FAILURE, data['code'])
+        self.assertFalse(mock_send_recovery_message_task.called)
+
 
 @patch('news.views.get_valid_email')
 class TestValidateEmail(TestCase):
@@ -692,3 +891,78 @@ class TestValidateEmail(TestCase):
         """Should not call validation stuff if validated parameter set."""
         views.validate_email({'validated': 'true'})
         self.assertFalse(mock_valid.called)
+
+
+@override_settings(EXACTTARGET_CONCURRENT_LOOKUPS=True)
+class TestConcurrentLookups(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.lock = threading.Lock()
+        self.started = []
+        self.all_started = threading.Event()
+        # Set when a lookup needn't wait for the others any more
+        self.release = threading.Event()
+        self.release.set()
+        self.addCleanup(self.release.set)
+
+    def get_record(self, found, wait_for_all=False):
+        """Fake get_record that finds records in the databases in
+        `found`, once `self.release` is set. With `wait_for_all`, each
+        lookup waits for all three to have started, and records whether
+        they did."""
+        def get_record(ext, database, token, fields, field='TOKEN'):
+            with self.lock:
+                self.started.append(database)
+                if len(self.started) == 3:
+                    self.all_started.set()
+            if wait_for_all:
+                self.overlapped.append(self.all_started.wait(5))
+            self.release.wait(5)
+            if database not in found:
+                raise NewsletterNoResultsException()
+            return {
+                'EMAIL_ADDRESS_': 'dude@example.com',
+                'EMAIL_FORMAT_': 'H',
+                'COUNTRY_': 'us',
+                'LANGUAGE_ISO2': 'en',
+                'TOKEN': token,
+                'CREATED_DATE_': '2014-01-01',
+            }
+        return get_record
+
+    def test_pending_user(self):
+        """A pending user's three lookups are made at once instead of one
+        after another"""
+        self.overlapped = []
+        get_record = self.get_record([settings.EXACTTARGET_OPTIN_STAGE],
+                                     wait_for_all=True)
+        with patch.object(ExactTargetDataExt, 'get_record', get_record):
+            user_data = views.get_user_data(token='TOKEN')
+        # Each of them was still running when the last one started
+        self.assertEqual([True] * 3, self.overlapped)
+        self.assertEqual('TOKEN', user_data['token'])
+        self.assertFalse(user_data['master'])
+        self.assertFalse(user_data['confirmed'])
+
+    def test_confirmed_pending_user(self):
+        get_record = self.get_record([settings.EXACTTARGET_OPTIN_STAGE,
+                                      settings.EXACTTARGET_CONFIRMATION])
+        with patch.object(ExactTargetDataExt, 'get_record', get_record):
+            user_data = views.get_user_data(token='TOKEN')
+        self.assertTrue(user_data['confirmed'])
+
+    def test_unknown_user(self):
+        with patch.object(ExactTargetDataExt, 'get_record',
+                          self.get_record([])):
+            self.assertIsNone(views.get_user_data(token='TOKEN'))
+
+    @patch('news.views.ET_LOOKUP_DEADLINE', 0.05)
+    def test_deadline(self):
+        """Lookups still running at the deadline are a network failure"""
+        # The lookups only finish after the deadline
+        self.release.clear()
+        get_record = self.get_record([settings.EXACTTARGET_DATA])
+        with patch.object(ExactTargetDataExt, 'get_record', get_record):
+            user_data = views.get_user_data(token='TOKEN')
+        self.assertEqual('error', user_data['status'])
+        self.assertEqual(errors.BASKET_NETWORK_FAILURE, user_data['code'])
@@ -0,0 +1,192 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+from news import tasks, writebuffer
+from news.backends.common import NewsletterException, \
+    NewsletterNoResultsException
+from news.models import FailedTask, Newsletter
+from news.views import get_user_data
+from news.writebuffer import merge_records
+
+
+class TestMergeRecords(TestCase):
+    def test_last_write_wins(self):
+        eq_({'TOKEN': 't', 'LANGUAGE_ISO2': 'de', 'COUNTRY_': 'us'},
+            merge_records({'TOKEN': 't', 'LANGUAGE_ISO2': 'en',
+                           'COUNTRY_': 'us'},
+                          {'TOKEN': 't', 'LANGUAGE_ISO2': 'de'}))
+
+    def test_flags_and_dates(self):
+        """A newsletter's _DATE is never kept from another write than its
+        _FLG"""
+        eq_({'TOKEN': 't', 'A_FLG': 'N', 'B_FLG': 'Y', 'B_DATE': '2014-01-01'},
+            merge_records({'TOKEN': 't', 'A_FLG': 'Y', 'A_DATE': '2014-01-01',
+                           'B_FLG': 'Y', 'B_DATE': '2014-01-01'},
+                          {'TOKEN': 't', 'A_FLG': 'N'}))
+
+
+@patch('news.writebuffer.WINDOW', 5)
+@patch('news.tasks.ExactTargetDataExt')
+@patch('news.tasks.ExactTarget')
+class TestWriteBuffer(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch.object(tasks.flush_updates, 'apply_async')
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_coalesced(self, et, ext):
+        """Writes of the same row are merged into one, in one call"""
+        ext().add_records.return_value = [None, None]
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'A_FLG': 'Y',
+                                     'A_DATE': '2014-01-01'})
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'B_FLG': 'Y',
+                                     'B_DATE': '2014-01-02'})
+        tasks.apply_updates('DATA', {'TOKEN': 't2', 'A_FLG': 'N',
+                                     'A_DATE': '2014-01-02'})
+        tasks.apply_updates('DATA', {'TOKEN': 't2', 'A_FLG': 'Y',
+                                     'A_DATE': '2014-01-03',
+                                     'B_FLG': 'N', 'B_DATE': '2014-01-03'})
+        ok_(not et().data_ext().add_record.called)
+        # Only the first write schedules the flush
+        self.apply_async.assert_called_once_with(('DATA',), countdown=5)
+
+        tasks.flush_updates('DATA')
+        eq_(1, ext().add_records.call_count)
+        data_id, fields, rows = ext().add_records.call_args[0]
+        eq_('DATA', data_id)
+        eq_(('A_DATE', 'A_FLG', 'B_DATE', 'B_FLG', 'TOKEN'), fields)
+        eq_(sorted([['2014-01-01', 'Y', '2014-01-02', 'Y', 't1'],
+                    ['2014-01-03', 'Y', '2014-01-03', 'N', 't2']]),
+            sorted(rows))
+        # The buffer is empty and the next write schedules a flush again
+        eq_({}, writebuffer.take_updates('DATA'))
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'de'})
+        eq_(2, self.apply_async.call_count)
+
+    def test_failed_flush(self, et, ext):
+        """Updates that couldn't be written are flushed again, under newer
+        ones"""
+        ext().add_records.side_effect = NewsletterException('down')
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us',
+                                     'LANGUAGE_ISO2': 'en'})
+        with patch.object(tasks.flush_updates, 'retry') as retry:
+            retry.side_effect = NewsletterException('retry')
+            with self.assertRaises(NewsletterException):
+                tasks.flush_updates('DATA')
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'de'})
+        eq_({'t1': {'TOKEN': 't1', 'COUNTRY_': 'de', 'LANGUAGE_ISO2': 'en'}},
+            writebuffer.take_updates('DATA'))
+
+    def test_rejected_rows(self, et, ext):
+        """Rows ET rejects are flushed again, until they've been rejected
+        MAX_FAILURES times in a row"""
+        def add_records(data_id, fields, rows):
+            token = fields.index('TOKEN')
+            return ['bad row' if row[token] == 't1' else None
+                    for row in rows]
+        ext().add_records.side_effect = add_records
+
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us'})
+        tasks.apply_updates('DATA', {'TOKEN': 't2', 'COUNTRY_': 'us'})
+        for i in range(writebuffer.MAX_FAILURES - 1):
+            self.apply_async.reset_mock()
+            tasks.flush_updates('DATA')
+            # Back in the buffer, with a flush scheduled
+            self.apply_async.assert_called_once_with(
+                ('DATA',), countdown=tasks.flush_updates.default_retry_delay)
+            eq_(set(['t1']),
+                writebuffer.pending_tokens(['DATA'], ['t1', 't2']))
+        eq_(0, FailedTask.objects.count())
+
+        # The last try gives up on it
+        self.apply_async.reset_mock()
+        tasks.flush_updates('DATA')
+        ok_(not self.apply_async.called)
+        eq_({}, writebuffer.take_updates('DATA'))
+        failed = FailedTask.objects.get()
+        eq_(tasks.write_update.name, failed.name)
+        eq_(['DATA', {'TOKEN': 't1', 'COUNTRY_': 'us'}], failed.args)
+
+    def test_rejected_row_written(self, et, ext):
+        """A row written after being rejected starts its count again"""
+        ext().add_records.return_value = ['bad row']
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us'})
+        tasks.flush_updates('DATA')
+        eq_(1, cache.get(writebuffer._key('DATA', 'failures', 't1')))
+        ext().add_records.return_value = [None]
+        tasks.flush_updates('DATA')
+        eq_(None, cache.get(writebuffer._key('DATA', 'failures', 't1')))
+
+    def test_busy(self, et, ext):
+        """If the buffer can't be had, the write is made straight away"""
+        with patch('news.writebuffer._lock') as lock:
+            lock.return_value = False
+            tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us'})
+        data_id, fields, values = et().data_ext().add_record.call_args[0]
+        eq_({'TOKEN': 't1', 'COUNTRY_': 'us'}, dict(zip(fields, values)))
+        ok_(not self.apply_async.called)
+
+    def test_busy_row(self, et, ext):
+        """A write that can't be buffered takes the row's pending write
+        with it, so that can't overwrite it later"""
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us',
+                                     'LANGUAGE_ISO2': 'en'})
+        with patch('news.writebuffer._lock') as lock:
+            lock.return_value = False
+            tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'de'})
+        data_id, fields, values = et().data_ext().add_record.call_args[0]
+        eq_({'TOKEN': 't1', 'COUNTRY_': 'de', 'LANGUAGE_ISO2': 'en'},
+            dict(zip(fields, values)))
+        eq_({}, writebuffer.take_updates('DATA'))
+
+    @patch('news.writebuffer.MAX_ROWS', 1)
+    def test_full(self, et, ext):
+        """Rows past the buffer's size are written straight away"""
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'COUNTRY_': 'us'})
+        tasks.apply_updates('DATA', {'TOKEN': 't1', 'LANGUAGE_ISO2': 'en'})
+        ok_(not et().data_ext().add_record.called)
+        tasks.apply_updates('DATA', {'TOKEN': 't2', 'COUNTRY_': 'de'})
+        data_id, fields, values = et().data_ext().add_record.call_args[0]
+        eq_({'TOKEN': 't2', 'COUNTRY_': 'de'}, dict(zip(fields, values)))
+        eq_({'t1': {'TOKEN': 't1', 'COUNTRY_': 'us', 'LANGUAGE_ISO2': 'en'}},
+            writebuffer.take_updates('DATA'))
+
+    @patch('news.views.ExactTargetDataExt')
+    def test_lookups_see_pending_writes(self, views_ext, et, ext):
+        """get_user_data shows writes that are still in the buffer"""
+        Newsletter.objects.create(slug='slug', vendor_id='VENDOR',
+                                  languages='en')
+        records = {settings.EXACTTARGET_DATA: {
+            'TOKEN': 't1', 'EMAIL_ADDRESS_': 'dude@example.com',
+            'LANGUAGE_ISO2': 'en', 'VENDOR_FLG': 'N',
+        }}
+
+        def get_record(database, *args):
+            if database not in records:
+                raise NewsletterNoResultsException()
+            return dict(records[database])
+        views_ext().get_record.side_effect = get_record
+
+        tasks.apply_updates(settings.EXACTTARGET_DATA,
+                            {'TOKEN': 't1', 'VENDOR_FLG': 'Y',
+                             'LANGUAGE_ISO2': 'de'})
+        user_data = get_user_data(token='t1')
+        eq_(['slug'], user_data['newsletters'])
+        eq_('de', user_data['lang'])
+
+        # A new user whose record is only in the buffer yet
+        del records[settings.EXACTTARGET_DATA]
+        tasks.apply_updates(settings.EXACTTARGET_OPTIN_STAGE,
+                            {'TOKEN': 't2',
+                             'EMAIL_ADDRESS_': 'new@example.com'})
+        user_data = get_user_data(token='t2')
+        eq_('new@example.com', user_data['email'])
+        ok_(not user_data['confirmed'])
+        tasks.apply_updates(settings.EXACTTARGET_CONFIRMATION,
+                            {'TOKEN': 't2'})
+        ok_(get_user_data(token='t2')['confirmed'])
@@ -0,0 +1,153 @@
+"""A short-lived cache of the user data get_user_data() finds in ET.
+
+The same user is often looked up several times within seconds, e.g. by
+a view and then by the task it queues, and each lookup is up to three
+ET calls. Entries are keyed by token; looking up by email goes through
+a second key that only holds the token. Anything that writes a user's
+record to ET must call forget_user_data() so the write isn't hidden
+from the next reader.
+
+A lookup that started before a write can finish after it, with the
+record from before the write. So that it doesn't cache that record,
+forget_user_data() also bumps a write generation per token: a reader
+gets a user_data_stamp() before looking the user up, and
+cache_user_data() only keeps the result if no write came in between.
+
+The default cache is used so web and task processes share entries.
+USER_DATA_CACHE_TIMEOUT sets how many seconds an entry lives; 0 turns
+the cache off.
+
+Tokens and emails that are in neither basket nor ET are remembered too,
+in the bounded, per-process 'unknown_users' cache, so requests with junk
+or stale tokens don't cost ET calls every time. Saving a Subscriber
+forgets its token and email there, but only in the process that saved
+it, so only ask is_unknown_user() about users basket's database has
+just been found not to have.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache, get_cache
+from django_statsd.clients import statsd
+
+
+__all__ = ('cache_user_data', 'cached_user_data', 'forget_unknown_user',
+           'forget_user_data', 'is_unknown_user', 'remember_unknown_user',
+           'user_data_stamp')
+
+
+TIMEOUT = getattr(settings, 'USER_DATA_CACHE_TIMEOUT', 60)
+
+UNKNOWN_USERS_CACHE = get_cache('unknown_users')
+
+
+def _token_key(token):
+    return 'user_data:token:%s' % token
+
+
+def _email_key(email):
+    # Emails can hold characters memcached doesn't allow in keys
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return 'user_data:email:%s' % hashlib.md5(email).hexdigest()
+
+
+def cached_user_data(token=None, email=None):
+    """Return the cached user data for the email if given, otherwise
+    for the token, or None"""
+    if not TIMEOUT:
+        return None
+    if email:
+        token = cache.get(_email_key(email))
+    user_data = token and cache.get(_token_key(token))
+    if user_data and email and user_data['email'] != email:
+        # Their email has changed since
+        user_data = None
+    statsd.incr('news.user_data_cache.%s' % ('hit' if user_data else 'miss'))
+    return user_data or None
+
+
+def _written_key(token):
+    return 'user_data:written:%s' % token
+
+
+def _write_generation(token):
+    return cache.get(_written_key(token))
+
+
+def user_data_stamp(token=None, email=None):
+    """
+    Call before looking up the user with this token or email in ET, and
+    pass what it returns to cache_user_data() with the result.
+    """
+    if not TIMEOUT:
+        return None, None
+    if not token and email:
+        token = cache.get(_email_key(email))
+    return token, token and _write_generation(token)
+
+
+def cache_user_data(user_data, stamp):
+    """
+    Cache user data found in ET, as returned by get_user_data(), unless
+    the user's record was written since ``stamp`` was taken with
+    user_data_stamp().
+    """
+    if not TIMEOUT:
+        return
+    token = user_data['token']
+    entries = {_email_key(user_data['email']): token}
+    stamp_token, generation = stamp
+    # A lookup by an email we didn't know the token of had no write
+    # generation to go by; the next one will.
+    if stamp_token == token:
+        entries[_token_key(token)] = user_data
+    cache.set_many(entries, TIMEOUT)
+    # Checked after setting, so that a write either shows up here or
+    # comes after the set and deletes the entry itself.
+    if stamp_token == token and _write_generation(token) != generation:
+        statsd.incr('news.user_data_cache.stale')
+        cache.delete(_token_key(token))
+
+
+def forget_user_data(token):
+    """Drop the cached user data for this token, and keep lookups that
+    started before now from caching theirs"""
+    if not (TIMEOUT and token):
+        return
+    try:
+        cache.incr(_written_key(token))
+    except ValueError:
+        # Start from the time, so that a generation that expired isn't
+        # reused for a later write.
+        cache.set(_written_key(token), int(time.time() * 1000), TIMEOUT)
+    cache.delete(_token_key(token))
+
+
+def _unknown_keys(token, email):
+    keys = []
+    if token:
+        keys.append(_token_key(token))
+    if email:
+        keys.append(_email_key(email))
+    return keys
+
+
+def is_unknown_user(token=None, email=None):
+    """Whether the token or email was recently found in neither basket
+    nor ET. Only to be trusted when basket still doesn't have it."""
+    unknown = bool(UNKNOWN_USERS_CACHE.get_many(_unknown_keys(token, email)))
+    statsd.incr('news.unknown_users_cache.%s'
+                % ('hit' if unknown else 'miss'))
+    return unknown
+
+
+def remember_unknown_user(token=None, email=None):
+    """Remember that the token or email is in neither basket nor ET"""
+    UNKNOWN_USERS_CACHE.set_many(
+        dict.fromkeys(_unknown_keys(token, email), True))
+
+
+def forget_unknown_user(token=None, email=None):
+    UNKNOWN_USERS_CACHE.delete_many(_unknown_keys(token, email))
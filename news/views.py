@@ -1,21 +1,28 @@
 from functools import wraps
+import hashlib
 import json
 import re
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse
-from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.text import compress_string
+from django.utils.timezone import now
 from django.views.decorators.cache import cache_control, never_cache
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_GET, require_POST
+from django.views.decorators.http import (condition, require_GET,
+                                          require_POST)
+from django.views.decorators.vary import vary_on_headers
 
 # Get error codes from basket-client so users see the same definitions
 from basket import errors
 
 from .backends.common import NewsletterNoResultsException
-from .backends.exacttarget import (ExactTargetDataExt, NewsletterException,
-                                   UnauthorizedException)
+from .backends.exacttarget import (ET_LOOKUP_DEADLINE, ExactTargetDataExt,
+                                   NewsletterException, UnauthorizedException)
 from .email import get_valid_email
 from .models import APIUser, Newsletter, Subscriber
 from .tasks import (
@@ -30,7 +37,12 @@ from .tasks import (
     update_student_ambassadors,
     update_user,
 )
-from .newsletters import newsletter_fields, newsletter_slugs, slug_to_vendor_id
+from .newsletters import (newsletter_flags, newsletter_slugs,
+                          newsletters_etag, newsletters_generation,
+                          newsletters_json)
+from .usercache import (cache_user_data, cached_user_data, is_unknown_user,
+                        remember_unknown_user, user_data_stamp)
+from . import writebuffer
 
 
 ## Utility functions
@@ -58,7 +70,7 @@ def has_valid_api_key(request):
     return APIUser.is_valid(api_key)
 
 
-def lookup_subscriber(token=None, email=None):
+def lookup_subscriber(token=None, email=None, projection=None):
     """
     Find or create Subscriber object for given token and/or email.
 
@@ -76,12 +88,15 @@ def lookup_subscriber(token=None, email=None):
     to come up with another solution.
 
     If we are only given a token, and cannot find any user with that
-    token in Basket or ET, then the returned subscriber is None.
+    token in Basket or ET, then the returned subscriber is None. Such
+    tokens are remembered for a while, so we don't keep asking ET
+    about them; see news.usercache.
 
     Returns (Subscriber, user_data, created).
 
     The user_data is only provided if we had to ask ET about this
-    email/token (and found it there); otherwise, it's None.
+    email/token (and found it there); otherwise, it's None. It's limited
+    to ``projection`` as for get_user_data.
     """
     if not (token or email):
         raise Exception(MSG_EMAIL_OR_TOKEN_REQUIRED)
@@ -99,8 +114,12 @@ def lookup_subscriber(token=None, email=None):
         # But currently no callers pass both, so luckily we don't have to
         # figure out what we would do in that case.
         created = True
-        # Check with ET to see if our DB is just out of sync
-        user_data = get_user_data(sync_data=True, **kwargs)
+        # Check with ET to see if our DB is just out of sync, unless we
+        # recently found they're not there either. Having just missed
+        # them here, we know no other process has saved them since.
+        if not is_unknown_user(**kwargs):
+            user_data = get_user_data(sync_data=True,
+                                      projection=projection, **kwargs)
         if user_data and user_data['status'] == 'ok':
             # Found them in ET and updated subscriber db locally
             subscriber = Subscriber.objects.get(**kwargs)
@@ -117,6 +136,8 @@ def lookup_subscriber(token=None, email=None):
                 # No email?  Just token? Token not known in basket or ET?
                 # That's an error.
                 subscriber = None
+                if user_data is None:
+                    remember_unknown_user(**kwargs)
     else:
         created = False
     return subscriber, user_data, created
@@ -209,7 +230,8 @@ def update_user_task(request, type, data=None, optin=True, sync=False):
         # We need a token for this user. If we don't have a Subscriber
         # object for them already, we'll need to find or make one,
         # checking ET first if need be.
-        sub, user_data, created = lookup_subscriber(email=email)
+        sub, user_data, created = lookup_subscriber(email=email,
+                                                    projection=())
 
     update_user.delay(data, sub.email, sub.token, created, type, optin)
     return HttpResponseJSON({
@@ -236,29 +258,83 @@ def look_for_user(database, email, token, fields):
                               fields,
                               'EMAIL_ADDRESS_' if email else 'TOKEN')
     except NewsletterNoResultsException:
+        user = None
+    return user_data_from_record(database, user, token)
+
+
+def user_data_from_record(database, user, token=None):
+    """
+    Turn a record from look_for_user's ET database, or None if the user
+    with that token wasn't found there, into its result.
+
+    Writes of the record still in the write buffer are laid over it; see
+    news.writebuffer.
+    """
+    user = writebuffer.overlay(database, user, token)
+    if user is None:
         return None
     if database == settings.EXACTTARGET_CONFIRMATION:
         return True
-    newsletters = []
-    for slug in newsletter_slugs():
-        vendor_id = slug_to_vendor_id(slug)
-        flag = "%s_FLG" % vendor_id
-        if user.get(flag, 'N') == 'Y':
-            newsletters.append(slug)
+    if 'EMAIL_ADDRESS_' not in user:
+        # Only a pending change to a record ET doesn't have yet
+        return None
+    newsletters = newsletter_flags().decode(user)
+    # Fields not looked up (see user_data_fields) come out empty.
     user_data = {
         'status': 'ok',
         'email': user['EMAIL_ADDRESS_'],
-        'format': user['EMAIL_FORMAT_'] or 'H',
-        'country': user['COUNTRY_'] or '',
-        'lang': user['LANGUAGE_ISO2'] or '',  # Never None
+        'format': user.get('EMAIL_FORMAT_') or 'H',
+        'country': user.get('COUNTRY_') or '',
+        'lang': user.get('LANGUAGE_ISO2') or '',  # Never None
         'token': user['TOKEN'],
-        'created-date': user['CREATED_DATE_'],
+        'created-date': user.get('CREATED_DATE_'),
         'newsletters': newsletters,
     }
     return user_data
 
 
-def get_user_data(token=None, email=None, sync_data=False):
+def start_lookups(email, token, fields):
+    """
+    Return a function that looks the user up in one of the ET databases
+    get_user_data uses, like look_for_user does.
+
+    With EXACTTARGET_CONCURRENT_LOOKUPS set, every lookup get_user_data
+    might need is started right away, and the function just waits for
+    the result of the one asked for. All of them share one deadline, so
+    get_user_data takes about one ET round trip instead of up to three.
+    """
+    databases = [
+        (settings.EXACTTARGET_DATA, fields),
+        (settings.EXACTTARGET_OPTIN_STAGE, fields),
+        # The confirmed database doesn't have most of the user's data,
+        # just their token.
+        (settings.EXACTTARGET_CONFIRMATION, ['Token']),
+    ]
+    if not settings.EXACTTARGET_CONCURRENT_LOOKUPS:
+        database_fields = dict(databases)
+        return lambda database: look_for_user(database, email, token,
+                                              database_fields[database])
+
+    ext = ExactTargetDataExt(settings.EXACTTARGET_USER,
+                             settings.EXACTTARGET_PASS)
+    deadline = time.time() + ET_LOOKUP_DEADLINE
+    pending = {}
+    for database, database_fields in databases:
+        pending[database] = ext.get_record_async(
+            database, email or token, database_fields,
+            'EMAIL_ADDRESS_' if email else 'TOKEN')
+
+    def lookup(database):
+        try:
+            user = pending[database].result(deadline)
+        except NewsletterNoResultsException:
+            user = None
+        return user_data_from_record(database, user, token)
+    return lookup
+
+
+def get_user_data(token=None, email=None, sync_data=False, use_mirror=True,
+                  projection=None):
     """Return a dictionary of the user's data from Exact Target.
     Look them up by their email if given, otherwise by the token.
 
@@ -304,37 +380,101 @@ def get_user_data(token=None, email=None, sync_data=False):
         'master': True if we found them in the master subscribers table
     }
 
+    To look up less, pass the fields you need as ``projection``, e.g.
+    ``('lang', 'format')``. 'email', 'token' and the confirmation state
+    are always returned; other fields may be left out. Only ask for
+    'newsletters' if you use it: that's a field in ET per newsletter.
 
+    Users found in ET are cached for a short while; see news.usercache.
+    With USER_DATA_MIRROR set, users are also answered from the copy of
+    their data in basket's database while it's recent enough, unless
+    use_mirror is False.
     """
-    newsletters = newsletter_fields()
-
-    fields = [
-        'EMAIL_ADDRESS_',
-        'EMAIL_FORMAT_',
-        'COUNTRY_',
-        'LANGUAGE_ISO2',
-        'TOKEN',
-        'CREATED_DATE_',
-    ]
+    user_data = cached_user_data(token=token, email=email)
+    if user_data is None and use_mirror and settings.USER_DATA_MIRROR:
+        # Only subscribers we have are mirrored, so no need to sync.
+        user_data = Subscriber.objects.get_mirrored(token=token, email=email)
+        if user_data is not None:
+            return user_data
+    # Only complete user data is cached or mirrored
+    fetched = user_data is None and projection is None
+    if user_data is None:
+        stamp = user_data_stamp(token=token, email=email)
+        # To the second, as MySQL keeps et_synced
+        fetched_at = now().replace(microsecond=0)
+        user_data = fetch_user_data(token=token, email=email,
+                                    projection=projection)
+        if not user_data or user_data.get('status') != 'ok':
+            return user_data
+        if fetched:
+            cache_user_data(user_data, stamp)
+
+    # We did find a user
+    if sync_data:
+        # if user not in our db create it, if token mismatch fix it.
+        Subscriber.objects.get_and_sync(user_data['email'], user_data['token'])
+    if fetched and settings.USER_DATA_MIRROR:
+        # Not if ET doesn't have the user's latest writes yet, or a
+        # write-through came in since the lookup started.
+        pending = writebuffer.pending_tokens(
+            [settings.EXACTTARGET_DATA, settings.EXACTTARGET_OPTIN_STAGE,
+             settings.EXACTTARGET_CONFIRMATION], [user_data['token']])
+        if not pending:
+            Subscriber.objects.mirror(user_data, fetched_at=fetched_at)
+
+    return user_data
+
+
+# The ET field behind each field of get_user_data's result, but for
+# 'newsletters', which takes a flag field per newsletter.
+USER_DATA_FIELDS = [
+    ('email', 'EMAIL_ADDRESS_'),
+    ('format', 'EMAIL_FORMAT_'),
+    ('country', 'COUNTRY_'),
+    ('lang', 'LANGUAGE_ISO2'),
+    ('token', 'TOKEN'),
+    ('created-date', 'CREATED_DATE_'),
+]
+
+# Fields get_user_data always returns when it finds the user
+BASE_USER_DATA = frozenset(['status', 'email', 'token', 'confirmed',
+                            'pending', 'master'])
+
+
+def user_data_fields(projection=None):
+    """
+    The ET fields get_user_data needs.
 
-    for nl in newsletters:
-        fields.append('%s_FLG' % nl)
+    :param projection: Fields of get_user_data's result to look up, on
+        top of BASE_USER_DATA; None for all of them.
+    """
+    fields = [field for name, field in USER_DATA_FIELDS
+              if projection is None or name in BASE_USER_DATA or
+              name in projection]
+
+    if projection is None or 'newsletters' in projection:
+        fields.extend(newsletter_flags().fields)
+    return fields
+
+
+def fetch_user_data(token=None, email=None, projection=None):
+    """Look the user up in ET, for get_user_data, which see."""
+    fields = user_data_fields(projection)
 
     confirmed = True
     pending = False
     master = True
     try:
+        lookup = start_lookups(email, token, fields)
         # Look first in the master subscribers database for the user
-        user_data = look_for_user(settings.EXACTTARGET_DATA,
-                                  email, token, fields)
+        user_data = lookup(settings.EXACTTARGET_DATA)
         # If we get back a user, then they have already confirmed.
 
         # If not, look for them in the database of unconfirmed users.
         if user_data is None:
             master = False
             confirmed = False
-            user_data = look_for_user(settings.EXACTTARGET_OPTIN_STAGE,
-                                      email, token, fields)
+            user_data = lookup(settings.EXACTTARGET_OPTIN_STAGE)
             if user_data is None:
                 # No such user, as far as we can tell - if they're in
                 # neither the master subscribers nor optin database,
@@ -345,10 +485,8 @@ def get_user_data(token=None, email=None, sync_data=False):
             # might have confirmed but the batch job hasn't
             # yet run to move their data to the master subscribers
             # database; catch that case here by looking for them in the
-            # Confirmed database.  Do it simply; the confirmed database
-            # doesn't have most of the user's data, just their token.
-            if look_for_user(settings.EXACTTARGET_CONFIRMATION,
-                             email, token, ['Token']):
+            # Confirmed database.
+            if lookup(settings.EXACTTARGET_CONFIRMATION):
                 # Ah-ha, they're in the Confirmed DB so they did confirm
                 confirmed = True
 
@@ -369,13 +507,45 @@ def get_user_data(token=None, email=None, sync_data=False):
             'desc': 'Email service provider auth failure',
             'code': errors.BASKET_EMAIL_PROVIDER_AUTH_FAILURE,
         }
+    if projection is not None:
+        user_data = dict((key, value) for key, value in user_data.items()
+                         if key in BASE_USER_DATA or key in projection)
+    return user_data
 
-    # We did find a user
-    if sync_data:
-        # if user not in our db create it, if token mismatch fix it.
-        Subscriber.objects.get_and_sync(user_data['email'], user_data['token'])
 
-    return user_data
+def fetch_users_data(tokens):
+    """
+    Look many users up in ET at once, the way fetch_user_data looks up
+    one.
+
+    :returns: A dict mapping the tokens of the users that were found to
+        their data.
+    :raises: NewsletterException, UnauthorizedException
+    """
+    fields = user_data_fields()
+    ext = ExactTargetDataExt(settings.EXACTTARGET_USER,
+                             settings.EXACTTARGET_PASS)
+    users = {}
+    master = ext.get_records(settings.EXACTTARGET_DATA, tokens, fields)
+    for token, record in master.items():
+        users[token] = user_data_from_record(settings.EXACTTARGET_DATA,
+                                             record)
+        users[token].update(confirmed=True, pending=False, master=True)
+
+    rest = [token for token in tokens if token not in users]
+    optin = {}
+    if rest:
+        optin = ext.get_records(settings.EXACTTARGET_OPTIN_STAGE, rest,
+                                fields)
+    if optin:
+        confirmed = ext.get_records(settings.EXACTTARGET_CONFIRMATION,
+                                    optin.keys(), ['Token'], 'Token')
+        for token, record in optin.items():
+            users[token] = user_data_from_record(
+                settings.EXACTTARGET_OPTIN_STAGE, record)
+            users[token].update(confirmed=token in confirmed, pending=False,
+                                master=False)
+    return users
 
 
 def get_user(token=None, email=None, sync_data=False):
@@ -603,13 +773,17 @@ def send_recovery_message(request):
         return invalid_email_response(e)
 
     email = request.POST.get('email')
-    user_data = get_user_data(email=email, sync_data=True)
+    user_data = get_user_data(email=email, sync_data=True, projection=())
     if not user_data:
         return HttpResponseJSON({
             'status': 'error',
             'desc': 'Email address not known',
             'code': errors.BASKET_UNKNOWN_EMAIL,
         }, 404)  # Note: Bedrock looks for this 404
+    if user_data.get('status') == 'error':
+        # Most likely ET is unavailable; no use queueing the message.
+        status_code = user_data.pop('status_code', 400)
+        return HttpResponseJSON(user_data, status_code)
     send_recovery_message_task.delay(email)
     return HttpResponseJSON({'status': 'ok'})
 
@@ -685,21 +859,11 @@ def custom_update_phonebook(request, token):
 # Get data about current newsletters
 @require_GET
 @cache_control(max_age=300)
+@condition(etag_func=lambda request: newsletters_etag())
 def newsletters(request):
-    # Get the newsletters as a dictionary of dictionaries that are
-    # easily jsonified
-
-    result = {}
-    for newsletter in Newsletter.objects.all().values():
-        newsletter['languages'] = newsletter['languages'].split(",")
-        result[newsletter['slug']] = newsletter
-        del newsletter['id']  # caller doesn't need to know our pkey
-        del newsletter['slug']  # or our slug
-
-    return HttpResponseJSON({
-        'status': 'ok',
-        'newsletters': result,
-    })
+    # The response is built with the rest of the cached newsletter data,
+    # see news.newsletters. If-None-Match requests with its ETag get a 304.
+    return HttpResponse(newsletters_json(), content_type='application/json')
 
 
 @never_cache
@@ -783,11 +947,53 @@ def lookup_user(request):
     return HttpResponseJSON(user_data, status_code)
 
 
+accepts_gzip = re.compile(r'\bgzip\b').search
+
+
+def newsletters_page():
+    """
+    The list_newsletters page as (html, gzipped html, etag).
+
+    It only changes when the newsletters do, so it's rendered once for
+    each generation of the newsletter data and kept in the cache.
+    """
+    key = 'newsletters_page:%s' % newsletters_generation()
+    page = cache.get(key)
+    if page is None:
+        html = render_to_string('news/newsletters.html', {
+            'newsletters': Newsletter.objects.filter(active=True),
+        }).encode('utf-8')
+        page = (html, compress_string(html), hashlib.md5(html).hexdigest())
+        cache.set(key, page)
+    return page
+
+
+def request_newsletters_page(request):
+    """newsletters_page(), fetched once for the request"""
+    if not hasattr(request, 'newsletters_page'):
+        request.newsletters_page = newsletters_page()
+    return request.newsletters_page
+
+
+def newsletters_page_etag(request):
+    etag = request_newsletters_page(request)[2]
+    if accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        # The gzipped page is a different representation
+        etag += '-gzip'
+    return etag
+
+
+# Outside condition, so that its 304s vary on the encoding too
+@vary_on_headers('Accept-Encoding')
+@condition(etag_func=newsletters_page_etag)
 def list_newsletters(request):
     """
     Public web page listing currently active newsletters.
     """
-
-    active_newsletters = Newsletter.objects.filter(active=True)
-    return render(request, "news/newsletters.html",
-                  {'newsletters': active_newsletters})
+    html, gzipped, etag = request_newsletters_page(request)
+    if accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        response = HttpResponse(gzipped)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(html)
+    return response
@@ -0,0 +1,257 @@
+"""A short buffer that merges the updates made to the same ET row.
+
+A user who ticks several newsletters in a row, or a client that calls
+/subscribe/ and then /user/<token>/, makes several update_user tasks,
+each writing a small record for the same TOKEN. With
+EXACTTARGET_WRITE_BUFFER_SECONDS set, apply_updates() merges them here
+instead, per (data extension, token), and the first of them schedules a
+flush_updates task that writes everything buffered for the data
+extension in as few Update calls as ET allows.
+
+Later writes win, field by field, except that a newsletter's _FLG and
+_DATE fields are always kept from the same write.
+
+The default cache is used so that all the web and task processes share
+the buffer. Each row's pending write is kept under its own key, behind
+its own lock, and a small index per data extension lists the tokens
+that have one; EXACTTARGET_WRITE_BUFFER_MAX_ROWS bounds it. A write
+that can't be buffered, because the buffer is full or its row's lock is
+stuck, is made straight away with the row's pending write merged under
+it, so that the pending one can't overwrite it later.
+
+Until a write is flushed, ET lookups don't see it; get_user_data()
+lays it over what they find with overlay(). 0, the default, turns the
+buffer off.
+
+The buffer isn't durable: writes the user has been told succeeded are
+only in the cache until they're flushed, and are lost if it evicts or
+loses them, or if they aren't flushed within UPDATES_TIMEOUT. Rows ET
+rejects are put back and flushed again, up to MAX_FAILURES times; see
+count_failure().
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django_statsd.clients import statsd
+
+from news.backends.common import NewsletterException
+
+
+__all__ = ('buffer_update', 'claim_flush', 'clear_failures',
+           'count_failure', 'merge_records', 'overlay', 'pending_tokens',
+           'restore_updates', 'take_updates')
+
+
+WINDOW = getattr(settings, 'EXACTTARGET_WRITE_BUFFER_SECONDS', 0)
+# Most rows with a pending write per data extension, which keeps the
+# index well under memcached's 1MB limit
+MAX_ROWS = getattr(settings, 'EXACTTARGET_WRITE_BUFFER_MAX_ROWS', 5000)
+
+# Seconds to wait for another process to let go of a lock
+LOCK_WAIT = 1
+# Longest anyone may hold a lock, should they die holding it
+LOCK_TIMEOUT = 10
+# Longest buffered updates are kept, should their flush keep failing
+UPDATES_TIMEOUT = 60 * 60
+# Flushes in a row a row's update may be rejected in before it's given up
+MAX_FAILURES = 5
+
+
+def _key(data_id, kind, token=None):
+    key = 'et_write_buffer:%s:%s' % (kind, data_id)
+    if token:
+        key += ':%s' % token
+    return key
+
+
+def _lock(lock_key):
+    deadline = time.time() + LOCK_WAIT
+    while not cache.add(lock_key, True, LOCK_TIMEOUT):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _unlock(lock_key):
+    cache.delete(lock_key)
+
+
+def merge_records(old, new):
+    """
+    Return the record ``old`` with the fields of ``new`` written over it.
+
+    A newsletter's _DATE is dropped from ``old`` when ``new`` sets its
+    _FLG, so that the two always come from the same write.
+    """
+    merged = dict(old)
+    for field in new:
+        if field.endswith('_FLG'):
+            merged.pop(field[:-len('_FLG')] + '_DATE', None)
+    merged.update(new)
+    return merged
+
+
+def _index_add(data_id, tokens, limit=None):
+    """
+    Add tokens to the index of data_id's rows with a pending write.
+
+    :returns: False if the index is busy, or would grow past ``limit``
+    """
+    lock_key = _key(data_id, 'index_lock')
+    if not _lock(lock_key):
+        return False
+    try:
+        key = _key(data_id, 'index')
+        index = cache.get(key) or set()
+        new = set(tokens) - index
+        if not new:
+            return True
+        if limit is not None and len(index) + len(new) > limit:
+            return False
+        cache.set(key, index | new, UPDATES_TIMEOUT)
+        return True
+    finally:
+        _unlock(lock_key)
+
+
+def buffer_update(data_id, record):
+    """
+    Buffer a write of the record, which must have a TOKEN, to data
+    extension data_id.
+
+    :returns: None if the record was buffered. Otherwise, the record to
+        write straight away: this one, over any write of the same row
+        that was pending, which is taken out of the buffer.
+    """
+    token = record['TOKEN']
+    record_key = _key(data_id, 'record', token)
+    lock_key = _key(data_id, 'lock', token)
+    locked = _lock(lock_key)
+    try:
+        pending = cache.get(record_key)
+        merged = merge_records(pending, record) if pending else record
+        if not locked:
+            # Whoever holds the lock is stuck
+            statsd.incr('news.et_write_buffer.busy')
+        elif _index_add(data_id, [token], MAX_ROWS):
+            cache.set(record_key, merged, UPDATES_TIMEOUT)
+            statsd.incr('news.et_write_buffer.buffered')
+            return None
+        else:
+            statsd.incr('news.et_write_buffer.full')
+        cache.delete(record_key)
+        return merged
+    finally:
+        if locked:
+            _unlock(lock_key)
+
+
+def claim_flush(data_id):
+    """Whether the caller should schedule the flush of data_id's buffer,
+    as nobody else has yet"""
+    return cache.add(_key(data_id, 'flush'), True, WINDOW + LOCK_TIMEOUT)
+
+
+def take_updates(data_id):
+    """
+    Empty data_id's buffer.
+
+    :returns: A dict of the buffered records by token
+    :raises: NewsletterException if the buffer stays busy
+    """
+    lock_key = _key(data_id, 'index_lock')
+    if not _lock(lock_key):
+        raise NewsletterException('ET write buffer %s is busy' % data_id)
+    try:
+        key = _key(data_id, 'index')
+        tokens = cache.get(key) or set()
+        # Writes from now on go in a new index and schedule a new flush
+        cache.delete_many([key, _key(data_id, 'flush')])
+    finally:
+        _unlock(lock_key)
+
+    updates = {}
+    for token in tokens:
+        record_key = _key(data_id, 'record', token)
+        row_lock_key = _key(data_id, 'lock', token)
+        locked = _lock(row_lock_key)
+        try:
+            record = cache.get(record_key)
+            cache.delete(record_key)
+        finally:
+            if locked:
+                _unlock(row_lock_key)
+        if record:
+            updates[token] = record
+    return updates
+
+
+def restore_updates(data_id, updates):
+    """Put updates that couldn't be written back in the buffer, under any
+    that were buffered since"""
+    for token, record in updates.items():
+        record_key = _key(data_id, 'record', token)
+        lock_key = _key(data_id, 'lock', token)
+        locked = _lock(lock_key)
+        try:
+            pending = cache.get(record_key)
+            if pending:
+                record = merge_records(record, pending)
+            cache.set(record_key, record, UPDATES_TIMEOUT)
+        finally:
+            if locked:
+                _unlock(lock_key)
+    # Only index them once they're there to be taken. They were in the
+    # index before, so they may take it over MAX_ROWS.
+    if not _index_add(data_id, updates.keys()):
+        raise NewsletterException('ET write buffer %s is busy' % data_id)
+
+
+def count_failure(data_id, token):
+    """
+    Count a flush in which ET rejected the row's update.
+
+    :returns: The number of them since the row was last written
+    """
+    key = _key(data_id, 'failures', token)
+    cache.add(key, 0, UPDATES_TIMEOUT)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Gone from the cache in between
+        cache.set(key, 1, UPDATES_TIMEOUT)
+        return 1
+
+
+def clear_failures(data_id, tokens):
+    """Forget the failed flushes of the rows, which have been written"""
+    cache.delete_many([_key(data_id, 'failures', token) for token in tokens])
+
+
+def overlay(data_id, record, token=None):
+    """
+    Return ``record``, a row of data extension data_id as found in ET, or
+    None if there was none for ``token``, with the row's pending write
+    written over it. None if there's neither.
+    """
+    if not WINDOW:
+        return record
+    if record:
+        token = record.get('TOKEN') or record.get('Token')
+    pending = token and cache.get(_key(data_id, 'record', token))
+    if not pending:
+        return record
+    statsd.incr('news.et_write_buffer.overlaid')
+    return merge_records(record, pending) if record else pending
+
+
+def pending_tokens(data_ids, tokens):
+    """Return the set of the ``tokens`` that have a write pending in any
+    of the data extensions ``data_ids``"""
+    if not WINDOW:
+        return set()
+    keys = dict((_key(data_id, 'record', token), token)
+                for data_id in data_ids for token in tokens)
+    return set(keys[key] for key in cache.get_many(keys.keys()))
@@ -21,3 +21,13 @@ CACHES['bad_message_ids'] = {
     'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     'TIMEOUT': 12 * 60 * 60,  # 12 hours
 }
+
+# Tokens and emails known to be in neither basket nor ET. See
+# news/usercache.py.
+CACHES['unknown_users'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'TIMEOUT': 10 * 60,  # 10 minutes
+    'OPTIONS': {
+        'MAX_ENTRIES': 10000,
+    },
+}
@@ -106,6 +106,22 @@ DEFAULT_WELCOME_MESSAGE_ID = '39'
 # Name of the database where we put someone's token when they confirm
 EXACTTARGET_CONFIRMATION = 'Confirmation'
 EXACTTARGET_USE_SANDBOX = False
+# Look users up in all the ET databases at once instead of one after
+# another. Uses a thread pool in each web process.
+EXACTTARGET_CONCURRENT_LOOKUPS = False
+# Keep a copy of each user's ET data in basket's database and answer
+# get_user_data from it while it was synced in the last
+# USER_DATA_MIRROR_MAX_AGE seconds. Run ./manage.py reconcile_mirror
+# periodically to keep it synced.
+USER_DATA_MIRROR = False
+USER_DATA_MIRROR_MAX_AGE = 24 * 60 * 60
+# Drop update_user and confirm_user tasks identical to the latest one
+# queued for the same user in the last TASK_DEDUPE_TIMEOUT seconds, while
+# it's queued or running. 0 turns it off. Only turn it on (e.g. 10 * 60)
+# with a default cache shared by web and celery processes: otherwise the
+# worker can't tell web processes a task is done, and identical calls
+# keep being dropped until the timeout.
+TASK_DEDUPE_TIMEOUT = 0
 
 # This is a token that bypasses the news app auth in certain ways to
 # make debugging easier